@@ -0,0 +1,87 @@
+""" A catalogue of the images of every night in a dayBuilder web folder, written as archiveCatalogue.js for rootpage.html. It is stored by column: one list per field, with the night of each image as a position in the list of nights and the image filenames relative to that night's folder. A night is replaced as a whole each time it is processed. """
+
+import os, json, fcntl
+import metadataWriter
+
+recordFields = ['sourceFilename', 'thumbnailFilename', 'previewFilename', 'pngFilename', 'imageFormat', 'xSize', 'ySize']
+
+class archiveCatalogue:
+	def __init__(self, filename, debug=False):
+		self.filename = filename
+		self.debug = debug
+		self.nights = {}
+		self.load()
+
+	def load(self):
+		if not os.path.exists(self.filename): return False
+		try:
+			catalogueFile = open(self.filename, 'rt')
+			text = catalogueFile.read().strip()
+			catalogueFile.close()
+			catalogue = json.loads(text[len("var catalogue= "):-1])
+		except ValueError as e:
+			print("WARNING: Could not read the catalogue %s (%s). Starting a new one."%(self.filename, e))
+			return False
+		columns = catalogue['columns']
+		headers = catalogue['headers']
+		for night in catalogue['nights']: self.nights[night] = []
+		for row in range(len(columns['night'])):
+			record = {}
+			for field in recordFields:
+				# Catalogues written before a field was added have no column for it
+				if field in columns and columns[field][row] is not None: record[field] = columns[field][row]
+			recordHeaders = [ (key, headers[key][row]) for key in catalogue['headerOrder'] if headers[key][row] is not None ]
+			if len(recordHeaders) > 0: record['headers'] = dict(recordHeaders)
+			self.nights[catalogue['nights'][columns['night'][row]]].append(record)
+		return True
+
+	def save(self):
+		""" Writes the catalogue by column, atomically """
+		nights = sorted(self.nights.keys())
+		columns = dict([ (field, []) for field in ['night'] + recordFields ])
+		headerOrder = []
+		for night in nights:
+			for record in self.nights[night]:
+				for key in record.get('headers', {}).keys():
+					if key not in headerOrder: headerOrder.append(key)
+		headers = dict([ (key, []) for key in headerOrder ])
+		for index, night in enumerate(nights):
+			for record in self.nights[night]:
+				columns['night'].append(index)
+				for field in recordFields: columns[field].append(record.get(field))
+				recordHeaders = record.get('headers', {})
+				for key in headerOrder: headers[key].append(recordHeaders.get(key))
+		catalogue = { 'nights': nights, 'columns': columns, 'headerOrder': headerOrder, 'headers': headers }
+		metadataWriter.writeAtomically(self.filename, "var catalogue= %s;\n"%json.dumps(catalogue))
+
+	def updateNight(self, night, records):
+		""" Replaces the images of one night """
+		if self.debug: print("Catalogue: %d images for %s"%(len(records), night))
+		self.nights[night] = list(records)
+
+	def updateNightFromFolder(self, night, folder):
+		""" Replaces the images of one night with the ones in the imageMetadata.js file in its web folder. Returns the number of images. """
+		jsFilename = os.path.join(folder, "imageMetadata.js")
+		if not os.path.exists(jsFilename): return 0
+		records = metadataWriter.readJSONFile(jsFilename)
+		self.updateNight(night, records)
+		return len(records)
+
+	def commitNight(self, night, folder):
+		""" Updates one night from its web folder (as updateNightFromFolder) and saves the catalogue. The catalogue is read again under a lock first, so that nights added in the meantime by other dayBuilders sharing the root folder are kept. Returns the number of images for the night. """
+		lockFile = open(self.filename + ".lock", 'a')
+		try:
+			fcntl.flock(lockFile, fcntl.LOCK_EX)
+			self.nights = {}
+			self.load()
+			count = self.updateNightFromFolder(night, folder)
+			self.save()
+		finally:
+			lockFile.close()
+		return count
+
+	def removeNight(self, night):
+		self.nights.pop(night, None)
+
+	def __len__(self):
+		return sum([ len(records) for records in self.nights.values() ])
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+import argparse, sys, os, io, time, json, collections, shutil, subprocess, tempfile, platform, resource, multiprocessing, gzip, numpy
+import astropy, fitsClasses, imageFormats, imageStretch, metadataWriter
+from astropy.io import fits
+from PIL import Image
+
+stages = ['open', 'headers', 'load', 'reduced', 'boost', 'png', 'preview', 'thumbnail', 'metadata']
+formats = { 'fits': '.fits', 'gz': '.fits.gz', 'fz': '.fits.fz' }
+# Output formats with their PNG compression level or lossy quality
+encoderSettings = [ ('png', 1), ('png', 6), ('png', 9), ('webp', 85), ('webp', 60), ('jpeg', 85) ]
+
+def legacyToImage(imageData):
+	""" The old render path (rotate, Fortran-order reshape, palette and putdata), kept here only to compare against """
+	imgData = numpy.rot90(imageData, 3)
+	imgSize = numpy.shape(imgData)
+	imgLength = imgSize[0] * imgSize[1]
+	testData = numpy.reshape(imgData, imgLength, order="F")
+	img = Image.new("L", imgSize)
+	palette = []
+	for i in range(256):
+		palette.extend((i, i, i)) # grey scale
+		img.putpalette(palette)
+	img.putdata(testData)
+	return img
+
+def timeIt(function, repeats):
+	""" Returns the best wall time of 'repeats' calls """
+	best = None
+	for r in range(repeats):
+		start = time.time()
+		function()
+		elapsed = time.time() - start
+		if best is None or elapsed < best: best = elapsed
+	return best
+
+def benchmarkRender(sizes, repeats):
+	print "Render path: boosted array to 8-bit image (best of %d)"%repeats
+	print "%12s %12s %12s %8s"%("size", "old (s)", "new (s)", "speedup")
+	for size in sizes:
+		data = (numpy.random.random((size, size)) * 255).astype(numpy.float32)
+		oldTime = timeIt(lambda: legacyToImage(data), repeats)
+		newTime = timeIt(lambda: fitsClasses.toImage(data), repeats)
+		print "%12s %12.4f %12.4f %7.1fx"%("%dx%d"%(size, size), oldTime, newTime, oldTime/newTime)
+
+def benchmarkEncoders(sizes, repeats):
+	""" Times writing a stretched synthetic frame in each output format and setting and compares the sizes of the files, to help choose ImageFormat, ImageQuality and PNGCompressLevel """
+	print "Image writers: a stretched synthetic frame (best of %d)"%repeats
+	print "%12s %-10s %10s %12s %10s %10s"%("size", "format", "setting", "time (s)", "size (KB)", "MPix/s")
+	for size in sizes:
+		img = fitsClasses.toImage(imageStretch.stretch(syntheticCCD(size, size)))
+		for imageFormat, setting in encoderSettings:
+			if not imageFormats.imageFormatAvailable(imageFormat):
+				print "%12s %-10s %10s   not available in this PIL"%("%dx%d"%(size, size), imageFormat, setting)
+				continue
+			output = io.BytesIO()
+			def encode():
+				output.seek(0)
+				output.truncate()
+				imageFormats.saveImage(img, output, imageFormat, compressLevel=setting, quality=setting)
+			best = timeIt(encode, repeats)
+			print "%12s %-10s %10s %12.4f %10.1f %10.1f"%("%dx%d"%(size, size), imageFormat, setting, best, len(output.getvalue()) / 1024., size * size / 1e6 / best)
+
+def syntheticRecords(count):
+	""" Image records like those of a night of observing, with a typical header list """
+	records = []
+	for i in range(count):
+		name = "night/r%07d.fits"%i
+		headers = [ ('OBJECT', "Field %d"%(i // 20)), ('IMAGETYP', ['object', 'flat', 'bias'][i % 3]), ('FILTER', "%s"%"ugriz"[i % 5]), ('EXPTIME', [0.0, 30.0, 120.0][i % 3]), ('DATE-OBS', "2026-10-18T%02d:%02d:%02d"%((i // 3600) % 24, (i // 60) % 60, i % 60)),
+			('RA', 15.0 + i * 0.001), ('DEC', -20.5 + i * 0.0005), ('AIRMASS', 1.0 + (i % 100) / 100.), ('INSTRUME', 'WFC'), ('CCDTEMP', -110.2), ('RUN', i), ('OBSERVER', 'Benchmark') ]
+		records.append({ 'sourceFilename': name, 'pngFilename': "images/night/r%07d.png"%i, 'previewFilename': "images/night/preview_r%07d.png"%i, 'thumbnailFilename': "images/night/thumb_r%07d.png"%i,
+			'imageFormat': 'png', 'xSize': 2048, 'ySize': 4096, 'headers': collections.OrderedDict(headers) })
+	return records
+
+def benchmarkMetadata(count, repeats):
+	""" Compares the size of imageMetadata.js in the json and compact forms, plain and gzipped, and the time to write and read each back, for choosing MetadataFormat """
+	records = syntheticRecords(count)
+	folder = tempfile.mkdtemp(prefix="fitsBrowserBenchmark")
+	print "Metadata: %d synthetic records in one file (best of %d)"%(count, repeats)
+	print "%-10s %12s %12s %12s %12s"%("form", "size (KB)", "gzipped (KB)", "write (s)", "read (s)")
+	try:
+		for form in ['json', 'compact']:
+			filename = folder + "/imageMetadata.js"
+			write = timeIt(lambda: metadataWriter.writeJSONFile(filename, "Benchmark", records, compact=(form == 'compact'), gzipped=True), repeats)
+			read = timeIt(lambda: metadataWriter.readJSONFile(filename), repeats)
+			if metadataWriter.readJSONFile(filename) != records: print "WARNING: The %s records did not read back the same"%form
+			print "%-10s %12.1f %12.1f %12.4f %12.4f"%(form, os.path.getsize(filename) / 1024., os.path.getsize(filename + ".gz") / 1024., write, read)
+	finally:
+		shutil.rmtree(folder)
+
+startupRuns = [ ('python', "Python itself"), ('import', "import fitsBrowser"), ('html', "fitsBrowser.py --html"), ('upToDate', "a run with nothing new") ]
+
+def benchmarkStartup(repeats):
+	""" Times starting fitsBrowser.py in a new process (best of 'repeats'): Python on its own, importing fitsBrowser, an --html run, and a run over a small folder that is already up to date. A cron job every few minutes is mostly this. Returns the times and whether importing fitsBrowser imports astropy, which it should leave until there is a file to render. """
+	installPath = os.path.dirname(os.path.abspath(__file__))
+	folder = tempfile.mkdtemp(prefix="fitsBrowserBenchmark")
+	devnull = open(os.devnull, 'w')
+	try:
+		os.makedirs(folder + "/data")
+		for i in range(3): makeFixture(folder + "/data/startup%d.fits"%i, 'single', 256)
+		command = [ sys.executable, installPath + "/fitsBrowser.py", "--datapath", folder + "/data", "--webpath", folder + "/web", "--installpath", installPath ]
+		importCommand = "import sys; sys.path.insert(0, %r); import fitsBrowser"%installPath
+		# The first run makes the images, so the ones after it have nothing to do
+		subprocess.check_call(command, stdout=devnull)
+		commands = { 'python': [ sys.executable, "-c", "pass" ], 'import': [ sys.executable, "-c", importCommand ], 'html': command + [ "--html" ], 'upToDate': command }
+		startup = dict([ (run, timeIt(lambda: subprocess.check_call(commands[run], stdout=devnull), repeats)) for run, description in startupRuns ])
+		startup['importsAstropy'] = subprocess.check_output([ sys.executable, "-c", importCommand + "; print('astropy' in sys.modules)" ]).strip() == "True"
+		startup['importsPIL'] = subprocess.check_output([ sys.executable, "-c", importCommand + "; print('PIL' in sys.modules)" ]).strip() == "True"
+	finally:
+		devnull.close()
+		shutil.rmtree(folder)
+	return startup
+
+def printStartup(startup, previous=None):
+	""" Prints the startup times, and the ratio of each to a previous set of results if there is one """
+	print "%-26s %10s"%("start-up", "time (s)") + ("%10s"%"new/old" if previous is not None else "")
+	for run, description in startupRuns:
+		line = "%-26s %10.3f"%(description, startup[run])
+		if previous is not None and previous.get(run): line+= "%9.2fx"%(startup[run] / previous[run])
+		print line
+	if startup['importsAstropy']: print "WARNING: Importing fitsBrowser imports astropy"
+	if startup.get('importsPIL'): print "WARNING: Importing fitsBrowser imports PIL"
+
+def syntheticCCD(height, width):
+	""" Sky background with read noise and a sprinkling of stars, as unsigned 16-bit integers like the raw camera data """
+	data = numpy.random.normal(1000, 30, (height, width))
+	for star in range(50):
+		y, x = numpy.random.randint(0, height), numpy.random.randint(0, width)
+		data[max(0, y-2):y+3, max(0, x-2):x+3]+= numpy.random.uniform(1000, 30000)
+	return numpy.clip(data, 0, 65535).astype(numpy.uint16)
+
+def makeFixture(filename, fixtureType, size, extensions=2, fileFormat='fits'):
+	""" Writes a synthetic FITS file. 'single' is one size x size image in the primary HDU, 'mef' is a number of size x size/2 image extensions and 'wfc' is four size x size/2 CCDs laid out like the INT Wide Field Camera. 'fileFormat' is 'fits', 'gz' (the whole file gzipped) or 'fz' (each image Rice tile-compressed, as by fpack). """
+	header = fits.Header([('OBJECT', 'Benchmark field'), ('EXPTIME', 30.0), ('FILTER', 'r')])
+	if fixtureType == 'single':
+		images = [ syntheticCCD(size, size) ]
+	else:
+		if fixtureType == 'wfc':
+			header['INSTRUME'] = 'WFC'
+			extensions = 4
+		images = [ syntheticCCD(size, size // 2) for e in range(extensions) ]
+	if fileFormat == 'fz':
+		hdus = [ fits.PrimaryHDU(header=header) ] + [ fits.CompImageHDU(data) for data in images ]
+	elif fixtureType == 'single':
+		hdus = [ fits.PrimaryHDU(images[0], header=header) ]
+	else:
+		hdus = [ fits.PrimaryHDU(header=header) ] + [ fits.ImageHDU(data) for data in images ]
+	if fileFormat == 'gz':
+		outputFile = gzip.open(filename, 'wb')
+		fits.HDUList(hdus).writeto(outputFile)
+		outputFile.close()
+	else:
+		fits.HDUList(hdus).writeto(filename, overwrite=True)
+	pixels = sum([ data.size for data in images ])
+	return pixels, os.path.getsize(filename)
+
+def peakRSS():
+	""" Peak resident memory of this process in MB """
+	maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin': return maxRSS / 1024. / 1024.
+	return maxRSS / 1024.
+
+def benchmarkFixture(fixtureType, size, frames, extensions, folder, fileFormat='fits'):
+	""" Times each stage of the pipeline on 'frames' synthetic files. Runs in its own process so that the peak memory is for this fixture alone. The 'reduced' stage loads the file for a run that only makes previews and thumbnails. """
+	times = dict([ (s, 0.) for s in stages ])
+	pixels = 0
+	bytes = 0
+	records = []
+	for frame in range(frames):
+		filename = "%s_%d_%d%s"%(fixtureType, size, frame, formats[fileFormat])
+		filePixels, fileBytes = makeFixture(folder + "/" + filename, fixtureType, size, extensions, fileFormat)
+		pixels+= filePixels
+		bytes+= fileBytes
+
+		start = time.time()
+		hdulist = fits.open(folder + "/" + filename, memmap=True)
+		hdulist.close()
+		times['open']+= time.time() - start
+
+		start = time.time()
+		headerImage = fitsClasses.fitsObject()
+		headerImage.initFromFITSFile(filename, path=folder, loadPixels=False)
+		times['headers']+= time.time() - start
+
+		start = time.time()
+		reducedImage = fitsClasses.fitsObject()
+		reducedImage.initFromFITSFile(filename, path=folder, outputSize=800)
+		del reducedImage
+		times['reduced']+= time.time() - start
+
+		stageTimes = [ ('load', lambda image: image.initFromFITSFile(filename, path=folder)),
+			('boost', lambda image: image.getBoostedImage()),
+			('png', lambda image: image.writeAsPNG(boosted=True, filename=folder + "/image.png")),
+			('preview', lambda image: image.writePreview(filename=folder + "/preview.png", size=800)),
+			('thumbnail', lambda image: image.createThumbnail(filename=folder + "/thumb.png", size=128)) ]
+		image = fitsClasses.fitsObject()
+		for stage, function in stageTimes:
+			start = time.time()
+			function(image)
+			times[stage]+= time.time() - start
+		records.append({ 'sourceFilename': filename, 'xSize': image.size[0], 'ySize': image.size[1], 'thumbnailFilename': "images/thumb.png", 'headers': { 'OBJECT': 'Benchmark field', 'EXPTIME': 30.0 } })
+
+		start = time.time()
+		metadataWriter.writeJSONFile(folder + "/imageMetadata.js", "Benchmark", records)
+		times['metadata']+= time.time() - start
+		os.remove(folder + "/" + filename)
+
+	total = sum(times.values())
+	result = {
+		'type': fixtureType,
+		'size': size,
+		'format': fileFormat,
+		'frames': frames,
+		'megapixels': pixels / 1e6,
+		'megabytes': bytes / 1e6,
+		'stages': dict([ (s, times[s] / frames) for s in stages ]),
+		'framesPerSecond': frames / total,
+		'megapixelsPerSecond': pixels / 1e6 / total,
+		'loadMegapixelsPerSecond': pixels / 1e6 / times['load'],
+		'loadMegabytesPerSecond': bytes / 1e6 / times['load'],
+		'reducedMegapixelsPerSecond': pixels / 1e6 / times['reduced'],
+		'peakRSS': peakRSS()
+	}
+	return result
+
+def printResults(results, previous=None):
+	""" Prints a table of the time per frame of each stage. If a previous set of results is given, the ratio of the new to the old time is shown for each stage. """
+	previousResults = {}
+	if previous is not None:
+		for r in previous['fixtures']: previousResults[(r['type'], r['size'], r.get('format', 'fits'))] = r
+	print "%-20s"%"fixture" + "".join([ "%10s"%s for s in stages ]) + "%10s %10s %10s"%("frames/s", "MPix/s", "RSS (MB)")
+	for r in results:
+		line = "%-20s"%("%s %d %s"%(r['type'], r['size'], r['format']))
+		line+= "".join([ "%10.4f"%r['stages'][s] for s in stages ])
+		line+= "%10.2f %10.2f %10.1f"%(r['framesPerSecond'], r['megapixelsPerSecond'], r['peakRSS'])
+		print line
+		old = previousResults.get((r['type'], r['size'], r['format']))
+		if old is None: continue
+		line = "%-20s"%"  new/old"
+		for s in stages:
+			if old['stages'].get(s): line+= "%9.2fx"%(r['stages'][s] / old['stages'][s])
+			else: line+= "%10s"%"-"
+		line+= "%9.2fx %9.2fx %9.2fx"%(r['framesPerSecond'] / old['framesPerSecond'], r['megapixelsPerSecond'] / old['megapixelsPerSecond'], r['peakRSS'] / old['peakRSS'])
+		print line
+
+def printThroughput(results):
+	""" Prints how fast each file format is loaded, totalled over the fixtures: for a full render and for a run that only makes previews. Megabytes are of the file on disk. """
+	print "%-8s %14s %14s %18s"%("format", "load MB/s", "load MPix/s", "preview MPix/s")
+	for fileFormat in sorted(set([ r['format'] for r in results ])):
+		formatResults = [ r for r in results if r['format'] == fileFormat ]
+		loadTime = sum([ r['stages']['load'] * r['frames'] for r in formatResults ])
+		reducedTime = sum([ r['stages']['reduced'] * r['frames'] for r in formatResults ])
+		megabytes = sum([ r['megabytes'] for r in formatResults ])
+		megapixels = sum([ r['megapixels'] for r in formatResults ])
+		print "%-8s %14.1f %14.1f %18.1f"%(fileFormat, megabytes / loadTime, megapixels / loadTime, megapixels / reducedTime)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Times each stage of the fitsBrowser image pipeline on synthetic FITS files.')
+	parser.add_argument('--types', type=str, nargs='+', default=['single', 'mef', 'wfc'], help='Kinds of synthetic file to test: single, mef (multi-extension) and wfc (4-CCD mosaic). Default: all of them')
+	parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 2048], help='Image sizes in pixels. Single images are size x size, extensions and CCDs are size x size/2. Default: 1024 2048')
+	parser.add_argument('--formats', type=str, nargs='+', default=['fits', 'gz', 'fz'], choices=sorted(formats.keys()), help='File formats to test: fits (uncompressed), gz (gzipped) and fz (Rice tile-compressed). Default: all of them')
+	parser.add_argument('--extensions', type=int, default=2, help='Number of image extensions in the mef files. Default: 2')
+	parser.add_argument('-n', '--frames', type=int, default=3, help='Number of frames to process for each type and size. Default: 3')
+	parser.add_argument('-o', '--output', type=str, help='Save the results to this JSON file.')
+	parser.add_argument('--compare', type=str, help='A JSON file saved by an earlier run to compare these results against.')
+	parser.add_argument('--render', action="store_true", help='Compare the old and new render paths instead.')
+	parser.add_argument('--encoders', action="store_true", help='Compare the time and file size of writing the images in each output format (png at several compression levels, webp and jpeg) instead.')
+	parser.add_argument('--metadata', type=int, metavar='RECORDS', help='Compare the size and the write and read times of the json and compact forms of imageMetadata.js, for this many synthetic records, instead.')
+	parser.add_argument('--startup', action="store_true", help='Only time how long fitsBrowser.py takes to start up and to finish a run with nothing to do. (This is also measured after the fixtures.)')
+	parser.add_argument('-r', '--repeats', type=int, default=3, help='Number of times to repeat each measurement of the render paths and image writers. Default: 3')
+	args = parser.parse_args()
+
+	if args.render:
+		benchmarkRender(args.sizes, args.repeats)
+		sys.exit()
+	if args.encoders:
+		benchmarkEncoders(args.sizes, args.repeats)
+		sys.exit()
+	if args.metadata is not None:
+		benchmarkMetadata(args.metadata, args.repeats)
+		sys.exit()
+
+	previous = None
+	if args.compare is not None:
+		previous = json.load(open(args.compare, 'rt'))
+	if args.startup:
+		printStartup(benchmarkStartup(args.repeats), previous.get('startup') if previous is not None else None)
+		sys.exit()
+
+	folder = tempfile.mkdtemp(prefix="fitsBrowserBenchmark")
+	results = []
+	try:
+		for fileFormat in args.formats:
+			for fixtureType in args.types:
+				for size in args.sizes:
+					sys.stdout.write("\rBenchmarking %s %d %s...     "%(fixtureType, size, fileFormat))
+					sys.stdout.flush()
+					# A fresh process for each fixture, so that the peak memory is measured separately for each one
+					pool = multiprocessing.Pool(processes=1)
+					results.append(pool.apply(benchmarkFixture, (fixtureType, size, args.frames, args.extensions, folder, fileFormat)))
+					pool.close()
+					pool.join()
+	finally:
+		shutil.rmtree(folder)
+	sys.stdout.write("\n")
+	print "Seconds per frame for each stage:"
+
+	printResults(results, previous)
+	print
+	print "Throughput by file format:"
+	printThroughput(results)
+	print
+	startup = benchmarkStartup(args.repeats)
+	printStartup(startup, previous.get('startup') if previous is not None else None)
+
+	if args.output is not None:
+		output = {
+			'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+			'host': platform.node(),
+			'python': platform.python_version(),
+			'numpy': numpy.__version__,
+			'astropy': astropy.__version__,
+			'fixtures': results,
+			'startup': startup
+		}
+		outputFile = open(args.output, 'wt')
+		json.dump(output, outputFile, indent = 4)
+		outputFile.close()
+		print "Results written to %s"%args.output
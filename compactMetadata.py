@@ -0,0 +1,131 @@
+""" A compact, column-oriented form of a list of image records, which imageMetadata.js can hold instead of the records themselves. Each field of the records, and each FITS header, is stored once as a column, so the keyword names are not repeated for every image. The schema gives the type of each column: numbers are stored as plain numbers, strings that repeat (FILTER, OBJECT...) as indices into a list of their values, and image filenames that follow the usual pattern are worked out from the source filename instead of being stored. decode() gives back exactly the records that were encoded (with absent fields kept apart from null ones); index.html has the same decoder in JavaScript. """
+
+import os, collections
+import imageFormats
+
+formatName = "columns"
+formatVersion = 1
+imageFolder = "images"
+
+def columnType(values):
+	""" The type of a column from the values in it: 'bool', 'int', 'float', 'string', or 'any' for a mixture. Nulls are allowed in any type. """
+	types = set([ type(v) for v in values if v is not None ])
+	if len(types) == 0: return 'any'
+	if types <= set([bool]): return 'bool'
+	if types <= set([int, long]): return 'int'
+	if types <= set([int, long, float]): return 'float'
+	if types <= set([str, unicode]): return 'string'
+	return 'any'
+
+def splitFilename(sourceFilename):
+	""" (folder, stem) of a source file, as fitsBrowser.imageFilename uses them """
+	folder, name = os.path.split(sourceFilename)
+	return folder, imageFormats.imageStem(name)
+
+def derivedFilename(parts, prefix, extension):
+	""" The image filename made from the (folder, stem) of a source file """
+	return os.path.join(imageFolder, parts[0], prefix + parts[1] + "." + extension)
+
+def filenamePattern(values, sourceParts):
+	""" The (prefix, extension) that makes 'values' from the source filenames, judged from the first of them, or None if they don't look like image filenames """
+	for value, parts in zip(values, sourceParts):
+		if value is None or parts is None: continue
+		stem, extension = os.path.splitext(os.path.basename(value))
+		sourceStem = parts[1]
+		if not stem.endswith(sourceStem): return None
+		return stem[:len(stem) - len(sourceStem)], extension[1:]
+	return None
+
+def encodeColumn(values, absent, sourceParts=None):
+	""" Encodes one column. 'absent' lists the rows that don't have the field at all, which is kept apart from a field whose value is null. 'sourceParts' are the (folder, stem) of the source filenames, if the column might hold image filenames. """
+	column = collections.OrderedDict([ ('type', columnType(values)) ])
+	if len(absent) > 0: column['absent'] = absent
+	if column['type'] == 'bool':
+		column['data'] = [ None if v is None else int(v) for v in values ]
+		return column
+	if column['type'] != 'string':
+		column['data'] = values
+		return column
+	if sourceParts is not None:
+		pattern = filenamePattern(values, sourceParts)
+		if pattern is not None:
+			absentRows = set(absent)
+			exceptions = dict([ (str(row), v) for row, (v, parts) in enumerate(zip(values, sourceParts)) if row not in absentRows and (parts is None or v != derivedFilename(parts, pattern[0], pattern[1])) ])
+			if len(exceptions) < len(values) // 2:
+				column.update({ 'encoding': 'filename', 'prefix': pattern[0], 'extension': pattern[1], 'exceptions': exceptions })
+				return column
+	distinct = {}
+	for v in values: distinct.setdefault(v, len(distinct))
+	if len(distinct) <= len(values) // 2:
+		column['encoding'] = 'dictionary'
+		column['values'] = sorted(distinct.keys(), key=lambda v: distinct[v])
+		column['data'] = [ distinct[v] for v in values ]
+		return column
+	column['data'] = values
+	return column
+
+def encode(records):
+	""" The compact form of a list of records """
+	fields = []
+	headers = []
+	for record in records:
+		for field in record:
+			if field != 'headers' and field not in fields: fields.append(field)
+		for keyword in record.get('headers', {}):
+			if keyword not in headers: headers.append(keyword)
+	sourceParts = [ None if r.get('sourceFilename') is None else splitFilename(r['sourceFilename']) for r in records ]
+	compact = collections.OrderedDict([ ('format', formatName), ('version', formatVersion), ('count', len(records)), ('fields', fields), ('headers', headers) ])
+	compact['noHeaders'] = [ row for row, r in enumerate(records) if 'headers' not in r ]
+	compact['columns'] = collections.OrderedDict()
+	for field in fields:
+		values = [ r.get(field) for r in records ]
+		absent = [ row for row, r in enumerate(records) if field not in r ]
+		compact['columns'][field] = encodeColumn(values, absent, sourceParts if field != 'sourceFilename' else None)
+	compact['headerColumns'] = collections.OrderedDict()
+	for keyword in headers:
+		values = [ r.get('headers', {}).get(keyword) for r in records ]
+		absent = [ row for row, r in enumerate(records) if keyword not in r.get('headers', {}) ]
+		compact['headerColumns'][keyword] = encodeColumn(values, absent)
+	return compact
+
+def decodeColumn(column, count, sourceParts=None):
+	""" The values of an encoded column, one for each row. 'sourceParts' are the (folder, stem) of each source filename, for filename columns. """
+	encoding = column.get('encoding')
+	if encoding == 'filename':
+		exceptions = column['exceptions']
+		prefix, extension = column['prefix'], column['extension']
+		values = [ None if parts is None else derivedFilename(parts, prefix, extension) for parts in sourceParts ]
+		for row, value in exceptions.items(): values[int(row)] = value
+		return values
+	data = column['data']
+	if encoding == 'dictionary':
+		dictionary = column['values']
+		return [ dictionary[v] for v in data ]
+	if column['type'] == 'bool': return [ None if v is None else bool(v) for v in data ]
+	return data
+
+def decodeTable(names, columns, count, sourceParts=None):
+	""" One dict for each row, holding the columns in 'names' """
+	if len(names) == 0: return [ {} for row in range(count) ]
+	values = [ decodeColumn(columns[name], count, sourceParts) for name in names ]
+	rows = [ dict(zip(names, row)) for row in zip(*values) ]
+	for name in names:
+		for row in columns[name].get('absent', []): del rows[row][name]
+	return rows
+
+def isCompact(data):
+	return isinstance(data, dict) and data.get('format') == formatName
+
+def decode(compact):
+	""" The list of records held in a compact form. The headers of each record are a plain dict, as json.loads gives for the json form. """
+	if compact['version'] > formatVersion: raise ValueError("Compact metadata version %d is newer than this fitsBrowser can read"%compact['version'])
+	count = compact['count']
+	sourceParts = None
+	if 'sourceFilename' in compact['columns']:
+		sourceParts = [ None if s is None else splitFilename(s) for s in decodeColumn(compact['columns']['sourceFilename'], count) ]
+	records = decodeTable(compact['fields'], compact['columns'], count, sourceParts)
+	headers = decodeTable(compact['headers'], compact['headerColumns'], count)
+	noHeaders = set(compact['noHeaders'])
+	for row, record in enumerate(records):
+		if row not in noHeaders: record['headers'] = headers[row]
+	return records
@@ -0,0 +1,164 @@
+""" Reads the pixels of compressed FITS files without holding more of them in memory than is needed.
+
+Gzipped files (.fits.gz) can only be read forwards, so astropy decompresses a whole HDU into memory before it converts it. Here the data is streamed through a fixed-size buffer a band of rows at a time, each band going straight into a float32 array, which is already shrunk if that is all the images need.
+
+Tile-compressed images (.fits.fz) are stored as a table with one compressed tile per row. When the images being made only need every n-th row and column (e.g. just a preview and thumbnail), only the tiles holding those rows are decompressed. """
+
+import numpy
+import headerScan, mosaic
+
+bufferSize = 4 << 20
+pixelTypes = { 8: '>u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8' }
+heapTypes = { 'B': 1, 'I': 2, 'J': 4, 'K': 8, 'E': 4, 'D': 8 }
+
+def decimate(imageData, step):
+	""" Every 'step'-th row and column, trimmed to the same shape as mosaic.reducedShape """
+	if step == 1: return imageData
+	height, width = numpy.shape(imageData)[0] // step, numpy.shape(imageData)[1] // step
+	return imageData[:height * step:step, :width * step:step]
+
+def chooseStep(shape, outputSize, factor=4):
+	""" The largest divisor of 'factor' that leaves the image at least 'outputSize' pixels across. 'outputSize' of None means the full-size image is needed. Only divisors of the mosaic factor are used, so that an extension read at this step can still be placed in a mosaic. """
+	if outputSize is None: return 1
+	for step in range(factor, 1, -1):
+		if factor % step == 0 and max(shape) // step >= outputSize: return step
+	return 1
+
+def readFully(inputFile, size):
+	""" Reads exactly 'size' bytes, or raises IOError if the file ends first """
+	pieces = []
+	remaining = size
+	while remaining > 0:
+		piece = inputFile.read(remaining)
+		if len(piece) == 0: raise IOError("The file ends in the middle of the data")
+		pieces.append(piece)
+		remaining-= len(piece)
+	return b''.join(pieces)
+
+def skipForward(inputFile, size):
+	""" Reads past 'size' bytes a buffer at a time """
+	while size > 0:
+		skipped = len(inputFile.read(min(size, bufferSize)))
+		if skipped == 0: break
+		size-= skipped
+
+class imageStream:
+	""" The data of one image HDU in a gzipped file, read a band of rows at a time """
+	def __init__(self, inputFile, header, shape):
+		self.inputFile = inputFile
+		self.header = header
+		self.shape = shape
+		self.remaining = headerScan.dataSize(header)
+
+	def read(self, step=1, average=False):
+		""" Returns the first plane of the image as float32, keeping every 'step'-th row and column, or with average=True the mean of each step x step block (as mosaic.blockReduce). Scaled integer data is converted with BSCALE and BZERO, and BLANK pixels become NaN. """
+		height, width = self.shape[-2], self.shape[-1]
+		pixelType = numpy.dtype(pixelTypes[self.header['BITPIX']])
+		rowBytes = width * pixelType.itemsize
+		bscale = self.header.get('BSCALE', 1.)
+		bzero = self.header.get('BZERO', 0.)
+		blank = self.header.get('BLANK') if pixelType.kind in 'iu' else None
+		outputHeight, outputWidth = height // step, width // step
+		output = numpy.empty((outputHeight, outputWidth), dtype=numpy.float32)
+		# Each band is a whole number of steps, so the rows kept are the same whatever the buffer size
+		bandRows = max(step, (bufferSize // rowBytes) // step * step)
+		row = 0
+		while row < outputHeight * step:
+			rows = min(bandRows, outputHeight * step - row)
+			band = numpy.frombuffer(readFully(self.inputFile, rows * rowBytes), dtype=pixelType).reshape(rows, width)
+			self.remaining-= rows * rowBytes
+			target = output[row // step:(row + rows) // step]
+			if average:
+				# The mask below is made from the same columns as the values
+				band = band[:, :outputWidth * step]
+				values = numpy.array(band, dtype=numpy.float32)
+			else:
+				band = band[::step, :outputWidth * step:step]
+				values = target
+				values[:] = band
+			if bscale != 1: values*= bscale
+			if bzero != 0: values+= bzero
+			if blank is not None: values[band == blank] = numpy.nan
+			if average: mosaic.blockReduce(values, step, out=target)
+			row+= rows
+		return output
+
+	def skip(self):
+		skipForward(self.inputFile, self.remaining)
+		self.remaining = 0
+
+def gzipImages(filename, keywords=None):
+	""" Goes through the HDUs of a gzipped FITS file in order, yielding the headers of each one (limited to 'keywords' if given), the shape of its image (None if it has none) and an imageStream for its data. Any data that isn't read before the next HDU is asked for is skipped. """
+	wanted = None
+	if keywords is not None: wanted = set(keywords)
+	inputFile = headerScan.openFITSFile(filename)
+	try:
+		first = True
+		while True:
+			cards = headerScan.readHeader(inputFile, first)
+			first = False
+			if cards is None: break
+			header = dict(cards)
+			headers = dict([ (k, v) for k, v in cards if wanted is None or k in wanted ])
+			shape = headerScan.imageShape(header)
+			stream = imageStream(inputFile, header, shape)
+			yield headers, shape, stream
+			stream.skip()
+	finally:
+		inputFile.close()
+
+def readTileRows(hdu, step):
+	""" Decompresses every 'step'-th row of a tile-compressed image HDU, keeping every 'step'-th column, and returns it as float32. Only works where each tile is one row and the decompressed values don't depend on the position of the tile (no subtractive dithering). Returns None if the HDU can't be read like this, in which case the whole image has to be decompressed. This uses astropy's private decompressor and table internals, which change between releases, so None is also returned if they are not as expected, and fitsClasses.readHDUData falls back to reading hdu.data. """
+	try:
+		return readSelectedTiles(hdu, step)
+	except Exception:
+		return None
+
+def readSelectedTiles(hdu, step):
+	from astropy.io.fits import compression
+	header = hdu._header
+	if header.get('ZNAXIS', 0) != 2 or header.get('ZTILE2', 1) != 1 or header.get('ZTILE1', header['ZNAXIS1']) != header['ZNAXIS1']: return None
+	if header.get('ZQUANTIZ', 'NO_DITHER').strip() != 'NO_DITHER': return None
+	table = hdu.compressed_data
+	if 'ZBLANK' in table.columns.names: return None
+	height = header['ZNAXIS2'] // step
+	rowBytes = header['NAXIS1']
+	raw = table._get_raw_data().view(numpy.uint8)
+	heapStart = header.get('THEAP', rowBytes * header['NAXIS2'])
+	rows = numpy.array(raw[:rowBytes * header['NAXIS2']].reshape(header['NAXIS2'], rowBytes)[:height * step:step])
+	# Copy just the compressed bytes of the chosen tiles into a new heap, and point the tiles' descriptors at their new places
+	records = rows.view(table.dtype).reshape(height)
+	heap = []
+	heapSize = 0
+	for column in table.columns:
+		format = column.format.strip().lstrip('0123456789')
+		if format[0] not in 'PQ': continue
+		descriptors = records[column.name]
+		elementSize = heapTypes[format[1]]
+		for tile in range(height):
+			count, offset = descriptors[tile]
+			size = count * elementSize
+			heap.append(raw[heapStart + offset:heapStart + offset + size])
+			descriptors[tile] = (count, heapSize)
+			heapSize+= size
+	# The decompressor reads whole FITS blocks, so the table is padded out to the end of one
+	padding = -(rows.size + heapSize) % headerScan.blockSize
+	subset = tileSubset(header.copy(), numpy.concatenate([ rows.ravel() ] + heap + [ numpy.zeros(padding, dtype=numpy.uint8) ]))
+	for keyword in ['NAXIS2', 'ZNAXIS2']: subset._header[keyword] = height
+	subset._header['THEAP'] = height * rowBytes
+	subset._header['PCOUNT'] = heapSize
+	imageData = compression.decompress_hdu(subset)
+	output = numpy.array(imageData[:, :(header['ZNAXIS1'] // step) * step:step], dtype=numpy.float32)
+	bscale = hdu.header.get('BSCALE', 1.)
+	bzero = hdu.header.get('BZERO', 0.)
+	blank = hdu.header.get('BLANK', header.get('ZBLANK'))
+	if blank is not None and imageData.dtype.kind in 'iu': output[imageData[:, :(header['ZNAXIS1'] // step) * step:step] == blank] = numpy.nan
+	if bscale != 1: output*= bscale
+	if bzero != 0: output+= bzero
+	return output
+
+class tileSubset:
+	""" Stands in for a CompImageHDU when handing a table of selected tiles to astropy's decompressor, which only looks at these two attributes """
+	def __init__(self, header, compressedData):
+		self._header = header
+		self.compressed_data = compressedData
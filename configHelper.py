@@ -1,6 +1,6 @@
 """ Some functions to aid the setting and retrieving of config files saved in the user's home directory """
 
-import os, json, numpy
+import os, json
 
 class configClass:
 	def __init__(self, name="unknownapp", debug=False):
@@ -61,6 +61,7 @@ class configClass:
 			# if type(value) is unicode: 
 			#  	value = str(value)
 			if type(value) is list:
+				import numpy
 				value = numpy.array(value)
 			if self._debug: print("Loading", key, value)
 			setattr(self, key, value)
@@ -68,6 +69,7 @@ class configClass:
 		return True
 		
 	def save(self):
+		import numpy
 		filename = self._filename
 		object = {}
 		for key in self.__dict__.keys():
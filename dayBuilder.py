@@ -1,36 +1,85 @@
 #!/usr/bin/env python
 
-import argparse, sys, os, re, json, shutil, datetime, subprocess, fcntl
-import configHelper, numpy
+import argparse, sys, os, re, shutil, datetime, time, threading, multiprocessing
+import archiveCatalogue, fitsBrowser
 
 def debug(output):
 	global debugLevel
 	if not debugLevel: return
 	print(str(output))
 
-fh=0
-
-def  run_once():
-     global  fh
-     lockFilename = "/tmp/dayBuilder.lock"
-     # first create a lock file if it doesn't already exist
-     if not os.path.exists(lockFilename):
-		 lockFile = open(lockFilename, 'wt')
-		 lockFile.write("Lock file for dayBuilder.py\n")
-		 lockFile.close()
-
-     fh = open(lockFilename, 'r')
-     try:
-         fcntl.flock(fh,fcntl.LOCK_EX|fcntl.LOCK_NB)
-         # fcntl.flock(fh,fcntl.LOCK_EX)
-     except IOError as e:
-		 print "Sorry. I think I might already be running, so I am going to exit. Please look for stray processes."
-		 print e
-		 os._exit(0)
-
+def getDateFolder(date, rolloverHour=0):
+	""" Returns the name of the sub-folder for 'date'. {today} and {yesterday} are worked out from the current time, with the new day starting at rolloverHour o'clock. """
+	today = (datetime.datetime.now() - datetime.timedelta(hours=rolloverHour)).date()
+	if date == "{today}":
+		return str(today).replace('-','')
+	elif date == "{yesterday}":
+		return str(today - datetime.timedelta(days=1)).replace('-', '')
+	return date
+
+def nextRollover(rolloverHour=0):
+	""" Returns the time (in seconds since the epoch) when {today} next changes to a new folder """
+	now = datetime.datetime.now()
+	rollover = now.replace(hour=rolloverHour, minute=0, second=0, microsecond=0)
+	if rollover <= now: rollover+= datetime.timedelta(days=1)
+	return time.mktime(rollover.timetuple())
+
+def nightOptions(config, dataPath, webPath, dateFolder, debug=False):
+	""" The fitsBrowser options for one night's folder """
+	return fitsBrowser.folderOptions(config, dataPath=dataPath + "/" + dateFolder, webPath=webPath + "/" + dateFolder, title='INT images for ' + dateFolder, debug=debug)
+
+def reportNight(night, result):
+	if result['locked']:
+		print "Another fitsBrowser is writing to %s. Helped it with %d files for %s."%(result['webPath'], result['processed'], night)
+		return
+	print "Finished %s: %d images (%d new, %d modified, %d deleted) in %.1f seconds."%(night, result['images'], result['new'], result['modified'], result['deleted'], result['wallTime'])
+	for path, error in result['errors']: print "  Failed to render %s: %s"%(path, error)
+
+def nightComplete(result):
+	""" True if every file of the night was rendered and the night was written by this process, rather than left to another one holding its lock """
+	return not result['locked'] and len(result['errors']) == 0
+
+def archiveNights(dataPath, first, last):
+	""" Returns the date sub-folders (YYYYMMDD) of dataPath from 'first' to 'last' inclusive """
+	nights = []
+	for folder in sorted(os.listdir(dataPath)):
+		if not re.match(r"^\d{8}$", folder): continue
+		if folder < first or folder > last: continue
+		if os.path.isdir(dataPath + "/" + folder): nights.append(folder)
+	return nights
+
+def buildArchive(nights, config, dataPath, webPath, catalogue, jobs=2, pool=None, debug=False):
+	""" Runs fitsBrowser on each of the nights, with up to 'jobs' of them at a time sharing the worker pool. Each night is added to the catalogue as soon as it is done. A night that another process is already writing is helped with instead, and left to that process to add to the catalogue. Returns the nights that failed: those where fitsBrowser raised, a file could not be rendered or another process held the lock. """
+	pending = list(nights)
+	failed = []
+	lock = threading.Lock()
+	def worker():
+		while True:
+			with lock:
+				if len(pending) == 0: return
+				night = pending.pop(0)
+				print "Starting %s (%d still to start)"%(night, len(pending))
+			try:
+				builder = fitsBrowser.folderBuilder(nightOptions(config, dataPath, webPath, night, debug), pool=pool)
+				result = builder.run()
+				builder.unlock()
+				if result['locked']: result = builder.assist()
+			except Exception as e:
+				print "fitsBrowser failed for %s: %s"%(night, e)
+				with lock: failed.append(night)
+				continue
+			with lock:
+				reportNight(night, result)
+				if not nightComplete(result): failed.append(night)
+				if result['locked']: continue
+				catalogue.commitNight(night, webPath + "/" + night)
+				print "The catalogue now has %d images."%len(catalogue)
+	threads = [ threading.Thread(target=worker) for j in range(min(jobs, len(nights))) ]
+	for t in threads: t.start()
+	for t in threads: t.join()
+	return sorted(failed)
 
 if __name__ == "__main__":
-	run_once()
 	debugLevel = 0
 	parser = argparse.ArgumentParser(description='Builds or updates a root web folder containing fitsBrowser sub-folders for each day..')
 	parser.add_argument('--datapath', type=str, help='Path where the FITS files are. Default: current directory')
@@ -38,34 +87,35 @@ if __name__ == "__main__":
 	parser.add_argument('--installpath', type=str, help='Path of where this application has been installed. This is so that it can find the HTML files to copy to the web folder. ')
 	parser.add_argument('--debug', action='store_true', help='Debug')
 	parser.add_argument('--copyonly', action='store_true', help='Only copy the html files and then exit.')
+	parser.add_argument('--watch', action='store_true', help='Keep running, processing new images in {today}\'s folder as they arrive and moving on to the next folder when the date changes.')
 	parser.add_argument('--date', default='{today}', help='Date to process for the sub-folder. Default is {today}. Can also use {yesterday}.')
+	parser.add_argument('--archive', type=str, nargs=2, metavar=('FIRST', 'LAST'), help='Process all of the date sub-folders from FIRST to LAST (YYYYMMDD, {today} or {yesterday}) and add them to the catalogue.')
+	parser.add_argument('-j', '--jobs', type=int, help='Number of nights to process at the same time in --archive mode. Default: 2')
+	parser.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes to render the images with, shared by all of the nights. Default is 1 (no parallel processing).')
 	args = parser.parse_args()
 	if args.debug: debugLevel = 1
 	debug(args)
 
-	config = configHelper.configClass("fitsBrowser")
+	config = fitsBrowser.loadConfig()
+	config.setDefaults({ "ArchiveJobs": 2 })
 	webPath = config.assertProperty("WebPath", args.webpath)
 	installPath = config.assertProperty("InstallPath", args.installpath)
 	dataPath = config.assertProperty("DataPath", args.datapath)
 
 	debug(config)
 
-	# Now run 'fitBrowser'
-	if args.date == "{today}":
-		dateFolder = str(datetime.date.today()).replace('-','')
-	elif args.date == "{yesterday}":
-		dateFolder = str(datetime.date.today() - datetime.timedelta(days=1)).replace('-', '')
-	else:
-		dateFolder = args.date
-	dataFolder = dataPath + "/" + dateFolder
+	rolloverHour = int(config.assertProperty("RolloverHour", None) or 0)
 
 	# First, check if the source data is there
 	if not os.path.exists(dataPath):
 		print "The folder for the source data %s could not be found. Exiting."%dataPath
 		sys.exit()
-	if not os.path.exists(dataFolder):
-		print "The folder for the source data %s could not be found. Exiting."%dataFolder
-		sys.exit()
+	if not args.watch and args.archive is None:
+		dateFolder = getDateFolder(args.date, rolloverHour)
+		dataFolder = dataPath + "/" + dateFolder
+		if not os.path.exists(dataFolder):
+			print "The folder for the source data %s could not be found. Exiting."%dataFolder
+			sys.exit()
 
 	# Second, check to see if the webpath already exists
 	if not os.path.exists(webPath):
@@ -80,16 +130,52 @@ if __name__ == "__main__":
 	# Exit now if '--copyonly is specified
 	if args.copyonly: sys.exit()
 
+	catalogue = archiveCatalogue.archiveCatalogue(webPath + "/archiveCatalogue.js", debug=args.debug)
+	# fitsBrowser runs in this process. The worker pool is made once and kept for all of the nights.
+	pool = None
+	if args.workers > 1: pool = multiprocessing.Pool(processes=args.workers, maxtasksperchild=50)
+
+	if args.archive is not None:
+		first, last = [ getDateFolder(d, rolloverHour) for d in args.archive ]
+		nights = archiveNights(dataPath, first, last)
+		jobs = config.assertProperty("ArchiveJobs", args.jobs)
+		print "Processing %d nights from %s to %s, %d at a time."%(len(nights), first, last, jobs)
+		failed = buildArchive(nights, config, dataPath, webPath, catalogue, jobs, pool, args.debug)
+		if len(failed) > 0:
+			print "%d nights failed or were left to another process: %s"%(len(failed), " ".join(failed))
+			sys.exit(1)
+		sys.exit()
 
-	outputFolder = webPath + "/" + dateFolder
-	debug("Looking for FITS files in folder: %s"%dataFolder)
-	
-	fitsBrowserCommand = [installPath + "/fitsBrowser.py"]
-	fitsBrowserCommand.append('-f')
-	fitsBrowserCommand.append(dataFolder)
-	fitsBrowserCommand.append('--webpath')
-	fitsBrowserCommand.append(outputFolder)
-	fitsBrowserCommand.append('--title')
-	fitsBrowserCommand.append('INT images for ' + dateFolder)
+	if not args.watch:
+		debug("Looking for FITS files in folder: %s"%dataFolder)
+		builder = fitsBrowser.folderBuilder(nightOptions(config, dataPath, webPath, dateFolder, args.debug), pool=pool)
+		result = builder.run()
+		if result['locked']: result = builder.assist()
+		reportNight(dateFolder, result)
+		if not result['locked']: catalogue.commitNight(dateFolder, webPath + "/" + dateFolder)
+		if not nightComplete(result): sys.exit(1)
+		sys.exit()
 
-	subprocess.call(fitsBrowserCommand)
+	# In watch mode, keep fitsBrowser watching tonight's folder and move on to the next folder when the date changes
+	try:
+		while True:
+			dateFolder = getDateFolder('{today}', rolloverHour)
+			dataFolder = dataPath + "/" + dateFolder
+			rollover = nextRollover(rolloverHour)
+			if not os.path.exists(dataFolder):
+				debug("Waiting for the folder %s to appear."%dataFolder)
+				time.sleep(max(1, min(60, rollover - time.time())))
+				continue
+			print "Watching %s until %s"%(dataFolder, time.ctime(rollover))
+			builder = fitsBrowser.folderBuilder(nightOptions(config, dataPath, webPath, dateFolder, args.debug), pool=pool)
+			result = builder.run()
+			reportNight(dateFolder, result)
+			if result['locked']:
+				time.sleep(max(1, min(60, rollover - time.time())))
+				continue
+			interrupted = not builder.watch(rollover)
+			builder.unlock()
+			catalogue.commitNight(dateFolder, webPath + "/" + dateFolder)
+			if interrupted: break
+	except KeyboardInterrupt:
+		print "Stopped watching."
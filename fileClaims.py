@@ -0,0 +1,126 @@
+""" Lease files that let several fitsBrowser processes, on one machine or on several machines sharing the web folder, split the rendering of a folder between them without making any image twice.
+
+Before a process renders a FITS file it claims it by creating a small file in the web folder's .claims folder, which fails if the file is already there. When the file is done the claim is renamed to a marker that stays until the end of the run. A claim that is older than the lease is assumed to belong to a process that has died, and can be taken over. Only the process holding the lock on the web folder writes the metadata. Any others are helpers, which leave the record of each file they render in a result file for it to pick up. """
+
+import os, json, time, socket, hashlib, errno, collections
+
+class fileClaims:
+	def __init__(self, folder, lease=300., debug=False):
+		""" 'folder' holds the claim and result files. 'lease' is how long, in seconds, a claim lasts. """
+		self.folder = folder
+		self.lease = lease
+		self.debug = debug
+		self.owner = "%s:%d"%(socket.gethostname(), os.getpid())
+		self.held = set()
+		self.finished = set()
+
+	def filename(self, path, extension):
+		return os.path.join(self.folder, hashlib.md5(path.encode('utf-8')).hexdigest() + extension)
+
+	def expired(self, filename):
+		try:
+			return time.time() - os.path.getmtime(filename) > self.lease
+		except OSError:
+			return True
+
+	def claim(self, path):
+		""" Tries to claim a source file. Returns True if this process now holds the claim, or False if another process does. If two processes take over an expired claim at the same moment both may render the file, but neither skips it. """
+		if not os.path.isdir(self.folder):
+			try:
+				os.makedirs(self.folder)
+			except OSError:
+				if not os.path.isdir(self.folder): raise
+		claimFilename = self.filename(path, ".claim")
+		for attempt in range(2):
+			try:
+				claimFile = os.open(claimFilename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+			except OSError as e:
+				if e.errno != errno.EEXIST: raise
+				if attempt > 0 or not self.expired(claimFilename): return False
+				if self.debug: print("Taking over the expired claim on %s"%path)
+				try:
+					os.remove(claimFilename)
+				except OSError:
+					pass
+				continue
+			os.write(claimFile, json.dumps({ 'path': path, 'owner': self.owner, 'time': time.time() }).encode('utf-8'))
+			os.close(claimFile)
+			self.held.add(path)
+			return True
+		return False
+
+	def release(self, path):
+		""" Gives up a claim that this process holds, without finishing the file """
+		if path not in self.held: return
+		self.held.discard(path)
+		try:
+			os.remove(self.filename(path, ".claim"))
+		except OSError:
+			pass
+
+	def done(self, path):
+		""" Marks a file as finished for the rest of this run, so that helpers whose view of the index is older don't render it again. The claim, if this process holds it, becomes the marker. """
+		doneFilename = self.filename(path, ".done")
+		if path in self.held:
+			self.held.discard(path)
+			try:
+				os.rename(self.filename(path, ".claim"), doneFilename)
+			except OSError:
+				pass
+		else:
+			open(doneFilename, 'w').close()
+		self.finished.add(path)
+
+	def releaseAll(self):
+		""" Removes this process's claims and finished markers, at the end of a run """
+		for path in list(self.held): self.release(path)
+		for path in self.finished:
+			try:
+				os.remove(self.filename(path, ".done"))
+			except OSError:
+				pass
+		self.finished = set()
+
+	def removeStaleResults(self):
+		""" Deletes result files that have not been picked up within the lease, e.g. from a helper that carried on after the run it was helping had finished """
+		if not os.path.isdir(self.folder): return
+		for name in os.listdir(self.folder):
+			if not name.endswith((".result", ".tmp")): continue
+			filename = os.path.join(self.folder, name)
+			if self.expired(filename):
+				try:
+					os.remove(filename)
+				except OSError:
+					pass
+
+	def putResult(self, path, result):
+		""" Leaves the result of rendering a file for the process that writes the metadata, and releases the claim on it. The result file is complete before the claim goes. """
+		resultFilename = self.filename(path, ".result")
+		tempFilename = resultFilename + ".tmp"
+		resultFile = open(tempFilename, 'wt')
+		json.dump(result, resultFile)
+		resultFile.close()
+		os.rename(tempFilename, resultFilename)
+		self.release(path)
+
+	def takeResult(self, path):
+		""" Returns and deletes the result a helper left for a file, or None if there isn't one """
+		resultFilename = self.filename(path, ".result")
+		if not os.path.exists(resultFilename): return None
+		try:
+			resultFile = open(resultFilename, 'rt')
+			result = json.load(resultFile, object_pairs_hook=collections.OrderedDict)
+			resultFile.close()
+		except (IOError, ValueError) as e:
+			print("WARNING: Could not read the result file %s (%s)"%(resultFilename, e))
+			result = None
+		try:
+			os.remove(resultFilename)
+		except OSError:
+			pass
+		if result is not None and result.get('path') != path: return None
+		return result
+
+	def isFinished(self, path):
+		""" True if a helper has left a result for the file, or another process has finished it during its run """
+		return os.path.exists(self.filename(path, ".result")) or os.path.exists(self.filename(path, ".done"))
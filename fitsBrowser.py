@@ -1,33 +1,11 @@
 #!/usr/bin/env python
 
 import datetime, collections
-import argparse, sys, os, re, json, shutil, fcntl
-import configHelper, numpy
-import astropy
-import scipy.ndimage
-import scipy.misc
-import fitsClasses
-from astropy.io import fits
-from PIL import Image,ImageDraw,ImageFont
+import argparse, sys, os, re, shutil, fcntl, multiprocessing, time
+import configHelper, fileClaims, folderScanner, folderWatcher, headerCache, headerScan, imageFormats, metadataIndex, metadataWriter, renderCache, renderPipeline, stageTimer
+# fitsClasses (and with it astropy and numpy) is only imported once there is a file to render, so that a run with nothing to do starts quickly
 
 debug = False
-fh=0
-
-def  run_once():
-     global  fh
-     lockFilename = "/tmp/fitsBrowser.lock"
-     # first create a lock file if it doesn't already exist
-     if not os.path.exists(lockFilename):
-		 lockFile = open(lockFilename, 'wt')
-		 lockFile.write("Lock file for fitsBrowser.py\n")
-		 lockFile.close()
-		 
-     fh = open(lockFilename,'r')
-     try:
-         fcntl.flock(fh,fcntl.LOCK_EX|fcntl.LOCK_NB)
-     except IOError as e:
-		 print "Sorry. I think I might already be running, so I am going to exit. Please look for stray processes."
-		 os._exit(0)
 
 def readHeaderListFile(filename):
 	headerListFile = open(filename, 'rt')
@@ -41,26 +19,693 @@ def readHeaderListFile(filename):
 	headerListFile.close()
 	return headers
 	
-def writeJSONFile(filename, titleString, jsonData):
-	jsFile = open(filename, 'wt')
-	jsFile.write('var title= "%s";\n'%titleString)
-	jsFile.write("var allImages= ")
-	jsFile.write(json.dumps(jsonData, sort_keys=False))
-	jsFile.write(";\n")
-	jsFile.close()
+def seedIndexFromMetadata(fileIndex, jsonData, rootPath):
+	""" Adds the records from an old imageMetadata.js to the index, matching them to the source files by their path relative to the data folder. """
+	for record in jsonData:
+		p = os.path.join(rootPath, record['sourceFilename'])
+		if os.path.isfile(p): fileIndex.update(p, record)
 	
-			
+def imageFilename(filename, prefix="", extension="png"):
+	""" The name of an image made from a FITS file, relative to the web folder. 'filename' is relative to the data folder, and its sub-folders are repeated under images/ so that files with the same name in different folders don't clash. Compressed files keep their whole name (see imageFormats.imageStem). """
+	folder, name = os.path.split(filename)
+	return os.path.join("images", folder, prefix + imageFormats.imageStem(name) + "." + extension)
+
+def previewNeeded(size, options):
+	""" False if an image of 'size' is no bigger than a preview, in which case the full-size image is shown as its preview """
+	return max(size) > options['previewSize']
+
+def outputFilenames(filename, options, size=None):
+	""" Returns the images that are made for a FITS file, by kind, relative to the web folder. The full-size image and preview are in the image format of the options, and thumbnails are always PNG. If the 'size' of the image is given and it is no bigger than a preview, the preview is the full-size image. """
+	names = {}
+	extension = imageFormats.imageExtensions[options['imageFormat']]
+	if not options['skipimages']:
+		names['image'] = imageFilename(filename, extension=extension)
+		if options['previewSize'] > 0:
+			if size is not None and not previewNeeded(size, options): names['preview'] = names['image']
+			else: names['preview'] = imageFilename(filename, "preview_", extension)
+	if not options['skipthumbnails']:
+		names['thumbnail'] = imageFilename(filename, "thumb_")
+	return names
+
+def makeFolder(folder):
+	""" Creates a folder if it isn't there. Another worker may be creating it at the same time. """
+	if os.path.isdir(folder): return
+	try:
+		os.makedirs(folder)
+	except OSError:
+		if not os.path.isdir(folder): raise
+
+def outputSize(outputs, options):
+	""" The size of the largest image to be made, or None if that is the full-size image """
+	if 'image' in outputs: return None
+	sizes = [0]
+	if 'preview' in outputs: sizes.append(options['previewSize'])
+	if 'thumbnail' in outputs: sizes.append(options['thumbnailSize'])
+	return max(sizes)
+
+def loadFITSFile(filename, options, outputs, timer, scan=None):
+	""" Loads a FITS file for the kinds of image listed in 'outputs'. Returns the fitsObject (or None if the file has no usable image data) and the headers read from it, for the header cache. If no images are needed and 'scan' holds the cached headers, the file is not opened at all. """
+	debug = options['debug']
+	if debug: print "Filename:", filename
+	import fitsClasses
+	newImage = fitsClasses.fitsObject(debug=debug, stretchLo=options['stretchLo'], stretchHi=options['stretchHi'], stretchTolerance=options['stretchTolerance'], mosaicLayout=options['mosaicLayout'])
+	# If all of the images are up to date, only the headers need to be read
+	loadPixels = len(outputs) > 0
+	with timer.stage('load' if loadPixels else 'headers'):
+		if loadPixels or scan is None:
+			loaded = newImage.initFromFITSFile(filename, path=options['rootPath'], loadPixels=loadPixels, keywords=options['headerKeywords'], outputSize=outputSize(outputs, options))
+			if loaded and loadPixels: newImage.readPixels()
+			scan = newImage.getHeaderScan()
+		else:
+			loaded = newImage.initFromHeaderScan(filename, scan)
+			scan = None
+	if not loaded: return None, None
+	return newImage, scan
+
+def makeImages(newImage, filename, options, outputs, timer):
+	""" Stretches and shrinks the pixels of a loaded file into the 8-bit images listed in 'outputs'. Returns a list of (kind, PIL image, output path). The float arrays are let go of once the images are made. No preview is made of an image that is no bigger than a preview. """
+	if 'preview' in outputs and not previewNeeded(newImage.size, options): outputs = [ kind for kind in outputs if kind != 'preview' ]
+	if len(outputs) == 0: return []
+	names = outputFilenames(filename, options, newImage.size)
+	with timer.stage('stretch'): images = newImage.makeImages(outputs, options['previewSize'], options['thumbnailSize'])
+	return [ (kind, images[kind], options['webPath'] + "/" + names[kind]) for kind in outputs ]
+
+def imageFormat(kind, options):
+	""" The format an image of kind 'kind' is written in """
+	if kind == 'thumbnail': return 'png'
+	return options['imageFormat']
+
+def writeImages(images, timer, options):
+	""" Encodes and writes the images made by makeImages. The time and bytes of each kind and format of image are added to 'timer' as a stage such as 'preview/webp'. """
+	for kind, img, outputFilename in images:
+		makeFolder(os.path.dirname(outputFilename))
+		outputFormat = imageFormat(kind, options)
+		if options['debug']: print "Writing %s file: %s"%(kind, outputFilename)
+		stage = kind + "/" + outputFormat
+		with timer.stage(stage): imageFormats.saveImage(img, outputFilename, outputFormat, options['compressLevel'], options['imageQuality'])
+		timer.addBytes(stage, os.path.getsize(outputFilename))
+
+def makeRecord(newImage, filename, options):
+	""" The metadata record for a loaded file """
+	names = outputFilenames(filename, options, newImage.size)
+	imageJSON = {}
+	if 'image' in names: imageJSON['pngFilename'] = names['image']
+	if 'preview' in names: imageJSON['previewFilename'] = names['preview']
+	if 'image' in names or 'preview' in names: imageJSON['imageFormat'] = options['imageFormat']
+	imageJSON['thumbnailFilename'] = imageFilename(newImage.filename, "thumb_")
+	imageJSON['sourceFilename'] = newImage.filename
+	imageJSON['xSize'] = newImage.size[0]
+	imageJSON['ySize'] = newImage.size[1]
+	if options['headers'] is not None:
+		headerObject = collections.OrderedDict()
+		for h in options['headers']:
+			try:
+				headerObject.update(newImage.getHeader(h))
+			except:
+				print "No header data for", h
+		imageJSON['headers'] = headerObject
+	return imageJSON
+
+def renderFITSFile(filename, options, outputs, timer, scan=None):
+	""" Loads a FITS file, writes the kinds of image listed in 'outputs' and returns the metadata record for it (or None if the file has no usable image data) and the headers read from it, for the header cache. If no images are needed and 'scan' holds the cached headers, the file is not opened at all. The time taken by each stage is added to 'timer'. """
+	newImage, scan = loadFITSFile(filename, options, outputs, timer, scan)
+	if newImage is None: return None, None
+	images = makeImages(newImage, filename, options, outputs, timer)
+	imageJSON = makeRecord(newImage, filename, options)
+	writeImages(images, timer, options)
+	return imageJSON, scan
+
+def loadStage(task):
+	""" The stages of renderPipeline for one (path, fingerprint, job, result) from processFiles, each of which passes on a dict holding the task, its timer and what has been made so far. Files whose result is already known go straight through. """
+	p, fingerprint, job, result = task
+	state = { 'task': task, 'result': result, 'timer': stageTimer.stageTimer() }
+	if result is not None: return state
+	filename, options, outputs, scan = job
+	state['image'], state['scan'] = loadFITSFile(filename, options, outputs, state['timer'], scan)
+	if state['image'] is None: state['result'] = (None, state['timer'].fileStats(), None, None)
+	return state
+
+def computeStage(state):
+	if state['result'] is not None: return state
+	filename, options, outputs, scan = state['task'][2]
+	newImage = state.pop('image')
+	state['images'] = makeImages(newImage, filename, options, outputs, state['timer'])
+	state['record'] = makeRecord(newImage, filename, options)
+	return state
+
+def encodeStage(state):
+	if state['result'] is not None: return state
+	writeImages(state.pop('images'), state['timer'], state['task'][2][1])
+	state['result'] = (state['record'], state['timer'].fileStats(), None, state['scan'])
+	return state
+
+def stateBytes(state):
+	""" The memory held by a file in the pipeline: its pixel arrays, or once they are made its 8-bit images """
+	if state.get('image') is not None: return state['image'].pixelBytes()
+	return sum([ img.size[0] * img.size[1] for kind, img, outputFilename in state.get('images', []) ])
+
+class knownResult:
+	""" Stands in for a pool's AsyncResult when the result of a file is already known """
+	def __init__(self, value):
+		self.value = value
+
+	def ready(self):
+		return True
+
+	def get(self, timeout=None):
+		return self.value
+
+def takeResult(job, result, timeout=None):
+	""" The result of rendering a file in the pool, as renderFITSFileWorker gives it. If it hasn't come back after 'timeout' seconds the file is reported as failed, because a worker that crashed or was killed (for running out of memory, say) never sends one. """
+	try:
+		return result.get(timeout)
+	except multiprocessing.TimeoutError:
+		error = "No result after %d seconds. The worker process may have died."%timeout
+		print "\nFailed to render %s: %s"%(job[0], error)
+		return None, {}, error, None
+
+def renderInOrder(jobs, pool=None, queueLength=32, pipeline=None, timeout=None):
+	""" Renders the files from the iterable 'jobs', each a (path, fingerprint, job, result) where 'result' is None if the file has to be rendered or is the result already known. Yields them with their results in the same order. With a pool, up to 'queueLength' files are handed to the workers ahead of the one being yielded, and each file is given up on if its result hasn't come 'timeout' seconds after the files before it are done. Without one, the files go through 'pipeline' (a renderPipeline.stagedPipeline made with the stages above) if one is given, or are rendered one at a time. """
+	if pool is None and pipeline is not None:
+		for task, state, error in pipeline.run(jobs):
+			p, fingerprint, job, result = task
+			if error is not None:
+				print "\nFailed to render %s: %s"%(job[0], error)
+				yield p, fingerprint, job, (None, state['timer'].fileStats() if isinstance(state, dict) else {}, str(error), None)
+			else:
+				yield p, fingerprint, job, state['result']
+		return
+	pending = collections.deque()
+	for p, fingerprint, job, result in jobs:
+		if result is not None: result = knownResult(result)
+		elif pool is None: result = knownResult(renderFITSFileWorker(job))
+		else: result = pool.apply_async(renderFITSFileWorker, (job,))
+		pending.append((p, fingerprint, job, result))
+		# The results are taken in the order the files were given, so the metadata order is fixed regardless of which worker finishes first
+		while len(pending) >= queueLength or (len(pending) > 0 and pending[0][3].ready()):
+			p, fingerprint, job, result = pending.popleft()
+			yield p, fingerprint, job, takeResult(job, result, timeout)
+	while len(pending) > 0:
+		p, fingerprint, job, result = pending.popleft()
+		yield p, fingerprint, job, takeResult(job, result, timeout)
+
+def helperResult(result, fingerprint, parameters, renderOptions):
+	""" Checks a result left by a helper process (see assistFiles). Returns the outputs it made and the result as renderFITSFileWorker gives it, or None if it was made from a different version of the file or with different settings, in which case the file is rendered again here. """
+	if result is None: return None
+	if result['fingerprint'] != fingerprint or result['parameters'] != parameters or result['headers'] != renderOptions['headers']: return None
+	return result['outputs'], (result['record'], result['times'], result['error'], result['scan'])
+
+def showProgress(f, processed, total, debug):
+	if not debug:
+		if total is not None: sys.stdout.write("\rProgress:  %3.1f%%, %d of %d files. %s        "%(float(processed) / float(total) * 100., processed, total, os.path.basename(f)))
+		else: sys.stdout.write("\rProgress:  %d files. %s        "%(processed, os.path.basename(f)))
+		sys.stdout.flush()
+	else:
+		print "%s \tProgress:  %d files."%(f, processed)
+
+def processFiles(paths, renderOptions, fileIndex, cache, headers, writer, timer, pool=None, queueLength=32, claims=None, claimPollInterval=1.0, pipeline=None, timeout=None):
+	""" Renders the FITS files in 'paths', in the worker pool if there is one, and adds their records to the index and the metadata writer in the same order as 'paths'. 'paths' can be any iterable, such as a generator that is still scanning the data folder: with a pool, up to 'queueLength' files are handed to the workers ahead of the one being finished. Files that are already in the index have their old record replaced. Files that fail to render are left out of the index and the metadata, so that they are tried again on the next run. Files that only need their metadata are served from the header cache 'headers' where possible. With 'claims' (a fileClaims), each file is claimed before it is rendered, so that helper processes leave it alone, and the files that helpers have rendered are taken from their results. Files that a helper is still working on are left until the end and waited for. Without a pool, the files go through 'pipeline' if one is given, and with one each file has 'timeout' seconds to come back (see renderInOrder). Returns the number of files processed and a list of (path, error message) for the files that failed. """
+	debug = renderOptions['debug']
+	parameters = renderCache.renderParameters(renderOptions)
+	total = None
+	if isinstance(paths, (list, tuple)): total = len(paths)
+	errors = []
+	processed = 0
 	
-def changeExtension(filename, extension):
-	return os.path.splitext(filename)[0] + "." + extension 
+	def jobs():
+		deferred = []
+		for p in paths:
+			fingerprint = metadataIndex.fileFingerprint(p)
+			filename = os.path.relpath(p, renderOptions['rootPath'])
+			names = outputFilenames(filename, renderOptions)
+			outputs = cache.staleOutputs(p, names, fingerprint, parameters, force=renderOptions['forceImages'])
+			scan = None
+			if len(outputs) == 0: scan = headers.get(fingerprint, renderOptions['headerKeywords'])
+			job = (filename, renderOptions, outputs, scan)
+			if claims is not None:
+				helped = helperResult(claims.takeResult(p), fingerprint, parameters, renderOptions)
+				if helped is not None:
+					cache.countResults(names, helped[0])
+					yield p, fingerprint, (filename, renderOptions, helped[0], scan), helped[1]
+					continue
+				if not claims.claim(p):
+					deferred.append((p, fingerprint, names, job))
+					continue
+			cache.countResults(names, outputs)
+			yield p, fingerprint, job, None
+		
+		# A helper is working on these. If it gives up or dies, its claim is released or expires and the file is rendered here instead.
+		while len(deferred) > 0:
+			waiting = []
+			for p, fingerprint, names, job in deferred:
+				helped = helperResult(claims.takeResult(p), fingerprint, parameters, renderOptions)
+				if helped is not None:
+					cache.countResults(names, helped[0])
+					yield p, fingerprint, (job[0], job[1], helped[0], job[3]), helped[1]
+				elif claims.claim(p):
+					cache.countResults(names, job[2])
+					yield p, fingerprint, job, None
+				else:
+					waiting.append((p, fingerprint, names, job))
+			deferred = waiting
+			if len(deferred) > 0:
+				with timer.stage('claims'): time.sleep(claimPollInterval)
 	
+	for f, fingerprint, job, result in renderInOrder(jobs(), pool, queueLength, pipeline, timeout):
+		processed+= 1
+		imageJSON, fileTimes, error, scan = result
+		timer.merge(fileTimes, filename=f)
+		if error is not None: errors.append((f, error))
+		if scan is not None: headers.put(fingerprint, scan, renderOptions['headerKeywords'])
+		if f in fileIndex: writer.remove(fileIndex.getRecord(f))
+		if error is not None:
+			# A file that failed is left out of the index, so that it is tried again on the next run
+			if f in fileIndex: fileIndex.remove(f)
+		else:
+			fileIndex.update(f, imageJSON, fingerprint=fingerprint, headerList=renderOptions['headers'])
+		if imageJSON is not None and error is None:
+			filename, options, outputs, scan = job
+			cache.update(f, fingerprint, outputFilenames(filename, options, (imageJSON['xSize'], imageJSON['ySize'])), outputs, parameters)
+			# Keep the index and cache in step with the metadata file, so that an interrupted run picks up where it left off
+			with timer.stage('metadata'): flushed = writer.append(imageJSON)
+			if flushed:
+				with timer.stage('index'):
+					fileIndex.save()
+					cache.save()
+					headers.save()
+		if claims is not None: claims.done(f)
+		showProgress(f, processed, total, debug)
+	return processed, errors
+
+def assistFiles(paths, renderOptions, cache, headers, claims, timer, pool=None, queueLength=32, pipeline=None, timeout=None):
+	""" Helps another process that is writing the metadata of the same web folder (see processFiles). Each file in 'paths' that no other process has claimed or finished is claimed and rendered, and its result is left for that process to add to the metadata. Nothing else in the web folder is written. Returns the number of files rendered and a list of (path, error message) for the files that failed. """
+	debug = renderOptions['debug']
+	parameters = renderCache.renderParameters(renderOptions)
+	errors = []
+	processed = 0
+	
+	def jobs():
+		for p in paths:
+			if claims.isFinished(p) or not claims.claim(p): continue
+			fingerprint = metadataIndex.fileFingerprint(p)
+			filename = os.path.relpath(p, renderOptions['rootPath'])
+			names = outputFilenames(filename, renderOptions)
+			outputs = cache.staleOutputs(p, names, fingerprint, parameters, force=renderOptions['forceImages'])
+			cache.countResults(names, outputs)
+			scan = None
+			if len(outputs) == 0: scan = headers.get(fingerprint, renderOptions['headerKeywords'])
+			yield p, fingerprint, (filename, renderOptions, outputs, scan), None
+	
+	for f, fingerprint, job, result in renderInOrder(jobs(), pool, queueLength, pipeline, timeout):
+		processed+= 1
+		imageJSON, fileTimes, error, scan = result
+		timer.merge(fileTimes, filename=f)
+		if error is not None: errors.append((f, error))
+		claims.putResult(f, { 'path': f, 'fingerprint': fingerprint, 'parameters': parameters, 'headers': renderOptions['headers'], 'outputs': job[2], 'record': imageJSON, 'times': fileTimes, 'error': error, 'scan': scan })
+		showProgress(f, processed, None, debug)
+	return processed, errors
+
+def renderFITSFileWorker(job):
+	""" Wrapper around renderFITSFile for the process pool. Returns the record, the stage times, an error message (or None) and the headers read from the file. Any failure is reported and swallowed here so that one bad file can't take down the pool or the run. """
+	filename, options, outputs, scan = job
+	timer = stageTimer.stageTimer()
+	try:
+		imageJSON, scan = renderFITSFile(filename, options, outputs, timer, scan)
+		return imageJSON, timer.fileStats(), None, scan
+	except Exception as e:
+		print "\nFailed to render %s: %s"%(filename, e)
+		return None, timer.fileStats(), str(e), None
+
+configDefaults  = {
+	"FITSPath": ".",
+	"SearchString": ".*.(fits|fits.gz|fits.fz|fit)",
+	"WebPath": ".",
+	"InstallPath": "undefined", 
+	"ThumbnailSize": 128, 
+	"PreviewSize": 800,
+	"FITSHeadersList": "/home/rashley/fitHeaders.list",
+	"MetadataFlushCount": 20,
+	"MetadataFlushInterval": 10.0,
+	"MetadataChunkSize": 500,
+	"MetadataFeedLength": 1000,
+	"MetadataFormat": "json",
+	"MetadataGzip": False,
+	"StretchLo": 20,
+	"StretchHi": 99,
+	"StretchTolerance": 0.001,
+	"MosaicLayout": "auto",
+	"WatchPollInterval": 2.0,
+	"WatchSettleTime": 2.0,
+	"HeaderCache": "selected",
+	"ScanThreads": 4,
+	"ClaimLease": 300.0,
+	"PipelineDepth": 2,
+	"MemoryBudget": 256,
+	"RenderTimeout": 600,
+	"ImageFormat": "png",
+	"ImageQuality": 85,
+	"PNGCompressLevel": 6,
+	"WatchPNGCompressLevel": 1
+}
+
+def loadConfig():
+	""" Returns the fitsBrowser config, with the defaults filled in for any settings that are not in the config file """
+	config = configHelper.configClass("fitsBrowser")
+	config.setDefaults(configDefaults)
+	return config
+
+def folderOptions(config, **settings):
+	""" Returns the options for a folderBuilder. Anything not given in 'settings' (dataPath, webPath, installPath, title, headerList, thumbnailSize, previewSize, stretchLo, stretchHi, skipimages, skipthumbnails, forceImages, number, debug) comes from the config. """
+	options = {
+		'dataPath': config.FITSPath,
+		'webPath': config.WebPath,
+		'installPath': config.InstallPath,
+		'title': "FITS Image browser for {today}",
+		'searchString': config.SearchString,
+		'headerList': config.FITSHeadersList,
+		'thumbnailSize': config.ThumbnailSize,
+		'previewSize': config.PreviewSize,
+		'stretchLo': config.StretchLo,
+		'stretchHi': config.StretchHi,
+		'stretchTolerance': config.StretchTolerance,
+		'mosaicLayout': config.MosaicLayout,
+		'flushCount': config.MetadataFlushCount,
+		'flushInterval': config.MetadataFlushInterval,
+		'chunkSize': config.MetadataChunkSize,
+		'feedLength': config.MetadataFeedLength,
+		'metadataFormat': config.MetadataFormat,
+		'metadataGzip': config.MetadataGzip,
+		'watchPollInterval': config.WatchPollInterval,
+		'watchSettleTime': config.WatchSettleTime,
+		'headerCache': config.HeaderCache,
+		'scanThreads': config.ScanThreads,
+		'claimLease': config.ClaimLease,
+		'pipelineDepth': config.PipelineDepth,
+		'memoryBudget': config.MemoryBudget,
+		'renderTimeout': config.RenderTimeout,
+		'imageFormat': config.ImageFormat,
+		'imageQuality': config.ImageQuality,
+		'compressLevel': config.PNGCompressLevel,
+		'watchCompressLevel': config.WatchPNGCompressLevel,
+		'skipimages': False,
+		'skipthumbnails': False,
+		'forceImages': False,
+		'number': 0,
+		'debug': False
+	}
+	for key, value in settings.items():
+		if key not in options: raise KeyError("Unknown fitsBrowser option: %s"%key)
+		if value is not None: options[key] = value
+	return options
+
+def lockWebFolder(webPath):
+	""" Takes the lock for a web folder, which is held on the file .fitsBrowser.lock inside it so that it also works between machines that share the folder. Returns the open lock file, or None if another fitsBrowser already has it. Only one fitsBrowser may write the metadata of a web folder at a time, but others can help it render the images (see folderBuilder.assist), and different folders can be processed at once. """
+	makeFolder(webPath)
+	lockFile = open(os.path.join(webPath, ".fitsBrowser.lock"), 'a')
+	try:
+		fcntl.flock(lockFile, fcntl.LOCK_EX|fcntl.LOCK_NB)
+	except IOError:
+		lockFile.close()
+		return None
+	return lockFile
+
+class folderBuilder:
+	""" Builds or updates the web folder for one folder of FITS files. The stages of a run are discover (find the FITS files), diff (compare them with the index of the last run), render (make the images of the new and changed files) and publish (write the metadata, index and render cache). The first three are chained generators, so rendering starts with the first file found rather than after the whole tree has been scanned. run() does all four and returns a summary, and watch() then keeps the folder up to date as new files arrive. A worker pool can be shared between several builders. """
+	def __init__(self, options, pool=None, timer=None):
+		self.options = options
+		self.pool = pool
+		self.debug = options['debug']
+		self.dataPath = options['dataPath']
+		self.webPath = options['webPath']
+		self.timer = timer
+		if self.timer is None: self.timer = stageTimer.stageTimer()
+		self.search_re = re.compile(options['searchString'])
+		self.lockFile = None
+		self.FITSPaths = []
+		self.errors = []
+		self.counts = { 'found': 0, 'new': 0, 'modified': 0, 'deleted': 0, 'stale': 0, 'reheadered': 0, 'processed': 0 }
+		headers = None
+		if options['headerList'] is not None and os.path.exists(options['headerList']):
+			print "Loading a header list file:", options['headerList']
+			headers = readHeaderListFile(options['headerList'])
+			if len(headers) == 0: headers = None
+		self.renderOptions = {
+			'rootPath': os.path.realpath(self.dataPath),
+			'webPath': self.webPath,
+			'skipimages': options['skipimages'],
+			'skipthumbnails': options['skipthumbnails'],
+			'forceImages': options['forceImages'],
+			'thumbnailSize': options['thumbnailSize'],
+			'previewSize': options['previewSize'],
+			'stretchLo': options['stretchLo'],
+			'stretchHi': options['stretchHi'],
+			'stretchTolerance': options['stretchTolerance'],
+			'mosaicLayout': options['mosaicLayout'],
+			'imageFormat': options['imageFormat'],
+			'imageQuality': options['imageQuality'],
+			'compressLevel': options['compressLevel'],
+			'headers': headers,
+			'debug': self.debug
+		}
+		if options['imageFormat'] not in imageFormats.imageExtensions:
+			raise ValueError("Unknown image format %s. Use one of: %s"%(options['imageFormat'], ", ".join(sorted(imageFormats.imageExtensions))))
+		if not imageFormats.imageFormatAvailable(options['imageFormat']):
+			print "WARNING: This PIL can't write %s images. Writing PNG instead."%options['imageFormat']
+			self.renderOptions['imageFormat'] = 'png'
+		if options['metadataFormat'] not in ('json', 'compact'):
+			raise ValueError("Unknown metadata format %s. Use json or compact."%options['metadataFormat'])
+		self.headerCache = headerCache.headerCache(self.webPath + "/headerCache.json", mode=options['headerCache'], debug=self.debug)
+		self.renderOptions['headerKeywords'] = headerScan.wantedKeywords(self.headerCache.keywords(headers))
+		# Claims let other processes help with the rendering. A lease of 0 switches them off.
+		self.claims = None
+		if options['claimLease'] > 0: self.claims = fileClaims.fileClaims(self.webPath + "/.claims", lease=options['claimLease'], debug=self.debug)
+		# Without a worker pool, loading, stretching and encoding overlap in a pipeline, within a memory budget given in MB. A depth of 0 renders one file at a time.
+		self.pipeline = None
+		if options['pipelineDepth'] > 0:
+			self.memoryBudget = renderPipeline.memoryBudget(options['memoryBudget'] * 1024 * 1024)
+			self.pipeline = renderPipeline.stagedPipeline(loadStage, computeStage, encodeStage, size=stateBytes, depth=options['pipelineDepth'], budget=self.memoryBudget)
+
+	def lock(self):
+		""" Returns False if another fitsBrowser is already writing to this web folder """
+		self.lockFile = lockWebFolder(self.webPath)
+		return self.lockFile is not None
+
+	def unlock(self):
+		if self.lockFile is not None: self.lockFile.close()
+		self.lockFile = None
+
+	def copyStaticFiles(self):
+		""" Creates the web folder and copies index.html into it from the source code folder. Files that are already there, with the same size and time, are left alone. """
+		imageFolder = self.webPath + "/images"
+		if self.debug: print "Creating folder %s"%imageFolder
+		if not os.path.exists(imageFolder):
+			os.makedirs(imageFolder)
+		staticFiles = ["index.html", "jquery.js"]
+		for s in staticFiles:
+			source, destination = os.stat(self.options['installPath'] + "/" + s), None
+			if os.path.exists(self.webPath + "/" + s): destination = os.stat(self.webPath + "/" + s)
+			if destination is None or destination.st_size != source.st_size or int(destination.st_mtime) != int(source.st_mtime):
+				shutil.copy2(self.options['installPath'] + "/" + s, self.webPath + "/" + s)
+
+	def discover(self):
+		""" Finds the FITS files in the data folder and its sub-folders, yielding (path, stat) for each one as soon as it is found """
+		self.FITSPaths = []
+		scanner = iter(folderScanner.folderScanner(self.dataPath, self.search_re, threads=self.options['scanThreads'], debug=self.debug))
+		scanTime = 0.
+		while True:
+			stageStart = time.time()
+			try:
+				path, fileStat = next(scanner)
+			except StopIteration:
+				break
+			finally:
+				scanTime+= time.time() - stageStart
+			self.FITSPaths.append(path)
+			yield path, fileStat
+		self.timer.add('discover', scanTime)
+		self.counts['found'] = len(self.FITSPaths)
+		print ("\nFound %d fits files in %s."%(len(self.FITSPaths), self.dataPath))
+
+	def prepare(self):
+		""" Loads the index of the files processed by previous runs and the render cache, and starts the metadata writer off with the records in the index """
+		jsFilename = self.webPath + "/imageMetadata.js"
+		self.fileIndex = metadataIndex.metadataIndex(self.webPath + "/imageIndex.json", debug=self.debug)
+		if not self.fileIndex.existed and os.path.exists(jsFilename):
+			print "No index found. Building one from the existing %s"%jsFilename
+			seedIndexFromMetadata(self.fileIndex, metadataWriter.readJSONFile(jsFilename), self.renderOptions['rootPath'])
+		
+		self.renderParameters = renderCache.renderParameters(self.renderOptions)
+		self.cache = renderCache.renderCache(self.webPath + "/renderCache.json", self.webPath, debug=self.debug)
+		
+		# Until the scan says otherwise, every file is assumed to be as it was on the last run
+		jsonData = [ self.fileIndex.getRecord(p) for p in sorted(self.fileIndex.entries) if self.fileIndex.getRecord(p) is not None ]
+		today = str(datetime.date.today()).replace('-','')
+		folder = str(os.path.dirname(os.path.realpath(self.dataPath)))
+		titleString = self.options['title'].format(today = today, folder = folder)
+		self.writer = metadataWriter.metadataWriter(jsFilename, titleString, jsonData, flushCount=self.options['flushCount'], flushInterval=self.options['flushInterval'], chunkSize=self.options['chunkSize'], feedLength=self.options['feedLength'], compact=self.options['metadataFormat'] == 'compact', gzipped=self.options['metadataGzip'], debug=self.debug)
+		self.writer.flush()
+
+	def diff(self, found):
+		""" Compares the files found (an iterable of (path, stat), e.g. from discover()) with the index, and yields the ones that need to be rendered as it goes. The files that have been deleted are only known once all of the files have been seen, and are taken out by removeDeleted(). prepare() has to be called first. """
+		diffTime = 0.
+		yielded = 0
+		for p, fileStat in found:
+			stageStart = time.time()
+			status = self.fileIndex.status(p, fileStat)
+			render = True
+			if status == 'unchanged':
+				if self.debug: print "Found file already....", p
+				record = self.fileIndex.getRecord(p)
+				render = False
+				if record is not None:
+					names = outputFilenames(os.path.relpath(p, self.renderOptions['rootPath']), self.renderOptions)
+					# Images made before there was a render cache are assumed to be up to date
+					if not self.cache.existed: self.cache.adopt(p, self.fileIndex.getFingerprint(p), names, self.renderParameters)
+					stale = self.cache.staleOutputs(p, names, self.fileIndex.getFingerprint(p), self.renderParameters, force=self.options['forceImages'])
+					if len(stale) > 0:
+						if self.debug: print "Images are out of date....", p
+						self.counts['stale']+= 1
+						render = True
+					elif self.fileIndex.headerListChanged(p, self.renderOptions['headers']):
+						# The images are fine but the record has the wrong headers. Only the headers need to be read again.
+						if self.debug: print "Header list has changed....", p
+						self.counts['reheadered']+= 1
+						render = True
+					else:
+						self.cache.countResults(names, stale)
+			elif status == 'modified':
+				if self.debug: print "File has been modified....", p
+				self.counts['modified']+= 1
+			else:
+				self.counts['new']+= 1
+			diffTime+= time.time() - stageStart
+			# With --number, the rest of the files are still checked but not rendered
+			if render and (self.options['number'] == 0 or yielded < self.options['number']):
+				yielded+= 1
+				yield p
+		
+		stageStart = time.time()
+		self.deletedPaths = self.fileIndex.deletedFiles(set(self.FITSPaths))
+		self.counts['deleted'] = len(self.deletedPaths)
+		self.timer.add('diff', diffTime + time.time() - stageStart)
+		print "%d are new files, %d have been modified and %d have been deleted."%(self.counts['new'], self.counts['modified'], self.counts['deleted'])
+		if self.counts['stale'] > 0: print "%d files have images that are out of date."%self.counts['stale']
+		if self.counts['reheadered'] > 0: print "%d files need their headers read again for the new header list."%self.counts['reheadered']
+
+	def removeDeleted(self):
+		""" Takes the files that diff() found to have been deleted out of the metadata, the index and the render cache """
+		for p in self.deletedPaths:
+			if self.debug: print "File has been deleted....", p
+			self.writer.remove(self.fileIndex.getRecord(p))
+			self.fileIndex.remove(p)
+			self.cache.remove(p)
+
+	def render(self, paths):
+		""" Makes the images and metadata records of the FITS files in 'paths', which can be a generator such as diff() """
+		processed, errors = processFiles(paths, self.renderOptions, self.fileIndex, self.cache, self.headerCache, self.writer, self.timer, self.pool, claims=self.claims, pipeline=self.pipeline, timeout=self.options['renderTimeout'])
+		self.errors.extend(errors)
+		self.counts['processed']+= processed
+		return errors
+
+	def publish(self):
+		""" Writes out everything that is still pending: the metadata, the index, the render cache and the header cache """
+		with self.timer.stage('metadata'): self.writer.close()
+		with self.timer.stage('index'):
+			self.fileIndex.save()
+			self.cache.save()
+			self.headerCache.prune(self.fileIndex.fingerprints())
+			self.headerCache.save()
+		if self.claims is not None: self.claims.removeStaleResults()
+
+	def run(self):
+		""" Brings the web folder up to date and returns a summary of what was done (see result()). Does nothing if another fitsBrowser is already working on the folder. """
+		self.runStart = time.time()
+		if self.lockFile is None and not self.lock():
+			print "Another fitsBrowser is already writing to %s. Skipping it."%self.webPath
+			return self.result(locked=True)
+		self.copyStaticFiles()
+		self.prepare()
+		try:
+			# The files are rendered as the scan finds them
+			self.render(self.diff(self.discover()))
+			self.removeDeleted()
+			self.publish()
+		finally:
+			if self.claims is not None: self.claims.releaseAll()
+		if not self.debug:
+			sys.stdout.write("\n")
+			sys.stdout.flush()
+		return self.result()
+
+	def assist(self):
+		""" Helps the process that holds the lock on this web folder, instead of waiting for it: the files that need rendering are claimed one at a time, their images made and their records left for that process to add to the metadata. The index and caches are read, but only the images are written. Returns a summary as run() does. """
+		self.runStart = time.time()
+		if self.claims is None:
+			print "Another fitsBrowser is already writing to %s, and claims are switched off. Skipping it."%self.webPath
+			return self.result(locked=True)
+		self.fileIndex = metadataIndex.metadataIndex(self.webPath + "/imageIndex.json", debug=self.debug)
+		self.renderParameters = renderCache.renderParameters(self.renderOptions)
+		self.cache = renderCache.renderCache(self.webPath + "/renderCache.json", self.webPath, debug=self.debug)
+		try:
+			processed, errors = assistFiles(self.diff(self.discover()), self.renderOptions, self.cache, self.headerCache, self.claims, self.timer, self.pool, pipeline=self.pipeline, timeout=self.options['renderTimeout'])
+		finally:
+			self.claims.releaseAll()
+		self.errors.extend(errors)
+		self.counts['processed']+= processed
+		if not self.debug:
+			sys.stdout.write("\n")
+			sys.stdout.flush()
+		return self.result(locked=True)
+
+	def watch(self, until=None):
+		""" Processes new and changed files as they arrive in the data folder, until the time 'until' (in seconds since the epoch) or Ctrl-C. run() has to be called first. Returns False if it was stopped by Ctrl-C. """
+		# Files are known once they are in the index, so any that arrived while run() was working are picked up on the first check
+		watcher = folderWatcher.folderWatcher(self.dataPath, self.search_re, pollInterval=self.options['watchPollInterval'], settleTime=self.options['watchSettleTime'], isKnown=lambda p: self.fileIndex.status(p) == 'unchanged', debug=self.debug)
+		# New frames are wanted on the page quickly, so PNGs are compressed faster while watching
+		self.renderOptions['compressLevel'] = self.options['watchCompressLevel']
+		print "\nWatching %s for new files using %s. Press Ctrl-C to stop."%(self.dataPath, watcher.method)
+		try:
+			while until is None or time.time() < until:
+				timeout = 60
+				if until is not None: timeout = min(timeout, until - time.time())
+				paths = [ p for p in watcher.waitForFiles(timeout) if self.fileIndex.status(p) != 'unchanged' ]
+				if len(paths)==0: continue
+				self.render(paths)
+				with self.timer.stage('metadata'): self.writer.flush()
+				with self.timer.stage('index'):
+					self.fileIndex.save()
+					self.cache.save()
+					self.headerCache.save()
+				if self.claims is not None: self.claims.releaseAll()
+		except KeyboardInterrupt:
+			print "\nStopped watching."
+			watcher.close()
+			return False
+		watcher.close()
+		return True
+
+	def result(self, locked=False):
+		""" A summary of the run: the number of files found, new, modified, deleted, stale and processed, the number of images on the page, the files that failed and the time spent in each stage. 'locked' is True if another process was writing the folder, in which case this one at most helped it. """
+		result = dict(self.counts)
+		result['dataPath'] = self.dataPath
+		result['webPath'] = self.webPath
+		result['locked'] = locked
+		result['images'] = 0
+		if not locked: result['images'] = len(self.writer.jsonData)
+		result['errors'] = list(self.errors)
+		result['timings'] = self.timer.asDict()
+		result['wallTime'] = time.time() - self.runStart
+		return result
+
 if __name__ == "__main__":
-	run_once()
 	parser = argparse.ArgumentParser(description='Makes a web-browser accessible page containing previews and thumbnails of all FITS images in a directory.')
 	parser.add_argument('--datapath', type=str, help='Path where the FITS files are. Default: current directory')
 	parser.add_argument('--webpath', type=str, help='Path to write the web page and images to. Default: current directory')
 	parser.add_argument('--installpath', type=str, help='Path of where this application has been installed. This is so that it can find the HTML files to copy to the web folder. ')
 	parser.add_argument('--size', type=int, help='Thumbnail size. Default is 128 pixels.')
+	parser.add_argument('--previewsize', type=int, help='Size of the mid-sized preview images shown in the preview window. Use 0 to not make previews. Default is 800 pixels.')
+	parser.add_argument('--lo', type=float, help='Percentile of the pixels that are shown as black. Default is 20.')
+	parser.add_argument('--hi', type=float, help='Percentile of the pixels that are shown as white. Default is 99.')
 	parser.add_argument('--save', action="store_true", help='Write the input parameters to the config file as default values.')
 	parser.add_argument('--skipallimages', action="store_true", help="Skip creating of the images and thumbnails, just create the metadata. (For debugging purposes)")
 	parser.add_argument('--skipimages', action="store_true", help="Skip creating of the images (but still creates the thumbnails.")
@@ -69,43 +714,47 @@ if __name__ == "__main__":
 	parser.add_argument('--debug', action="store_true", help="Show some debug information.")
 	parser.add_argument('--headerlist', type=str, help='Filename of a text file containing FITS headers that should be displayed on the web page.')
 	parser.add_argument('-n', '--number', type=int, default=0, help='Stop after processing ''--number'' images. Default is process all images.')
+	parser.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes to use for rendering the images. Default is 1 (no parallel processing).')
+	parser.add_argument('--pipeline', type=int, help='Without --workers, the number of files that can wait between the load, stretch and encode stages, which overlap. Use 0 to render one file at a time. Default is 2.')
+	parser.add_argument('--memory', type=int, help='Memory budget in MB for the pixels of the files in the pipeline. Default is 256.')
+	parser.add_argument('--timeout', type=int, help='With --workers, the number of seconds to wait for a worker to render a file before reporting it as failed, as a worker that crashed or was killed never answers. Default is 600.')
+	parser.add_argument('--format', type=str, choices=['png', 'webp', 'jpeg'], help='Format of the full-size images and previews: png (lossless), webp or jpeg (lossy, smaller and quicker to write). Thumbnails are always PNG. Default is png.')
+	parser.add_argument('--quality', type=int, help='Quality of webp and jpeg images, from 1 to 100. Default is 85.')
+	parser.add_argument('--compresslevel', type=int, help='zlib compression level of PNG images, from 1 (fastest) to 9 (smallest). Default is 6. In --watch mode the WatchPNGCompressLevel setting (default 1) is used for the new files.')
+	parser.add_argument('--metadata', type=str, choices=['json', 'compact'], help='Form of the imageMetadata.js file: json (a list of records) or compact (in columns, which is several times smaller for large folders and quicker for the page to load). Default is json.')
+	parser.add_argument('--gzip', action="store_true", help="Also write gzipped copies of the metadata files, for web servers that can send precompressed files.")
+	parser.add_argument('--watch', action="store_true", help="Keep running after the first pass and process new FITS files as they arrive in the data folder.")
+	parser.add_argument('--watchuntil', type=float, help="Stop watching at this time, in seconds since the epoch. (Used by dayBuilder.py to move on to the next night.)")
+	parser.add_argument('--stats', action="store_true", help="Write the time taken by each stage for each file to imageStats.json in the web folder.")
+	parser.add_argument('--profile', action="store_true", help="Run under the Python profiler and show the functions that take the most time. The profile is also saved to fitsBrowser.prof in the web folder. (Only the main process is profiled, so use this without --workers.)")
 	parser.add_argument('-t', '--title', type=str, default="FITS Image browser for {today}", help='Title for the web page. Use {today} as an alias for today\'s date and {folder} for the source folder name.')
 	
 	args = parser.parse_args()
+	runStart = time.time()
+	if args.profile:
+		import cProfile, pstats
+		profiler = cProfile.Profile()
+		profiler.enable()
 	if args.debug: debug = True
 	if debug: print(args)
 	
-	forceImages = False
-	if args.force: forceImages = True
-	
-	searchForHeaders = False
-	skipthumbnails = False
-	skipimages = False
-	processAllImages = True
-	if args.number>0: 	processAllImages=False
-	if args.skipallimages:
-		skipthumbnails = True
-		skipimages = True
-	if args.skipimages == True: skipimages = True
-	# if args.skipthumbnails == True: skipthumbnails = True
-		
-	
-	config = configHelper.configClass("fitsBrowser")
-	configDefaults  = {
-		"FITSPath": ".",
-		"SearchString": ".*.(fits|fits.gz|fits.fz|fit)",
-		"WebPath": ".",
-		"InstallPath": "undefined", 
-		"ThumbnailSize": 128, 
-		"FITSHeadersList": "/home/rashley/fitHeaders.list"
-	}
-	config.setDefaults(configDefaults)
-	rootPath = config.assertProperty("FITSPath", args.datapath)
-	searchString = config.assertProperty("SearchString", None)
-	webPath = config.assertProperty("WebPath", args.webpath)
+	config = loadConfig()
+	config.assertProperty("FITSPath", args.datapath)
+	config.assertProperty("WebPath", args.webpath)
 	installPath = config.assertProperty("InstallPath", args.installpath)
-	thumbnailSize = config.assertProperty("ThumbnailSize", args.size)
-	fitsHeaderListFilename = config.assertProperty("FITSHeadersList", args.headerlist)
+	config.assertProperty("ThumbnailSize", args.size)
+	config.assertProperty("PreviewSize", args.previewsize)
+	config.assertProperty("FITSHeadersList", args.headerlist)
+	config.assertProperty("StretchLo", args.lo)
+	config.assertProperty("StretchHi", args.hi)
+	config.assertProperty("PipelineDepth", args.pipeline)
+	config.assertProperty("MemoryBudget", args.memory)
+	config.assertProperty("RenderTimeout", args.timeout)
+	config.assertProperty("ImageFormat", args.format)
+	config.assertProperty("ImageQuality", args.quality)
+	config.assertProperty("PNGCompressLevel", args.compresslevel)
+	config.assertProperty("MetadataFormat", args.metadata)
+	if args.gzip: config.assertProperty("MetadataGzip", True)
 	if args.save:
 		config.save()
 	
@@ -114,127 +763,45 @@ if __name__ == "__main__":
 		print "Please specify the install path of fitsBrowser. Use the --installpath command option, or specify it in ~/.config/fitsBrowser/fitsBrowser.conf file."
 		sys.exit(-1)
 	
-	if os.path.exists(fitsHeaderListFilename):
-		print "Loading a header list file:", fitsHeaderListFilename
-		headers = readHeaderListFile(fitsHeaderListFilename)
-		if len(headers) > 0: searchForHeaders = True
-		
-	search_re = re.compile(searchString)
-	
-	# Create sub-folder for the images
-	imageFolder = webPath + "/images"
-	if debug: print "Creating folder %s"%imageFolder
-	if not os.path.exists(imageFolder):
-		os.makedirs(imageFolder)
-	# Copy index.html file from source code folder to the web folder
-	staticFiles = ["index.html", "jquery.js"]
-	for s in staticFiles: shutil.copy2(installPath + "/" + s, webPath + "/" + s)
-	if args.html: sys.exit()
-	
-	fitsFiles = []
-	# Find all folders in data path
-	folders = os.walk(rootPath)
-	subFolders = []
-	FITSFilenames = []
-	for f in folders:
-		if debug: print("Folder: %s"%os.path.realpath(f[0]))
-		subFolders.append(os.path.realpath(f[0]))
-		for file in f[2]:
-			m = search_re.match(file)
-			if (m): 
-				FITSFilenames.append(file)
-
-	
-	print "subFolders:", subFolders
-	mainFolderName = subFolders[0].split('/')
-	print "Main folder:", mainFolderName[-1]
-	print ("Found %d fits files in the folder."%len(FITSFilenames))
-	
-	# Now check in the destination folder for pre-existing data
-	oldJSONdata = []
-	if os.path.exists(webPath + '/imageMetadata.js'):
-		jsFile = open(webPath + '/imageMetadata.js')
-		for line in jsFile:
-			if "var allImages" in line:
-				jsData = line[len("var allImages= "):-2]
-				oldJSONdata = json.loads(jsData)
-				
-	newFITSFilenames = []
-	for f in FITSFilenames:
-		newFile = True
-		for j in oldJSONdata:
-			if j['sourceFilename'] == f:
-				if debug: print "Found file already....", f
-				newFile = False
-				break
-		if newFile:
-			newFITSFilenames.append(f)
-			
-	print "%d are new files."%len(newFITSFilenames)
-	FITSFilenames = newFITSFilenames	
-	jsonData = oldJSONdata
-	
-	# Prepare some of the JSON objects for writing
-	titleString = args.title
-	today = str(datetime.date.today()).replace('-','')
-	folder = str(os.path.dirname(os.path.realpath(rootPath)))
-	titleString = titleString.format(today = today, folder = folder)
-	jsFilename = webPath + "/imageMetadata.js"
-	
-	
-	writeJSONFile(jsFilename, titleString, jsonData)
-	
+	options = folderOptions(config, title=args.title, skipimages=args.skipimages or args.skipallimages, skipthumbnails=args.skipallimages, forceImages=args.force, number=args.number, debug=debug)
+	builder = folderBuilder(options)
+	locked = not builder.lock()
+	if locked and (args.html or builder.claims is None):
+		print "Sorry. I think I might already be running, so I am going to exit. Please look for stray processes."
+		os._exit(0)
+	if args.html:
+		builder.copyStaticFiles()
+		sys.exit()
 	
-	for index, f in enumerate(FITSFilenames):
-		if debug: print "Filename:", f
-		if not processAllImages and ((index)==args.number): break
-		newImage = fitsClasses.fitsObject(debug=debug)
-		if (newImage.initFromFITSFile(f, path=rootPath)==False): continue
-		imageJSON = {}
-		if not skipimages:
-			imageFilename = imageFolder + "/" + changeExtension(newImage.filename, "png")
-			if not os.path.exists(imageFilename) or forceImages:
-				newImage.writeAsPNG(boosted=True, filename=imageFilename)
-			else:
-				if debug: print "Image exists, not overwriting."
-			imageJSON['pngFilename'] = "images/" + changeExtension(newImage.filename, "png")
-		imageFilename = imageFolder + "/thumb_" + changeExtension(newImage.filename, "png")
-		if not os.path.exists(imageFilename) or forceImages:
-			newImage.createThumbnail(filename=imageFilename, size=thumbnailSize)
-		else:
-			if debug: print "Thumbnail exists. Not overwriting."
-		imageJSON['thumbnailFilename'] = "images/thumb_" + changeExtension(newImage.filename, "png")
-		imageJSON['sourceFilename'] = newImage.filename
-		imageJSON['xSize'] = newImage.size[0]
-		imageJSON['ySize'] = newImage.size[1]
-		if searchForHeaders:
-			headerObject = collections.OrderedDict()
-			for h in headers:
-				try:
-					headerObject.update(newImage.getHeader(h))
-				except:
-					print "No header data for", h
-			imageJSON['headers'] = headerObject
-				
-		
-		
-		jsonData.append(imageJSON)
-		writeJSONFile(jsFilename, titleString, jsonData)
-	
-		
-		progressPercent = float(index+1) / float(len(FITSFilenames)) * 100.
-		if not debug:
-			sys.stdout.write("\rProgress:  %3.1f%%, %d of %d files. %s        "%(progressPercent, index+1, len(FITSFilenames), f))
-			sys.stdout.flush()
-		else:
-			print "%s \tProgress:  %3.1f%%, %d of %d files."%(f, progressPercent, index+1, len(FITSFilenames))
-		
-	if not debug:
-		sys.stdout.write("\n")
-		sys.stdout.flush()	
+	if args.workers > 1:
+		print "Rendering with %d worker processes."%args.workers
+		# Recycle the workers every so often so that a leaky or badly behaved file can't bloat a worker for the whole run
+		builder.pool = multiprocessing.Pool(processes=args.workers, maxtasksperchild=50)
 	
+	if locked:
+		print "Another fitsBrowser is writing to %s. Helping it with the images."%builder.webPath
+		result = builder.assist()
+	else:
+		result = builder.run()
+		if args.watch: builder.watch(args.watchuntil)
 	
+	if builder.pool is not None:
+		# Every result has been taken by now. join() would wait for ever on the task of a worker that died, so the workers are stopped instead.
+		builder.pool.terminate()
 	
-	print ""
+	print builder.cache.summary()
+	print builder.headerCache.summary()
+	if builder.pipeline is not None and builder.pool is None: print "Pipeline: at most %.0f MB of pixels held, with a budget of %d MB."%(builder.memoryBudget.peak / 1048576., options['memoryBudget'])
+	print builder.timer.summary()
+	if len(builder.errors) > 0: print "%d files could not be rendered."%len(builder.errors)
+	print "Total time: %.2f seconds"%(time.time() - runStart)
+	if args.stats:
+		stageTimer.writeStatsFile(builder.webPath + "/imageStats.json", builder.timer, time.time() - runStart)
+		print "Timings written to %s"%(builder.webPath + "/imageStats.json")
+	if args.profile:
+		profiler.disable()
+		profiler.dump_stats(builder.webPath + "/fitsBrowser.prof")
+		print "\nThe 25 functions with the highest cumulative time (full profile saved to %s):"%(builder.webPath + "/fitsBrowser.prof")
+		pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
 	print "Finished!"
-	print "Point your browser at: %s"%("file://" + webPath + "/index.html")
+	print "Point your browser at: %s"%("file://" + builder.webPath + "/index.html")
@@ -1,38 +1,91 @@
-import astropy, sys, numpy, scipy
+import astropy, sys, os, numpy
+import imageStretch, mosaic, headerScan, compressedInput
+from headerScan import wantedKeywords
 from astropy.io import fits
 from PIL import Image,ImageDraw,ImageFont
 
 class fitsObject:
-	def __init__(self, debug = False):
+	def __init__(self, debug = False, stretchLo=20, stretchHi=99, stretchTolerance=0.001, mosaicLayout='auto', mosaicFactor=4):
 		self.filename = None
+		self.stretchLo = stretchLo
+		self.stretchHi = stretchHi
+		self.stretchTolerance = stretchTolerance
+		self.mosaicLayout = mosaicLayout
+		self.mosaicFactor = mosaicFactor
 		self.boostedImageExists = False
+		self.boostedImage = None
+		self.renderedImage = None
+		self.pyramid = []
 		self.allHeaders = {}
 		self.fullImage = {}
+		self.shapes = []
+		self.size = None
 		self.debug = debug
 
-	def initFromFITSFile(self, filename, path="."):
-		images = []
+	def initFromFITSFile(self, filename, path=".", loadPixels=True, keywords=None, outputSize=None):
+		""" Loads the headers and image data from a FITS file. Uncompressed data is memory-mapped, and when there are several image extensions they are read one at a time and shrunk straight into the mosaic, so that only one full-size extension is ever in memory. With loadPixels=False only the header blocks are read, by headerScan. If 'keywords' is given only those headers are kept. 'outputSize' is the size of the largest image that will be made from the data, or None if the full-size image is needed, and lets compressed files be read at a lower resolution (see compressedInput). """
+		if loadPixels and filename.endswith('.gz'):
+			try:
+				return self.initFromGzipFile(filename, path, keywords, outputSize)
+			except IOError as e:
+				print "Could not read %s: %s"%(filename, e)
+				return False
+		if not loadPixels:
+			try:
+				return self.initFromHeaderScan(filename, headerScan.scanFile(path + "/" + filename, wantedKeywords(keywords)))
+			except IOError as e:
+				print "Could not read the headers of %s: %s"%(filename, e)
+				return False
+			except Exception as e:
+				if self.debug: print "The header scan failed (%s). Trying astropy."%e
+		wanted = wantedKeywords(keywords)
 		try:
-			hdulist = fits.open(path + "/" + filename)
+			hdulist = fits.open(path + "/" + filename, memmap=True)
 			if self.debug: print "Info: ", hdulist.info()
-			# card = hdulist[0]
-			for h in hdulist:
-				if type(h.data) is numpy.ndarray:
-					imageObject = {}
-					imageObject['data'] = h.data
-					imageObject['size'] = numpy.shape(h.data)
-					if len(imageObject['size'])<2:
-						if self.debug: print "Data is one-dimensional. Not valid."
-						return False
-					images.append(imageObject)
-					if self.debug: print("Found image data of dimensions (%d, %d)"%(imageObject['size'][0], imageObject['size'][1]))
-				else:
+			# Grab the FITS headers from every HDU
+			for card in hdulist:
+				header = card.header
+				for key in header.keys() if wanted is None else wanted:
+					if key in headerScan.skippedKeywords or key not in header: continue
+					value = header[key]
+					if isinstance(value, fits.card.Undefined): value = None
+					self.allHeaders[key] = value
+			imageHDUs = []
+			for index, h in enumerate(hdulist):
+				shape = self.getHDUShape(h)
+				if shape is None:
 					if self.debug: print "This card has no image data"
 					continue                 # This card has no image data
-			# Grab all of the FITS headers I can find
-			for card in hdulist:
-				for key in card.header.keys():
-					self.allHeaders[key] = card.header[key]
+				if len(shape)<2:
+					if self.debug: print "Data is one-dimensional. Not valid."
+					return False
+				if self.debug: print("Found image data of dimensions (%d, %d)"%(shape[0], shape[1]))
+				imageHDUs.append(index)
+			self.filename = filename
+			if len(imageHDUs)==0:
+				if self.debug: print "Could not find any valid FITS data for %s"%filename
+				return False
+			shapes = [ self.getHDUShape(hdulist[index]) for index in imageHDUs ]
+			self.shapes = shapes
+			if len(imageHDUs)>1:
+				if self.debug: print "Combining %d multiple images."%len(imageHDUs)
+				layout = mosaic.chooseLayout(self.allHeaders, shapes, self.mosaicLayout)
+				if loadPixels:
+					builder = mosaic.mosaicBuilder(shapes, layout, factor=self.mosaicFactor, debug=self.debug)
+					for num, index in enumerate(imageHDUs):
+						builder.addTile(num, self.readHDUData(hdulist, index)[0])
+						# Release this extension's pixels before reading the next one
+						if 'data' in hdulist[index].__dict__: del hdulist[index].data
+					self.fullImage = { 'data': builder.image, 'size': builder.shape, 'isMosaic': True }
+					self.size = builder.shape
+				else:
+					self.size = layout([ mosaic.reducedShape(s, self.mosaicFactor) for s in shapes ])[0]
+			elif not loadPixels:
+				self.size = shapes[0]
+			else:
+				imageData, step = self.readHDUData(hdulist, imageHDUs[0], compressedInput.chooseStep(shapes[0], outputSize, self.mosaicFactor))
+				self.fullImage = { 'data': imageData, 'size': shapes[0] }
+				self.size = self.fullImage['size']
 			hdulist.close(output_verify='ignore')
 		except astropy.io.fits.verify.VerifyError as e:
 
@@ -44,141 +97,156 @@ class fitsObject:
 			print "Could not find any valid FITS data for %s"%filename
 			return False
 
+		if self.size is None: return False
+		return True
+
+	def initFromGzipFile(self, filename, path, keywords=None, outputSize=None, isMosaic=False):
+		""" Loads a gzipped FITS file in one pass through the decompressed stream. An image in the primary HDU is read at the resolution the outputs need. If more images follow it is a mosaic, and each of them is shrunk to the resolution of the mosaic as it is read. """
+		wanted = wantedKeywords(keywords)
+		images = []
+		for index, (headers, shape, stream) in enumerate(compressedInput.gzipImages(path + "/" + filename, wanted)):
+			for key, value in headers.items():
+				if key not in headerScan.skippedKeywords: self.allHeaders[key] = value
+			if shape is None: continue
+			if len(shape)<2:
+				if self.debug: print "Data is one-dimensional. Not valid."
+				return False
+			if len(images)==1 and images[0][2]>1 and not isMosaic:
+				# The first image was thinned out for a preview, but a mosaic needs every pixel averaged. Start again.
+				if self.debug: print "%s is a mosaic. Reading it again."%filename
+				self.allHeaders = {}
+				return self.initFromGzipFile(filename, path, keywords, outputSize, isMosaic=True)
+			if len(images)>0 or isMosaic:
+				images.append((shape[-2:], stream.read(self.mosaicFactor, average=True), self.mosaicFactor))
+			elif index==0:
+				step = compressedInput.chooseStep(shape, outputSize, self.mosaicFactor)
+				images.append((shape[-2:], stream.read(step), step))
+			else:
+				# Images in extensions are usually the first of several, so are read in full, ready to be averaged into a mosaic
+				images.append((shape[-2:], stream.read(), 1))
 		self.filename = filename
 		if len(images)==0:
 			if self.debug: print "Could not find any valid FITS data for %s"%filename
 			return False
+		shapes = [ shape for shape, imageData, step in images ]
+		self.shapes = shapes
 		if len(images)>1:
-			self.combineImages(images)
+			if self.debug: print "Combining %d multiple images."%len(images)
+			builder = mosaic.mosaicBuilder(shapes, mosaic.chooseLayout(self.allHeaders, shapes, self.mosaicLayout), factor=self.mosaicFactor, debug=self.debug)
+			for num, (shape, imageData, step) in enumerate(images):
+				builder.addTile(num, imageData, step)
+				images[num] = None
+			self.fullImage = { 'data': builder.image, 'size': builder.shape, 'isMosaic': True }
+			self.size = builder.shape
 		else:
-			self.fullImage = images[0]
-			self.size = numpy.shape(self.fullImage['data'])
+			self.fullImage = { 'data': images[0][1], 'size': shapes[0] }
+			self.size = shapes[0]
 		return True
 
-	def getHeader(self, key):
-		if key in self.allHeaders.keys():
-			return { key: self.allHeaders[key] }
+	def initFromHeaderScan(self, filename, scan):
+		""" Sets up the headers and size from the result of headerScan.scanFile (or a cached copy of it), without opening the file """
+		self.filename = filename
+		self.allHeaders = dict(scan['headers'])
+		self.shapes = [ tuple(s) for s in scan['shapes'] ]
+		if len(self.shapes)==0 or min([ len(s) for s in self.shapes ])<2:
+			if self.debug: print "Could not find any valid FITS data for %s"%filename
+			return False
+		if len(self.shapes)>1:
+			layout = mosaic.chooseLayout(self.allHeaders, self.shapes, self.mosaicLayout)
+			self.size = layout([ mosaic.reducedShape(s, self.mosaicFactor) for s in self.shapes ])[0]
+		else:
+			self.size = self.shapes[0]
+		return True
 
-	def combineImages(self, images):
-		if self.debug: print "Combining %d multiple images."%len(images)
-		WFC = False
+	def getHeaderScan(self):
+		""" The headers and image shapes, in the same form as headerScan.scanFile, for the header cache """
+		return { 'headers': self.allHeaders, 'shapes': [ list(s) for s in self.shapes ] }
+
+	def getHDUShape(self, hdu):
+		""" Returns the shape of the image data in an HDU from its header, without reading the data. Returns None if the HDU has no image data. """
+		if not hdu.is_image: return None
+		naxis = hdu.header.get('NAXIS', 0)
+		if naxis==0: return None
+		return tuple([ hdu.header['NAXIS%d'%i] for i in range(naxis, 0, -1) ])
+
+	def readHDUData(self, hdulist, index, step=1):
+		""" Returns the data for one HDU, memory-mapped where possible, and the step it was read at. Tile-compressed HDUs are read at every 'step'-th row and column if they can be, other HDUs at full resolution (a step of 1). Older versions of astropy refuse to memory-map scaled integer data, so in that case just this HDU is read directly. """
+		hdu = hdulist[index]
+		if step > 1 and isinstance(hdu, fits.CompImageHDU):
+			imageData = compressedInput.readTileRows(hdu, step)
+			if imageData is not None: return imageData, step
+			if self.debug: print "HDU %d can't be decompressed a tile at a time. Reading all of it."%index
 		try:
-			instrument = self.allHeaders['INSTRUME']
-			print "Instrument detected:", instrument
-			WFC = True
-		except KeyError:
-			pass
-
-		# Reduce the images sizes by 1/4
-		for num, i in enumerate(images):
-			percent = 25
-			if self.debug: print "Shrinking image %d by %d percent."%(num, percent)
-			i['data'] = scipy.misc.imresize(self.boostImageData(i['data']), percent)
-			i['size'] = numpy.shape(i['data'])
-			if self.debug: print "New size:", i['size']
-
-		if WFC:
-			# Custom code to stitch the WFC images together
-			CCD1 = images[0]
-			CCD2 = images[1]
-			CCD3 = images[2]
-			CCD4 = images[3]
-			width = CCD1['size'][1]
-			height = CCD1['size'][0]
-			fullWidth = width + height
-			fullHeight = 3 * width
-			if self.debug: print "WFC width", fullWidth, "WFC height", fullHeight
-			fullImage = numpy.zeros((fullHeight, fullWidth))
-			CCD3data = numpy.rot90(CCD3['data'], 3)
-			fullImage[0:width, width:width+height] = CCD3data
-			CCD2data = CCD2['data']
-			fullImage[width:width+height, 0:width] = CCD2data
-			CCD4data = numpy.rot90(CCD4['data'], 3)
-			fullImage[width:2*width, width:width+height] = CCD4data
-			CCD1data = numpy.rot90(CCD1['data'], 3)
-			fullImage[2*width:3*width, width:width+height] = CCD1data
-			fullImage = numpy.rot90(fullImage, 2)
-		else:
-			totalWidth = 0
-			totalHeight = 0
-			for i in images:
-				totalWidth+= i['size'][1]
-				totalHeight+=i['size'][0]
-			if self.debug: print "potential width, height", totalWidth, totalHeight
-			if totalWidth<totalHeight:
-				if self.debug: print "Stacking horizontally"
-				maxHeight = 0
-				for i in images:
-					if i['size'][0]>maxHeight: maxHeight = i['size'][0]
-				fullImage = numpy.zeros((maxHeight, totalWidth))
-				if self.debug: print "Full image shape", numpy.shape(fullImage)
-				segWstart = 0
-				segHstart = 0
-				for num, i in enumerate(images):
-					segWidth = i['size'][1]
-					segHeight = i['size'][0]
-					segWend = segWstart + segWidth
-					segHend = segHstart + segHeight
-					fullImage[segHstart:segHend, segWstart: segWend] = i['data']
-					segWstart+= segWidth
-
-
-		self.fullImage['data'] = fullImage
-		self.fullImage['size'] = numpy.shape(fullImage)
-		self.size = numpy.shape(fullImage)
-		if self.debug: print "Final size:", self.size
+			return hdu.data, 1
+		except ValueError:
+			if self.debug: print "Could not memory-map HDU %d. Reading it directly."%index
+			return fits.getdata(hdulist.filename(), ext=index, memmap=False), 1
+
+	def getHeader(self, key):
+		if key in self.allHeaders:
+			return { key: self.allHeaders[key] }
 
 	def boostImageData(self, imageData):
 		""" Returns a normalised array where lo percent of the pixels are 0 and hi percent of the pixels are 255 """
-		hi = 99
-		lo = 20
-		data = imageData
-		max = data.max()
-		dataArray = data.flatten()
-		pHi = numpy.percentile(dataArray, hi)
-		pLo = numpy.percentile(dataArray, lo)
-		range = pHi - pLo
-		scale = range/255
-		data = numpy.clip(data, pLo, pHi)
-		data-= pLo
-		data/=scale
-		return data
+		return imageStretch.stretch(imageData, self.stretchLo, self.stretchHi, self.stretchTolerance)
 
 
 	def getBoostedImage(self):
 		""" Returns a normalised array where lo percent of the pixels are 0 and hi percent of the pixels are 255 """
-		hi = 99
-		lo = 20
-		imageData = self.fullImage['data']
-		data = numpy.copy(self.fullImage['data'])
-		max = data.max()
-		dataArray = data.flatten()
-		pHi = numpy.percentile(dataArray, hi)
-		pLo = numpy.percentile(dataArray, lo)
-		range = pHi - pLo
-		scale = range/255
-		data = numpy.clip(data, pLo, pHi)
-		data-= pLo
-		data/=scale
+		data = self.boostImageData(self.fullImage['data'])
+		# Blank pixels, and the gaps between the CCDs of a mosaic, are NaN. Show them as black.
+		data[numpy.isnan(data)] = 0
 		self.boostedImage = data
 		self.boostedImageExists = True
 		return data
 
+	def getRenderedImage(self):
+		""" Returns the boosted image as an 8-bit greyscale PIL image. It is made once and shared by the full-size image and the thumbnail. """
+		if self.renderedImage is None:
+			if not self.boostedImageExists: self.getBoostedImage()
+			self.renderedImage = toImage(self.boostedImage)
+		return self.renderedImage
+
+	def readPixels(self):
+		""" Reads memory-mapped pixels into memory as native float32. The reading then happens here (e.g. in an I/O thread) rather than in whatever touches the pixels first, the mapped file is let go of, and the stretch can be done in place on the copy. """
+		data = self.fullImage.get('data')
+		if data is None or (data.dtype == numpy.float32 and data.dtype.isnative and data.flags.owndata): return
+		self.fullImage['data'] = numpy.array(data, dtype=numpy.float32)
+
+	def makeImages(self, kinds, previewSize=800, thumbnailSize=128):
+		""" Returns the 8-bit PIL images for the kinds of output in 'kinds' ('image', 'preview' and 'thumbnail'), ready to be written, and then lets go of all of the float arrays, so that only the 8-bit images are held while they are encoded. The stretch is done in place on the loaded pixels where they are writeable, rather than on a copy. """
+		data = imageStretch.stretch(self.fullImage['data'], self.stretchLo, self.stretchHi, self.stretchTolerance, inPlace=True)
+		self.fullImage['data'] = None
+		data[numpy.isnan(data)] = 0
+		self.boostedImage = data
+		self.boostedImageExists = True
+		images = {}
+		if 'image' in kinds: images['image'] = self.getRenderedImage()
+		if 'preview' in kinds: images['preview'] = self.getReducedImage(previewSize)
+		if 'thumbnail' in kinds: images['thumbnail'] = self.getReducedImage(thumbnailSize)
+		self.releasePixels()
+		return images
+
+	def releasePixels(self):
+		""" Drops the pixel arrays and the rendered image. The headers and size are kept. """
+		if 'data' in self.fullImage: self.fullImage['data'] = None
+		self.boostedImage = None
+		self.boostedImageExists = False
+		self.renderedImage = None
+		self.pyramid = []
+
+	def pixelBytes(self):
+		""" The memory held by the pixel arrays and rendered image of this object, in bytes """
+		arrays = [ self.fullImage.get('data'), self.boostedImage ] + self.pyramid
+		total = sum([ a.nbytes for a in arrays if isinstance(a, numpy.ndarray) ])
+		if self.renderedImage is not None: total+= self.renderedImage.size[0] * self.renderedImage.size[1]
+		return total
+
 	def writeAsPNG(self, boosted=False, filename = None):
-		imageData = numpy.copy(self.fullImage['data'])
 		if boosted==True:
-			if not self.boostedImageExists: imageData = self.getBoostedImage()
-			else: imageData = self.boostedImage
-		imgData = numpy.rot90(imageData, 3)
-		imgSize = numpy.shape(imgData)
-		imgLength = imgSize[0] * imgSize[1]
-		testData = numpy.reshape(imgData, imgLength, order="F")
-		img = Image.new("L", imgSize)
-		palette = []
-		for i in range(256):
-			palette.extend((i, i, i)) # grey scale
-			img.putpalette(palette)
-		img.putdata(testData)
+			img = self.getRenderedImage()
+		else:
+			img = toImage(numpy.clip(self.fullImage['data'], 0, 255))
 
 		if filename==None:
 			outputFilename = changeExtension(self.filename, "png")
@@ -186,28 +254,48 @@ class fitsObject:
 			outputFilename = filename
 
 		if self.debug: print ("Writing PNG file: " + outputFilename)
-		img.save(outputFilename, "PNG", clobber=True)
+		img.save(outputFilename, "PNG")
+
+	def getReducedImage(self, size):
+		""" Returns an 8-bit image no bigger than size x size pixels. The boosted array is block-averaged down to just above the requested size, starting from the smallest level of the pyramid made so far, and only that small array is resampled by PIL to the exact size. """
+		if not self.boostedImageExists: self.getBoostedImage()
+		source = self.boostedImage
+		for level in self.pyramid:
+			if max(numpy.shape(level)) >= size: source = level
+		factor = max(numpy.shape(source)) // size
+		if factor > 1:
+			source = mosaic.blockReduce(source, factor)
+			self.pyramid.append(source)
+		img = toImage(source)
+		img.thumbnail((size, size), Image.ANTIALIAS)
+		return img
+
+	def writePreview(self, filename = None, size=800):
+		""" Writes a mid-sized version of the image, for browsing over slow links """
+		img = self.getReducedImage(size)
+		if filename==None:
+			outputFilename = "preview_" + changeExtension(self.filename, "png")
+		else:
+			outputFilename = filename
+
+		if self.debug: print ("Writing preview file: " + outputFilename)
+		img.save(outputFilename, "PNG")
 
 	def createThumbnail(self, filename = None, size=128):
-		if not self.boostedImageExists: imageData = self.getBoostedImage()
-		else: imageData = self.boostedImage
-
-		imgData = numpy.rot90(imageData, 3)
-		imgSize = numpy.shape(imgData)
-		imgLength = imgSize[0] * imgSize[1]
-		testData = numpy.reshape(imgData, imgLength, order="F")
-		img = Image.new("L", imgSize)
-		palette = []
-		for i in range(256):
-			palette.extend((i, i, i)) # grey scale
-			img.putpalette(palette)
-		img.putdata(testData)
-		thumbnailSize = (size, size)
-		img.thumbnail(thumbnailSize, Image.ANTIALIAS)
+		img = self.getReducedImage(size)
 		if filename==None:
 			outputFilename = "thumb_" + changeExtension(self.filename, "png")
 		else:
 			outputFilename = filename
 
 		if self.debug: print ("Writing thumbnail file: " + outputFilename)
-		img.save(outputFilename, "PNG", clobber=True)
+		img.save(outputFilename, "PNG")
+
+def toImage(imageData):
+	""" Converts an array of 0-255 values into an 8-bit greyscale PIL image in one step. The rows are flipped while converting to uint8, because FITS images have their origin at the bottom left, and PIL then shares the uint8 buffer rather than copying it. """
+	height, width = numpy.shape(imageData)
+	buffer = numpy.ascontiguousarray(imageData[::-1], dtype=numpy.uint8)
+	return Image.frombuffer("L", (width, height), buffer, "raw", "L", 0, 1)
+
+def changeExtension(filename, extension):
+	return os.path.splitext(filename)[0] + "." + extension
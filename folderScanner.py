@@ -0,0 +1,99 @@
+""" Finds the FITS files in a data folder and all of its sub-folders. The files are handed out one at a time, with their stat, as soon as their folder has been listed, so that the files found first can be processed while the rest of the tree is still being scanned. Sub-folders are listed ahead of time by a few threads, which hides the latency of network file systems, but the files always come out in the same order: each folder's files sorted by name, then its sub-folders in turn.
+
+os.scandir (or the scandir package on Python 2) is used where it is available, because it gets the type of each entry from the directory listing without a stat call per entry. """
+
+import os, stat, threading
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+def listFolder(folder, search_re):
+	""" Returns the sub-folders of a folder and the files in it whose names match 'search_re', as (path, stat), both sorted by name. Symbolic links to folders are not followed, as with os.walk. """
+	folders = []
+	files = []
+	try:
+		if scandir is not None:
+			for entry in scandir(folder):
+				if entry.is_dir(follow_symlinks=False): folders.append(entry.path)
+				elif search_re.match(entry.name) and entry.is_file(): files.append((entry.path, entry.stat()))
+		else:
+			for name in os.listdir(folder):
+				path = os.path.join(folder, name)
+				if stat.S_ISDIR(os.lstat(path).st_mode): folders.append(path)
+				elif search_re.match(name) and os.path.isfile(path): files.append((path, os.stat(path)))
+	except OSError as e:
+		print("WARNING: Could not read the folder %s (%s)"%(folder, e))
+	return sorted(folders), sorted(files)
+
+class listing:
+	""" The listing of one folder, which a lister thread fills in. get() waits for it, and raises any exception the listing did. """
+	def __init__(self, folder):
+		self.folder = folder
+		self.result = None
+		self.error = None
+		self.done = threading.Event()
+
+	def get(self):
+		self.done.wait()
+		if self.error is not None: raise self.error
+		return self.result
+
+class folderScanner:
+	def __init__(self, path, search_re, threads=4, debug=False):
+		""" Iterating over the scanner gives (path, stat) for each matching file under 'path'. Paths are under the real path of 'path'. 'threads' folders are listed at once. """
+		self.path = os.path.realpath(path)
+		self.search_re = search_re
+		self.threads = max(1, threads)
+		self.debug = debug
+		self.folders = 0
+
+	def lister(self, toList):
+		while True:
+			job = toList.get()
+			if job is None: break
+			try:
+				job.result = listFolder(job.folder, self.search_re)
+			except Exception as e:
+				job.error = e
+			job.done.set()
+
+	def list(self, folder, toList):
+		job = listing(folder)
+		toList.put(job)
+		return job
+
+	def __iter__(self):
+		# Plain daemon threads rather than a multiprocessing ThreadPool, which takes a tenth of a second to shut down at exit
+		toList = queue.Queue()
+		for t in range(self.threads):
+			thread = threading.Thread(target=self.lister, args=(toList,))
+			thread.daemon = True
+			thread.start()
+		try:
+			listings = { self.path: self.list(self.path, toList) }
+			stack = [ self.path ]
+			while len(stack) > 0:
+				folder = stack.pop()
+				folders, files = listings.pop(folder).get()
+				self.folders+= 1
+				if self.debug: print("Folder: %s"%folder)
+				# Start listing the sub-folders in the background while this folder's files are processed
+				for f in folders: listings[f] = self.list(f, toList)
+				stack.extend(reversed(folders))
+				for path, fileStat in files: yield path, fileStat
+		finally:
+			# Listings still running finish in the background. Waiting for them here would hold up the caller.
+			for t in range(self.threads): toList.put(None)
+
+	def paths(self):
+		""" All of the matching files, as a list of paths """
+		return [ path for path, fileStat in self ]
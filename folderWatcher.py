@@ -0,0 +1,99 @@
+""" Watches a data folder for new FITS files as they are written by the camera. inotify (through the pyinotify package) is used if it is installed, otherwise the folder is polled. A file is only reported once its size and modification time have stopped changing, so that half-written frames are skipped. """
+
+import os, time
+import folderScanner
+
+try:
+	import pyinotify
+except ImportError:
+	pyinotify = None
+
+class folderWatcher:
+	def __init__(self, path, search_re, pollInterval=2.0, settleTime=2.0, usePolling=False, isKnown=None, debug=False):
+		""" 'isKnown' says whether a file that is already in the folder has been dealt with (e.g. it is in the index and unchanged). The others are reported as if they had just arrived, so that files written while an earlier pass was running are not missed. By default every file already there is taken as known. """
+		self.path = path
+		self.search_re = search_re
+		self.pollInterval = pollInterval
+		self.settleTime = settleTime
+		self.debug = debug
+		self.known = {}          # path -> (size, mtime) of the files that have already been reported
+		self.candidates = {}     # path -> (size, mtime, time first seen at that size and mtime)
+		for p in self.listFiles():
+			try:
+				known = isKnown is None or isKnown(p)
+			except OSError:
+				continue
+			if known: self.known[p] = self.getStat(p)
+			else: self.addCandidate(p)
+		self.notifier = None
+		if pyinotify is not None and not usePolling:
+			self.startNotifier()
+			self.method = "inotify"
+		else:
+			self.method = "polling"
+		if self.debug: print("Watching %s using %s. %d files already there."%(self.path, self.method, len(self.known)))
+
+	def startNotifier(self):
+		watcher = self
+		class eventHandler(pyinotify.ProcessEvent):
+			def process_default(self, event):
+				if not event.dir: watcher.addCandidate(event.pathname)
+		watchManager = pyinotify.WatchManager()
+		self.notifier = pyinotify.Notifier(watchManager, eventHandler(), timeout=int(self.pollInterval * 1000))
+		watchManager.add_watch(self.path, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO, rec=True, auto_add=True)
+
+	def close(self):
+		if self.notifier is not None: self.notifier.stop()
+
+	def listFiles(self):
+		return folderScanner.folderScanner(self.path, self.search_re, threads=1).paths()
+
+	def getStat(self, path):
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+		return (stat.st_size, stat.st_mtime)
+
+	def addCandidate(self, path):
+		path = os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+		if not self.search_re.match(os.path.basename(path)): return
+		if path not in self.candidates:
+			if self.debug: print("New or changed file: %s"%path)
+			self.candidates[path] = (None, None, time.time())
+
+	def checkForChanges(self):
+		""" Waits up to pollInterval seconds for files to change and adds them to the candidates """
+		if self.notifier is not None:
+			if self.notifier.check_events():
+				self.notifier.read_events()
+				self.notifier.process_events()
+			return
+		time.sleep(self.pollInterval)
+		for p in self.listFiles():
+			if self.known.get(p) != self.getStat(p): self.addCandidate(p)
+
+	def readyFiles(self):
+		""" Returns the candidates whose size and mtime have been steady for at least settleTime seconds """
+		ready = []
+		now = time.time()
+		for path, (size, mtime, since) in list(self.candidates.items()):
+			stat = self.getStat(path)
+			if stat is None:
+				del self.candidates[path]
+			elif stat != (size, mtime):
+				self.candidates[path] = (stat[0], stat[1], now)
+			elif now - since >= self.settleTime:
+				del self.candidates[path]
+				if self.known.get(path) == stat: continue
+				self.known[path] = stat
+				ready.append(path)
+		return sorted(ready)
+
+	def waitForFiles(self, timeout):
+		""" Returns a list of the new or changed files that are ready to be read, waiting up to 'timeout' seconds for some to turn up """
+		deadline = time.time() + timeout
+		while True:
+			self.checkForChanges()
+			ready = self.readyFiles()
+			if len(ready) > 0 or time.time() >= deadline: return ready
@@ -0,0 +1,64 @@
+""" Remembers the FITS headers and image shapes read from each file, keyed by the file's content fingerprint, so that the metadata can be rebuilt (e.g. with a new header list) without opening the FITS files again. In 'selected' mode only the headers in the header list are kept, in 'all' mode every header is, which makes the cache bigger but means any header list can be served from it. 'off' switches it off. """
+
+import os, json
+
+class headerCache:
+	def __init__(self, filename, mode='selected', debug=False):
+		self.filename = filename
+		self.mode = mode
+		self.debug = debug
+		self.entries = {}
+		self.savedText = None
+		self.hits = 0
+		self.misses = 0
+		if self.mode != 'off': self.load()
+
+	def load(self):
+		if not os.path.exists(self.filename): return False
+		try:
+			cacheFile = open(self.filename, 'rt')
+			self.savedText = cacheFile.read()
+			cacheFile.close()
+			self.entries = json.loads(self.savedText)
+		except ValueError as e:
+			print("WARNING: Could not read the header cache %s (%s). Starting a new one."%(self.filename, e))
+			self.entries = {}
+			return False
+		return True
+
+	def save(self):
+		if self.mode == 'off': return
+		text = json.dumps(self.entries, sort_keys=True)
+		if text == self.savedText: return
+		tempFilename = self.filename + ".tmp"
+		cacheFile = open(tempFilename, 'wt')
+		cacheFile.write(text)
+		cacheFile.close()
+		os.rename(tempFilename, self.filename)
+		self.savedText = text
+
+	def keywords(self, headerList):
+		""" The keywords to read from the files for a header list: None (everything) in 'all' mode """
+		if self.mode == 'all' or headerList is None: return None
+		return headerList
+
+	def get(self, fingerprint, keywords):
+		""" Returns the cached header scan of a file if it has all of 'keywords' (None for all of them), or None """
+		if self.mode == 'off': return None
+		entry = self.entries.get(fingerprint)
+		if entry is not None and (entry['keywords'] is None or (keywords is not None and set(keywords) <= set(entry['keywords']))):
+			self.hits+= 1
+			return entry['scan']
+		self.misses+= 1
+		return None
+
+	def put(self, fingerprint, scan, keywords):
+		if self.mode == 'off': return
+		self.entries[fingerprint] = { 'keywords': keywords, 'scan': scan }
+
+	def prune(self, fingerprints):
+		""" Forgets the files whose fingerprints are not in 'fingerprints' (a set) """
+		for f in [ f for f in self.entries if f not in fingerprints ]: del self.entries[f]
+
+	def summary(self):
+		return "Header cache: %d hits, %d misses."%(self.hits, self.misses)
@@ -0,0 +1,155 @@
+""" Reads just the headers of a FITS file, without astropy. A FITS file is a series of HDUs, each a header of 80-character cards in 2880-byte blocks followed by its data, padded to a whole number of blocks. The size of the data is worked out from the header, so the scan seeks straight from one header to the next and never reads any pixels. """
+
+import os, re, gzip
+
+blockSize = 2880
+cardSize = 80
+skippedKeywords = set(['', 'COMMENT', 'HISTORY', 'CONTINUE', 'END'])
+
+def wantedKeywords(keywords):
+	""" The headers to read for a list of keywords. INSTRUME is always included, because it decides how a mosaic is laid out. None means all of them. """
+	if keywords is None: return None
+	return list(keywords) + [ k for k in ['INSTRUME'] if k not in keywords ]
+
+def parseValue(text):
+	""" Converts the value part of a card (after '= ') to a Python value. Returns the value and the rest of the card. """
+	text = text.strip()
+	if text.startswith("'"):
+		# Strings are quoted, with '' standing for a quote inside the string
+		value = ""
+		position = 1
+		while position < len(text):
+			if text[position] == "'":
+				if text[position+1:position+2] == "'":
+					value+= "'"
+					position+= 2
+					continue
+				break
+			value+= text[position]
+			position+= 1
+		return value.rstrip(), text[position+1:]
+	value = text.split('/', 1)[0].strip()
+	if value == 'T': return True, ""
+	if value == 'F': return False, ""
+	if value == '': return None, ""
+	try:
+		return int(value), ""
+	except ValueError:
+		pass
+	try:
+		return float(value.replace('D', 'E')), ""
+	except ValueError:
+		return value, ""
+
+def parseCard(card):
+	""" Returns the keyword and value of a card, or (keyword, None) for a card without a value """
+	keyword = card[:8].strip()
+	if keyword == 'HIERARCH' and '=' in card:
+		keyword, text = card[9:].split('=', 1)
+		return keyword.strip(), parseValue(text)[0]
+	if card[8:10] != '= ': return keyword, None
+	return keyword, parseValue(card[10:])[0]
+
+def readHeader(inputFile, first=False):
+	""" Reads the cards of one header, up to and including END. Returns a list of (keyword, value), or None at the end of the file. Anything after the last HDU that is not a header is ignored. """
+	cards = []
+	block = inputFile.read(blockSize)
+	if first and not block.startswith(b'SIMPLE'): raise IOError("Not a FITS file")
+	if not first and not block.startswith(b'XTENSION'): return None
+	while True:
+		if len(block) < blockSize: raise IOError("The file ends in the middle of a header")
+		block = block.decode('ascii', 'replace')
+		for position in range(0, blockSize, cardSize):
+			card = block[position:position + cardSize]
+			keyword, value = parseCard(card)
+			if keyword == 'END': return cards
+			if keyword == 'CONTINUE' and len(cards) > 0:
+				# The rest of a long string that didn't fit on the card before
+				previousKeyword, previousValue = cards[-1]
+				if isinstance(previousValue, basestring) and previousValue.endswith('&'):
+					cards[-1] = (previousKeyword, previousValue[:-1] + parseValue(card[8:])[0])
+				continue
+			if keyword in skippedKeywords: continue
+			cards.append((keyword, value))
+		block = inputFile.read(blockSize)
+
+def dataSize(header):
+	""" The number of bytes of data after a header, including the padding to a whole block """
+	naxis = header.get('NAXIS', 0)
+	if naxis == 0: return 0
+	axes = [ header.get('NAXIS%d'%i, 0) for i in range(1, naxis + 1) ]
+	if header.get('GROUPS', False) and axes[0] == 0: axes = axes[1:]
+	pixels = 1
+	for a in axes: pixels*= a
+	bits = abs(header.get('BITPIX', 8)) * header.get('GCOUNT', 1) * (header.get('PCOUNT', 0) + pixels)
+	size = bits // 8
+	return ((size + blockSize - 1) // blockSize) * blockSize
+
+def imageShape(header):
+	""" The shape of the image in an HDU (slowest axis first, like numpy), or None if it has no image. Tile-compressed images (.fz) are stored as tables, with the real axes in ZNAXISn. """
+	prefix = ''
+	if header.get('XTENSION', '').strip() == 'BINTABLE':
+		if not header.get('ZIMAGE', False): return None
+		prefix = 'Z'
+	elif header.get('XTENSION', 'IMAGE').strip() != 'IMAGE':
+		return None
+	naxis = header.get(prefix + 'NAXIS', 0)
+	if naxis == 0: return None
+	return tuple([ header.get('%sNAXIS%d'%(prefix, i), 0) for i in range(naxis, 0, -1) ])
+
+# The keywords of a tile-compressed image's table that describe the table or the compression rather than the image
+compressionKeywords = re.compile(r'^(TFIELDS|THEAP|T(TYPE|FORM|UNIT|NULL|SCAL|ZERO|DISP|DIM)\d+|ZIMAGE|ZCMPTYPE|ZBITPIX|ZNAXIS\d*|ZTILE\d+|ZNAME\d+|ZVAL\d+|ZMASKCMP|ZSIMPLE|ZTENSION|ZEXTEND|ZBLOCKED|ZPCOUNT|ZGCOUNT|ZHECKSUM|ZDATASUM|ZQUANTIZ|ZDITHER0|ZBLANK|ZSCALE|ZZERO)$')
+# Keywords of the original image that are kept under another name in the table
+restoredKeywords = { 'ZBITPIX': 'BITPIX', 'ZNAXIS': 'NAXIS', 'ZPCOUNT': 'PCOUNT', 'ZGCOUNT': 'GCOUNT', 'ZEXTEND': 'EXTEND', 'ZBLOCKED': 'BLOCKED', 'ZHECKSUM': 'CHECKSUM', 'ZDATASUM': 'DATASUM' }
+
+def imageCards(cards):
+	""" The cards of a tile-compressed image (.fz) as astropy's CompImageHDU shows them: the image's own BITPIX, NAXIS and NAXISn in place of the table's, and without the keywords that describe the table and the compression """
+	header = dict(cards)
+	restored = {}
+	for keyword, value in header.items():
+		if keyword in restoredKeywords: restored[restoredKeywords[keyword]] = value
+		elif re.match(r'^ZNAXIS\d+$', keyword): restored[keyword[1:]] = value
+	restored.setdefault('PCOUNT', 0)
+	restored.setdefault('GCOUNT', 1)
+	if 'ZSIMPLE' in header: first = [ ('SIMPLE', header['ZSIMPLE']) ]
+	else: first = [ ('XTENSION', header.get('ZTENSION', 'IMAGE')) ]
+	kept = [ (k, v) for k, v in cards if k not in restored and k not in ('XTENSION', 'BITPIX', 'NAXIS') and not re.match(r'^NAXIS\d+$', k) and not compressionKeywords.match(k) ]
+	return first + sorted(restored.items()) + kept
+
+def openFITSFile(filename):
+	if filename.endswith('.gz'): return gzip.open(filename, 'rb')
+	return open(filename, 'rb')
+
+def scanFile(filename, keywords=None):
+	""" Reads the headers of every HDU in a file. Returns a dict with 'headers', the keywords of all of the HDUs merged together (a later HDU wins, as in fitsObject.allHeaders), limited to 'keywords' if they are given, and 'shapes', the shape of each HDU that holds an image. """
+	headers = {}
+	shapes = []
+	wanted = None
+	if keywords is not None: wanted = set(keywords)
+	inputFile = openFITSFile(filename)
+	try:
+		first = True
+		while True:
+			cards = readHeader(inputFile, first)
+			first = False
+			if cards is None: break
+			header = dict(cards)
+			shape = imageShape(header)
+			# Record a compressed image's headers as astropy does, so that they don't depend on whether the file was scanned or loaded
+			if header.get('XTENSION', '').strip() == 'BINTABLE' and header.get('ZIMAGE', False): cards = imageCards(cards)
+			for keyword, value in cards:
+				if wanted is None or keyword in wanted: headers[keyword] = value
+			if shape is not None: shapes.append(shape)
+			skip = dataSize(header)
+			if skip == 0: continue
+			if isinstance(inputFile, gzip.GzipFile):
+				# Gzip files can only be read forwards, so read past the data a piece at a time
+				while skip > 0:
+					skipped = len(inputFile.read(min(skip, 1 << 20)))
+					if skipped == 0: break
+					skip-= skipped
+			else:
+				inputFile.seek(skip, os.SEEK_CUR)
+	finally:
+		inputFile.close()
+	return { 'headers': headers, 'shapes': shapes }
@@ -0,0 +1,31 @@
+""" The formats the full-size images and previews can be written in, kept apart from fitsClasses so that the names of the images can be worked out without importing astropy or PIL. PIL is only imported by the functions that need it. """
+
+import os
+
+imageExtensions = { 'png': 'png', 'webp': 'webp', 'jpeg': 'jpg' }
+compressedExtensions = [ '.gz', '.fz' ]
+
+def imageStem(name):
+	""" The part of a FITS file name that the names of its images are made from: the name without its extension, or the whole name for a compressed file, so that a.fits, a.fits.gz and a.fits.fz give a.png, a.fits.gz.png and a.fits.fz.png rather than the same image """
+	root, extension = os.path.splitext(name)
+	if extension.lower() in compressedExtensions: return name
+	return root
+
+def imageFormatAvailable(imageFormat):
+	""" True if PIL can write images in 'imageFormat'. WebP needs PIL to have been built with libwebp. """
+	if imageFormat == 'png': return True
+	from PIL import Image
+	try:
+		from PIL import features
+	except ImportError:
+		# Older PILs only register the formats they can write
+		Image.init()
+		return imageFormat.upper() in Image.SAVE
+	return features.check({ 'jpeg': 'jpg' }.get(imageFormat, imageFormat))
+
+def saveImage(img, output, imageFormat='png', compressLevel=6, quality=85):
+	""" Writes an 8-bit image to a filename or file object as png (lossless, at zlib level 'compressLevel' from 1, fastest, to 9, smallest), webp or jpeg (lossy, at 'quality' from 1 to 100) """
+	if imageFormat == 'png': img.save(output, "PNG", compress_level=compressLevel)
+	elif imageFormat == 'webp': img.save(output, "WEBP", quality=quality)
+	elif imageFormat == 'jpeg': img.save(output, "JPEG", quality=quality)
+	else: raise ValueError("Unknown image format: %s"%imageFormat)
@@ -0,0 +1,33 @@
+""" The percentile stretch that turns raw FITS data into 0-255 grey levels for the web images. """
+
+import numpy
+
+def sampleSize(tolerance):
+	""" The number of pixels to sample so that the percentile levels are within 'tolerance' (as a fraction of the pixel ranking) of the true values. A tolerance of 0 means use every pixel. """
+	if tolerance <= 0: return 0
+	return int(0.25 / tolerance**2)
+
+def percentileLevels(data, lo=20, hi=99, tolerance=0.001):
+	""" Returns the lo and hi percentile levels of the data. Large arrays are measured on an evenly strided subsample rather than by partitioning every pixel. NaNs (blank pixels) are ignored. """
+	flatData = data.ravel()
+	samples = sampleSize(tolerance)
+	if samples > 0 and flatData.size > samples:
+		flatData = flatData[::flatData.size // samples]
+	if flatData.dtype.kind == 'f':
+		flatData = flatData[numpy.isfinite(flatData)]
+		if flatData.size == 0: return 0., 0.
+	# Asking for both percentiles at once means only one partition of the sample
+	pLo, pHi = numpy.percentile(flatData, [lo, hi])
+	return pLo, pHi
+
+def stretch(data, lo=20, hi=99, tolerance=0.001, inPlace=False):
+	""" Returns a float32 array where lo percent of the pixels are 0 and hi percent of the pixels are 255. With inPlace=True a writeable float32 input array is re-used rather than copied. """
+	pLo, pHi = percentileLevels(data, lo, hi, tolerance)
+	if inPlace and data.dtype == numpy.float32 and data.flags.writeable:
+		output = data
+	else:
+		output = numpy.array(data, dtype=numpy.float32)
+	numpy.clip(output, pLo, pHi, out=output)
+	output-= pLo
+	if pHi > pLo: output*= 255. / (pHi - pLo)
+	return output
@@ -0,0 +1,107 @@
+""" A persistent index of the FITS files that fitsBrowser has already processed. Entries are keyed by the path of the source file and record its mtime, size and a content fingerprint, so that new, modified and deleted files can be found without re-reading the old metadata. """
+
+import os, json, hashlib
+
+def fileFingerprint(filename, size=None, blockSize=65536):
+	""" Returns a cheap content fingerprint for a file. This is an md5 of the size and of the first and last blocks of the file, which is enough to spot a re-written frame without reading the whole thing. """
+	if size is None: size = os.path.getsize(filename)
+	md5 = hashlib.md5()
+	md5.update(str(size).encode('ascii'))
+	inputFile = open(filename, 'rb')
+	md5.update(inputFile.read(blockSize))
+	if size > blockSize:
+		inputFile.seek(max(blockSize, size - blockSize))
+		md5.update(inputFile.read(blockSize))
+	inputFile.close()
+	return md5.hexdigest()
+
+class metadataIndex:
+	def __init__(self, filename, debug=False):
+		self.filename = filename
+		self.debug = debug
+		self.entries = {}
+		self.existed = False
+		self.savedText = None
+		self.load()
+
+	def load(self):
+		if not os.path.exists(self.filename):
+			if self.debug: print("No index file found at %s"%self.filename)
+			return False
+		try:
+			indexFile = open(self.filename, 'rt')
+			self.savedText = indexFile.read()
+			indexFile.close()
+			self.entries = json.loads(self.savedText)['files']
+		except (ValueError, KeyError) as e:
+			print("WARNING: Could not read the index file %s (%s). Starting a new one."%(self.filename, e))
+			self.entries = {}
+			return False
+		self.existed = True
+		return True
+
+	def save(self):
+		""" Writes the index to disk. The file is written to a temporary name and then renamed so that it is never left half-written. Nothing is written if the index is the same as the file already holds. """
+		text = json.dumps({'files': self.entries}, sort_keys=True)
+		if text == self.savedText: return
+		tempFilename = self.filename + ".tmp"
+		indexFile = open(tempFilename, 'wt')
+		indexFile.write(text)
+		indexFile.close()
+		os.rename(tempFilename, self.filename)
+		self.savedText = text
+
+	def __contains__(self, path):
+		return path in self.entries
+
+	def __len__(self):
+		return len(self.entries)
+
+	def status(self, path, stat=None):
+		""" Returns 'new', 'modified' or 'unchanged' for a source file. The fingerprint is only computed when the mtime has moved but the size has not. """
+		entry = self.entries.get(path)
+		if entry is None: return 'new'
+		if stat is None: stat = os.stat(path)
+		if stat.st_size != entry['size']: return 'modified'
+		if stat.st_mtime == entry['mtime']: return 'unchanged'
+		if fileFingerprint(path, stat.st_size) != entry['fingerprint']: return 'modified'
+		# Touched but not changed. Remember the new mtime so that we don't fingerprint it again.
+		entry['mtime'] = stat.st_mtime
+		return 'unchanged'
+
+	def update(self, path, record, stat=None, fingerprint=None, headerList=None):
+		""" Records a processed file. 'record' is its metadata for the web page, or None if the file had no usable image data. 'headerList' is the list of headers the record was made with. """
+		if stat is None: stat = os.stat(path)
+		if fingerprint is None: fingerprint = fileFingerprint(path, stat.st_size)
+		self.entries[path] = {
+			'mtime': stat.st_mtime,
+			'size': stat.st_size,
+			'fingerprint': fingerprint,
+			'record': record,
+			'headerList': headerList
+		}
+
+	def getRecord(self, path):
+		return self.entries[path]['record']
+
+	def getFingerprint(self, path):
+		return self.entries[path]['fingerprint']
+
+	def headerListChanged(self, path, headerList):
+		""" True if the record of a file was made with a different list of headers. For entries made before the list was stored, or seeded from an old metadata file, the headers in the record are compared with the list. """
+		entry = self.entries[path]
+		if entry.get('headerList') is not None: return entry['headerList'] != headerList
+		recordHeaders = None
+		if entry['record'] is not None and 'headers' in entry['record']: recordHeaders = list(entry['record']['headers'].keys())
+		if headerList is None: return recordHeaders is not None
+		return recordHeaders is None or set(recordHeaders) != set(headerList)
+
+	def fingerprints(self):
+		return set([ entry['fingerprint'] for entry in self.entries.values() ])
+
+	def remove(self, path):
+		del self.entries[path]
+
+	def deletedFiles(self, currentPaths):
+		""" Returns the indexed paths that are not in 'currentPaths' (which should be a set). """
+		return [ p for p in self.entries if p not in currentPaths ]
@@ -0,0 +1,212 @@
+""" Writes the imageMetadata.js file that index.html reads. Records are batched up and the file is only re-written every so often, and always atomically, so that the web page never sees a half-written file during its auto-refresh. Large folders are split into chunks: the main file holds the first chunk and the names of the others (imageMetadata_1.js, imageMetadata_2.js...), which the page loads after it has shown the first page of images.
+
+Every change to the list of records is also given a sequence number and published in a small change feed (imageChanges.js). The main file records the sequence number it is up to date with, so that an open page can poll the feed and apply just the changes since then instead of reloading everything. The search index for the page (see searchIndex.py) is kept up to date here as well.
+
+With compact=True the records in the main file and the chunk files are written in the column-oriented form of compactMetadata.py, which index.html decodes. With gzipped=True a gzipped copy of each file is written next to it (imageMetadata.js.gz...), for web servers that can send precompressed files (nginx's gzip_static, Apache's MultiViews). The page loads the plain files when it is opened from disk. """
+
+import os, json, time, gzip
+import searchIndex, compactMetadata
+
+def chunkFilename(filename, chunk):
+	""" imageMetadata.js -> imageMetadata_<chunk>.js """
+	root, extension = os.path.splitext(filename)
+	return "%s_%d%s"%(root, chunk, extension)
+
+def writeAtomically(filename, text, gzipped=False):
+	""" Writes to a temporary name in the same folder and renames it into place. With 'gzipped' a gzipped copy is written as well, and without it any gzipped copy left from an earlier run is deleted, so that a web server never sends one that is out of date. The gzipped copy is written first, so it is never older than the plain file. Nothing is written if the files already hold 'text', so a run with nothing new leaves them (and the copies web browsers have cached) alone. """
+	if os.path.exists(filename) and gzipped == os.path.exists(filename + ".gz"):
+		jsFile = open(filename, 'rt')
+		unchanged = jsFile.read() == text
+		jsFile.close()
+		if unchanged: return
+	if gzipped:
+		tempFilename = filename + ".gz.tmp"
+		gzFile = open(tempFilename, 'wb')
+		# No name or time in the gzip header, so that the same text always gives the same file
+		compressed = gzip.GzipFile(filename='', mode='wb', fileobj=gzFile, mtime=0)
+		compressed.write(text.encode('utf-8'))
+		compressed.close()
+		gzFile.close()
+		os.rename(tempFilename, filename + ".gz")
+	elif os.path.exists(filename + ".gz"):
+		os.remove(filename + ".gz")
+	tempFilename = filename + ".tmp"
+	jsFile = open(tempFilename, 'wt')
+	jsFile.write(text)
+	jsFile.close()
+	os.rename(tempFilename, filename)
+
+def recordsJSON(jsonData, compact=False):
+	""" The records as JSON, in the compact form if 'compact' is set """
+	if compact: return json.dumps(compactMetadata.encode(jsonData), separators=(',', ':'))
+	return json.dumps(jsonData, sort_keys=False)
+
+def recordsFromJSON(text):
+	""" The list of records in JSON written by recordsJSON, in either form """
+	jsonData = json.loads(text)
+	if compactMetadata.isCompact(jsonData): return compactMetadata.decode(jsonData)
+	return jsonData
+
+def writeChunkFile(filename, chunk, jsonData, compact=False, gzipped=False):
+	writeAtomically(chunkFilename(filename, chunk), "metadataChunkLoaded(%d, %s);\n"%(chunk, recordsJSON(jsonData, compact)), gzipped)
+
+def writeJSONFile(filename, titleString, jsonData, chunkSize=0, dirtyFrom=0, version=None, generation=None, compact=False, gzipped=False):
+	""" Writes the metadata file. If 'chunkSize' is set, only the first 'chunkSize' records go in the main file and the rest in chunk files. Chunk files before the one holding record 'dirtyFrom' are assumed to be up to date already and are not re-written. 'version' and 'generation' identify the point in the change feed that the file corresponds to. With 'compact' the records are written in columns (see compactMetadata.py), in the main file as compactImages instead of allImages. """
+	chunks = [ jsonData ]
+	if chunkSize > 0 and len(jsonData) > chunkSize:
+		chunks = [ jsonData[i:i + chunkSize] for i in range(0, len(jsonData), chunkSize) ]
+	firstDirty = 1
+	if chunkSize > 0: firstDirty = max(1, dirtyFrom // chunkSize)
+	# The chunk files are written first, so that the main file never points at one that does not exist yet
+	for chunk in range(firstDirty, len(chunks)): writeChunkFile(filename, chunk, chunks[chunk], compact, gzipped)
+	chunkNames = [ os.path.basename(chunkFilename(filename, c)) for c in range(1, len(chunks)) ]
+	text = 'var title= "%s";\n'%titleString
+	if compact: text+= "var compactImages= " + recordsJSON(chunks[0], compact) + ";\n"
+	else: text+= "var allImages= " + recordsJSON(chunks[0]) + ";\n"
+	text+= "var metadataChunks= " + json.dumps(chunkNames) + ";\n"
+	text+= "var totalImages= %d;\n"%len(jsonData)
+	if version is not None:
+		text+= "var metadataVersion= %d;\n"%version
+		text+= 'var metadataGeneration= "%s";\n'%generation
+	writeAtomically(filename, text, gzipped)
+	removeChunkFiles(filename, len(chunks))
+
+def removeChunkFiles(filename, first):
+	""" Deletes the chunk files numbered 'first' and up, left over from when there were more records """
+	chunk = max(1, first)
+	while os.path.exists(chunkFilename(filename, chunk)):
+		os.remove(chunkFilename(filename, chunk))
+		if os.path.exists(chunkFilename(filename, chunk) + ".gz"): os.remove(chunkFilename(filename, chunk) + ".gz")
+		chunk+= 1
+
+def changesFilename(filename):
+	return os.path.join(os.path.dirname(filename), "imageChanges.js")
+
+def writeChangesFile(filename, feed, gzipped=False):
+	writeAtomically(filename, "metadataChangesLoaded(%s);\n"%json.dumps(feed, sort_keys=False), gzipped)
+
+def readChangesFile(filename):
+	""" Returns the change feed in an imageChanges.js file, or None if there isn't a readable one """
+	if not os.path.exists(filename): return None
+	feedFile = open(filename, 'rt')
+	text = feedFile.read().strip()
+	feedFile.close()
+	try:
+		return json.loads(text[len("metadataChangesLoaded("):-2])
+	except ValueError as e:
+		print("WARNING: Could not read the change feed %s (%s). Starting a new one."%(filename, e))
+		return None
+
+def readJSONFile(filename):
+	""" Reads the list of image records back out of an imageMetadata.js file and its chunk files, in either form. """
+	jsonData = []
+	chunkNames = []
+	jsFile = open(filename, 'rt')
+	for line in jsFile:
+		if line.startswith("var allImages= "):
+			jsonData = recordsFromJSON(line[len("var allImages= "):-2])
+		if line.startswith("var compactImages= "):
+			jsonData = recordsFromJSON(line[len("var compactImages= "):-2])
+		if line.startswith("var metadataChunks= "):
+			chunkNames = json.loads(line[len("var metadataChunks= "):-2])
+	jsFile.close()
+	folder = os.path.dirname(filename)
+	for chunkName in chunkNames:
+		chunkFile = open(os.path.join(folder, chunkName), 'rt')
+		line = chunkFile.read().strip()
+		chunkFile.close()
+		jsonData.extend(recordsFromJSON(line[line.index(",") + 1:-2]))
+	return jsonData
+
+class metadataWriter:
+	def __init__(self, filename, titleString, jsonData, flushCount=20, flushInterval=10.0, chunkSize=0, feedLength=1000, compact=False, gzipped=False, debug=False):
+		""" 'flushCount' is the number of new records and 'flushInterval' the number of seconds after which the file is re-written. 'chunkSize' is the number of records in each chunk file, or 0 to write them all to the one file. 'feedLength' is the number of changes kept in the change feed. Pages that are further behind than that reload everything. 'compact' and 'gzipped' choose the form of the files, as described above. """
+		self.filename = filename
+		self.titleString = titleString
+		self.jsonData = jsonData
+		self.flushCount = flushCount
+		self.flushInterval = flushInterval
+		self.chunkSize = chunkSize
+		self.compact = compact
+		self.gzipped = gzipped
+		self.debug = debug
+		self.pending = 0
+		self.dirtyFrom = 0
+		self.lastFlush = time.time()
+		self.feedLength = feedLength
+		self.changesFilename = changesFilename(filename)
+		self.pendingChanges = []
+		self.loadFeed()
+		self.search = searchIndex.searchIndex(jsonData)
+		self.searchFilename = searchIndex.searchFilename(filename)
+		self.searchChanged = True
+
+	def loadFeed(self):
+		""" Carries on from the existing change feed. The first changes are the differences between the records already published and 'jsonData'. """
+		feed = readChangesFile(self.changesFilename)
+		if feed is None:
+			feed = { 'generation': "%.3f"%time.time(), 'version': 0, 'changes': [] }
+		self.generation = feed['generation']
+		self.version = feed['version']
+		self.changes = feed['changes']
+		if not os.path.exists(self.filename): return
+		published = {}
+		for record in readJSONFile(self.filename): published[record['sourceFilename']] = record
+		current = {}
+		for record in self.jsonData: current[record['sourceFilename']] = record
+		for name in sorted(published.keys()):
+			if current.get(name) != published[name]: self.pendingChanges.append(('remove', name))
+		for record in self.jsonData:
+			if published.get(record['sourceFilename']) != record: self.pendingChanges.append(('add', record))
+		if len(self.pendingChanges) > 0: self.pending+= 1
+
+	def append(self, record):
+		""" Adds a record. Returns True if this caused the file to be written. """
+		if self.pending == 0: self.dirtyFrom = len(self.jsonData)
+		self.dirtyFrom = min(self.dirtyFrom, len(self.jsonData))
+		self.jsonData.append(record)
+		self.pendingChanges.append(('add', record))
+		self.search.add(record)
+		self.searchChanged = True
+		self.pending+= 1
+		if self.pending >= self.flushCount or (time.time() - self.lastFlush) >= self.flushInterval:
+			self.flush()
+			return True
+		return False
+
+	def remove(self, record):
+		""" Removes a record that is being replaced, e.g. because its source file was modified """
+		if record in self.jsonData:
+			position = self.jsonData.index(record)
+			if self.pending == 0: self.dirtyFrom = position
+			self.dirtyFrom = min(self.dirtyFrom, position)
+			del self.jsonData[position]
+			self.pendingChanges.append(('remove', record['sourceFilename']))
+			self.search.remove(record['sourceFilename'])
+			self.searchChanged = True
+			self.pending+= 1
+
+	def flush(self):
+		if self.debug: print("Writing %d records (%d new) to %s"%(len(self.jsonData), self.pending, self.filename))
+		# The feed is written before the metadata file, so a page is never told it is up to date with a version that isn't in the feed yet
+		if len(self.pendingChanges) > 0 or not os.path.exists(self.changesFilename): self.publishChanges()
+		if self.searchChanged:
+			writeAtomically(self.searchFilename, "searchIndexLoaded(%s);\n"%json.dumps(self.search.asDict(), sort_keys=False), self.gzipped)
+			self.searchChanged = False
+		writeJSONFile(self.filename, self.titleString, self.jsonData, self.chunkSize, self.dirtyFrom, self.version, self.generation, self.compact, self.gzipped)
+		self.pending = 0
+		self.dirtyFrom = len(self.jsonData)
+		self.lastFlush = time.time()
+
+	def publishChanges(self):
+		for action, item in self.pendingChanges:
+			self.version+= 1
+			self.changes.append([self.version, action, item])
+		self.pendingChanges = []
+		self.changes = self.changes[-self.feedLength:]
+		oldest = self.version + 1
+		if len(self.changes) > 0: oldest = self.changes[0][0]
+		writeChangesFile(self.changesFilename, { 'generation': self.generation, 'version': self.version, 'oldest': oldest, 'changes': self.changes }, self.gzipped)
+
+	def close(self):
+		if self.pending > 0: self.flush()
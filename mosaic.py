@@ -0,0 +1,107 @@
+""" Stitches the image extensions of multi-CCD cameras into a single downsampled mosaic.
+
+A layout function takes the shapes of the (already downsampled) tiles and returns the shape of the mosaic and a placement (row, column, rotation) for each tile, where rotation is the number of times the tile is turned by 90 degrees with numpy.rot90 before it is placed. """
+
+import math, numpy
+
+def placedShape(shape, rotation):
+	""" The shape of a tile after it has been rotated """
+	if rotation % 2 == 1: return (shape[1], shape[0])
+	return (shape[0], shape[1])
+
+def rotateLayout(mosaicShape, shapes, placements, rotation):
+	""" Turns a whole layout by 'rotation' x 90 degrees, so that the tiles can be written straight to their final positions. Only rotations of 0 and 180 degrees are supported. """
+	if rotation % 4 == 0: return mosaicShape, placements
+	if rotation % 4 != 2: raise ValueError("Only 180 degree rotations of a mosaic are supported.")
+	height, width = mosaicShape
+	rotated = []
+	for shape, (row, column, tileRotation) in zip(shapes, placements):
+		tileHeight, tileWidth = placedShape(shape, tileRotation)
+		rotated.append((height - row - tileHeight, width - column - tileWidth, (tileRotation + 2) % 4))
+	return mosaicShape, rotated
+
+def wfcLayout(shapes):
+	""" The four CCDs of the INT Wide Field Camera. CCD2 lies on its side to the left of the column made by CCDs 3, 4 and 1. """
+	height, width = shapes[0]
+	mosaicShape = (3 * width, width + height)
+	placements = [
+		(2 * width, width, 3),     # CCD1
+		(width, 0, 0),             # CCD2
+		(0, width, 3),             # CCD3
+		(width, width, 3)          # CCD4
+	]
+	return rotateLayout(mosaicShape, shapes, placements, 2)
+
+def stackedLayout(shapes):
+	""" All of the tiles side by side, or one above the other if that makes a squarer image """
+	totalWidth = sum([ s[1] for s in shapes ])
+	totalHeight = sum([ s[0] for s in shapes ])
+	placements = []
+	if totalWidth<totalHeight:
+		column = 0
+		for s in shapes:
+			placements.append((0, column, 0))
+			column+= s[1]
+		return (max([ s[0] for s in shapes ]), totalWidth), placements
+	row = 0
+	for s in shapes:
+		placements.append((row, 0, 0))
+		row+= s[0]
+	return (totalHeight, max([ s[1] for s in shapes ])), placements
+
+def gridLayout(shapes, columns=None):
+	""" The tiles in a grid, filled a row at a time. By default the grid is as close to square as possible. """
+	if columns is None: columns = int(math.ceil(math.sqrt(len(shapes))))
+	rows = int(math.ceil(len(shapes) / float(columns)))
+	rowHeights = [0] * rows
+	columnWidths = [0] * columns
+	for num, s in enumerate(shapes):
+		rowHeights[num // columns] = max(rowHeights[num // columns], s[0])
+		columnWidths[num % columns] = max(columnWidths[num % columns], s[1])
+	placements = []
+	for num, s in enumerate(shapes):
+		placements.append((sum(rowHeights[:num // columns]), sum(columnWidths[:num % columns]), 0))
+	return (sum(rowHeights), sum(columnWidths)), placements
+
+layouts = {
+	'wfc': wfcLayout,
+	'stacked': stackedLayout,
+	'grid': gridLayout
+}
+
+def chooseLayout(headers, shapes, layout='auto'):
+	""" Returns the layout function to use. With 'auto' the WFC preset is used for four equal WFC extensions and everything else is stacked. """
+	if layout != 'auto': return layouts[layout]
+	instrument = str(headers.get('INSTRUME', '')).strip().upper()
+	if instrument.startswith('WFC') and len(shapes)==4 and len(set(shapes))==1:
+		print "Instrument detected:", headers['INSTRUME']
+		return wfcLayout
+	return stackedLayout
+
+def reducedShape(shape, factor):
+	return (shape[0] // factor, shape[1] // factor)
+
+def blockReduce(imageData, factor, out=None):
+	""" Averages the array over factor x factor blocks, optionally straight into 'out'. Rows and columns that don't fill a whole block are dropped. """
+	height, width = reducedShape(numpy.shape(imageData), factor)
+	blocks = imageData[:height * factor, :width * factor].reshape(height, factor, width, factor)
+	return blocks.mean(axis=(1, 3), dtype=numpy.float32, out=out)
+
+class mosaicBuilder:
+	def __init__(self, shapes, layoutFunction, factor=4, debug=False):
+		""" Prepares a float32 mosaic for extensions of the given (full-size) shapes, each shrunk by 'factor'. Anything not covered by a tile is NaN. """
+		self.factor = factor
+		self.debug = debug
+		self.tileShapes = [ reducedShape(s, factor) for s in shapes ]
+		self.shape, self.placements = layoutFunction(self.tileShapes)
+		if self.debug: print "Mosaic of %d tiles, shape %s"%(len(shapes), str(self.shape))
+		self.image = numpy.empty(self.shape, dtype=numpy.float32)
+		self.image.fill(numpy.nan)
+
+	def addTile(self, num, imageData, step=1):
+		""" Shrinks one extension directly into its place in the mosaic. 'step' is how much the data has been shrunk by already, and must divide the mosaic factor. """
+		row, column, rotation = self.placements[num]
+		tileHeight, tileWidth = placedShape(self.tileShapes[num], rotation)
+		target = self.image[row:row + tileHeight, column:column + tileWidth]
+		blockReduce(imageData, self.factor // step, out=numpy.rot90(target, -rotation))
+		if self.debug: print "Placed tile %d at (%d, %d), rotated %d times"%(num, row, column, rotation)
@@ -0,0 +1,114 @@
+""" Remembers which images (full-size, preview and thumbnail) were made from each FITS file, from which version of the file and with which render settings. Only the images whose source or settings have changed since they were made need to be made again, and images that are no longer needed are deleted. """
+
+import os, json
+
+outputKinds = ['image', 'preview', 'thumbnail']
+
+def renderParameters(options):
+	""" Returns the settings that each kind of output depends on, as a string per kind. Only the kinds that are switched on are included. """
+	imageParameters = "lo=%s hi=%s tolerance=%s layout=%s"%(options['stretchLo'], options['stretchHi'], options['stretchTolerance'], options['mosaicLayout'])
+	thumbnailParameters = imageParameters + " size=%d"%options['thumbnailSize']
+	# The PNG compression level doesn't change the pixels, so PNGs are not made again when it changes. Lossy formats depend on their quality.
+	if options['imageFormat'] != 'png': imageParameters+= " format=%s quality=%d"%(options['imageFormat'], options['imageQuality'])
+	parameters = { 'image': imageParameters }
+	if options['previewSize'] > 0: parameters['preview'] = imageParameters + " size=%d"%options['previewSize']
+	parameters['thumbnail'] = thumbnailParameters
+	return parameters
+
+class renderCache:
+	def __init__(self, filename, webPath, debug=False):
+		""" Output filenames are stored relative to 'webPath' """
+		self.filename = filename
+		self.webPath = webPath
+		self.debug = debug
+		self.entries = {}
+		self.existed = False
+		self.savedText = None
+		self.hits = 0
+		self.misses = 0
+		self.evicted = 0
+		self.load()
+
+	def load(self):
+		if not os.path.exists(self.filename): return False
+		try:
+			cacheFile = open(self.filename, 'rt')
+			self.savedText = cacheFile.read()
+			cacheFile.close()
+			self.entries = json.loads(self.savedText)
+			self.existed = True
+		except ValueError as e:
+			print("WARNING: Could not read the render cache %s (%s). Starting a new one."%(self.filename, e))
+			self.entries = {}
+			return False
+		return True
+
+	def save(self):
+		""" Writes the cache, unless it is the same as the file already holds """
+		text = json.dumps(self.entries, sort_keys=True)
+		if text == self.savedText: return
+		tempFilename = self.filename + ".tmp"
+		cacheFile = open(tempFilename, 'wt')
+		cacheFile.write(text)
+		cacheFile.close()
+		os.rename(tempFilename, self.filename)
+		self.savedText = text
+
+	def staleOutputs(self, path, outputFilenames, fingerprint, parameters, force=False):
+		""" Returns the kinds of output in 'outputFilenames' (kind -> filename) that have to be made (again) for a source file """
+		stale = []
+		entry = self.entries.get(path)
+		for kind in outputKinds:
+			if kind not in outputFilenames: continue
+			output = None
+			if entry is not None and entry['fingerprint'] == fingerprint: output = entry['outputs'].get(kind)
+			filenames = [ outputFilenames[kind] ]
+			# An image no bigger than a preview is its own preview. That only changes with the file or the preview size, which are checked here as well.
+			if kind == 'preview' and 'image' in outputFilenames: filenames.append(outputFilenames['image'])
+			if force or output is None or output['filename'] not in filenames or output['parameters'] != parameters[kind] or not os.path.exists(self.webPath + "/" + output['filename']):
+				stale.append(kind)
+		return stale
+
+	def countResults(self, outputFilenames, stale):
+		""" Adds the outcome of a staleOutputs check to the hit and miss counts """
+		self.misses+= len(stale)
+		self.hits+= len(outputFilenames) - len(stale)
+
+	def adopt(self, path, fingerprint, outputFilenames, parameters):
+		""" Records the outputs that already exist on disk as up to date, for folders made before there was a render cache """
+		if path in self.entries: return
+		made = [ kind for kind in outputFilenames if os.path.exists(self.webPath + "/" + outputFilenames[kind]) ]
+		self.update(path, fingerprint, outputFilenames, made, parameters)
+
+	def update(self, path, fingerprint, outputFilenames, made, parameters):
+		""" Records the outputs of kinds in 'made' as up to date. Outputs of the file made earlier under a different name are deleted. """
+		entry = self.entries.get(path)
+		if entry is None or entry['fingerprint'] != fingerprint:
+			oldOutputs = {}
+			if entry is not None: oldOutputs = entry['outputs']
+			entry = { 'fingerprint': fingerprint, 'outputs': {} }
+			# Outputs that are kept under the same filename are simply overwritten
+			for kind, output in oldOutputs.items():
+				if output['filename'] in outputFilenames.values(): continue
+				self.evict(output['filename'])
+			self.entries[path] = entry
+		for kind in made:
+			old = entry['outputs'].get(kind)
+			if old is not None and old['filename'] not in outputFilenames.values(): self.evict(old['filename'])
+			entry['outputs'][kind] = { 'filename': outputFilenames[kind], 'parameters': parameters[kind] }
+
+	def remove(self, path):
+		""" Forgets a source file that has gone and deletes its outputs """
+		entry = self.entries.pop(path, None)
+		if entry is None: return
+		for output in entry['outputs'].values(): self.evict(output['filename'])
+
+	def evict(self, filename):
+		fullFilename = self.webPath + "/" + filename
+		if os.path.exists(fullFilename):
+			if self.debug: print("Deleting obsolete output %s"%fullFilename)
+			os.remove(fullFilename)
+			self.evicted+= 1
+
+	def summary(self):
+		return "Render cache: %d hits, %d misses, %d obsolete images deleted."%(self.hits, self.misses, self.evicted)
@@ -0,0 +1,119 @@
+""" Runs a series of files through three stages at once, so that reading file N+1 from disk overlaps with working on file N and with compressing the images of file N-1. Loading runs in an I/O thread, the compute stage in the calling thread and encoding in an encode thread. The queues between the stages are bounded, and a memory budget holds back the I/O thread while the files already in the pipeline hold too many bytes, so the memory used stays flat however big the frames are and however many files are waiting. The files come out in the order they went in. """
+
+import threading
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+class memoryBudget:
+	""" Counts the bytes held by the files in the pipeline. wait() holds back a new file while the budget is used up, but a file is always let in when the pipeline is empty, so a frame bigger than the whole budget is still rendered, on its own. """
+	def __init__(self, limit):
+		self.limit = limit
+		self.used = 0
+		self.peak = 0
+		self.condition = threading.Condition()
+
+	def wait(self):
+		with self.condition:
+			while self.used > 0 and self.used >= self.limit: self.condition.wait()
+
+	def add(self, size):
+		with self.condition:
+			self.used+= size
+			self.peak = max(self.peak, self.used)
+			if size < 0: self.condition.notify_all()
+
+	def release(self, size):
+		self.add(-size)
+
+end = object()
+
+class stagedPipeline:
+	def __init__(self, load, compute, encode, size=None, depth=2, budget=None):
+		""" 'load', 'compute' and 'encode' each take the state of a file and return its new state (load takes the item itself). 'size' gives the bytes held by a state, for the budget. 'depth' is how many files can wait between two stages. 'budget' is a memoryBudget, or None for no limit. An exception in a stage is passed on with the file, and its later stages are skipped. """
+		self.load = load
+		self.compute = compute
+		self.encode = encode
+		self.size = size
+		if self.size is None: self.size = lambda state: 0
+		self.depth = max(1, depth)
+		self.budget = budget
+		if self.budget is None: self.budget = memoryBudget(float('inf'))
+
+	def loader(self, toLoad, loaded):
+		while True:
+			item = toLoad.get()
+			if item is end: break
+			self.budget.wait()
+			state, error = self.runStage(self.load, item)
+			size = self.size(state)
+			self.budget.add(size)
+			loaded.put((item, state, error, size))
+		loaded.put(end)
+
+	def encoder(self, toEncode, encoded):
+		while True:
+			task = toEncode.get()
+			if task is end: break
+			item, state, error, size = task
+			if error is None: state, error = self.runStage(self.encode, state)
+			self.budget.release(size)
+			encoded.put((item, state, error))
+		encoded.put(end)
+
+	def runStage(self, stage, state):
+		try:
+			return stage(state), None
+		except Exception as e:
+			return state, e
+
+	def run(self, items):
+		""" Yields (item, state, error) for each of 'items', in order, where 'error' is the exception raised by a stage, or None. 'items' is only read from the calling thread. """
+		toLoad = queue.Queue()
+		loaded = queue.Queue(self.depth)
+		toEncode = queue.Queue(self.depth)
+		encoded = queue.Queue()
+		threads = [ threading.Thread(target=self.loader, args=(toLoad, loaded)), threading.Thread(target=self.encoder, args=(toEncode, encoded)) ]
+		for t in threads:
+			t.daemon = True
+			t.start()
+		items = iter(items)
+		waiting = 0
+		finished = False
+		try:
+			while True:
+				# Keep the I/O thread a few files ahead of the compute stage
+				while not finished and waiting < self.depth:
+					try:
+						item = next(items)
+					except StopIteration:
+						finished = True
+						toLoad.put(end)
+						break
+					toLoad.put(item)
+					waiting+= 1
+				if waiting == 0: break
+				item, state, error, size = loaded.get()
+				waiting-= 1
+				if error is None:
+					state, error = self.runStage(self.compute, state)
+					newSize = self.size(state)
+					self.budget.add(newSize - size)
+					size = newSize
+				toEncode.put((item, state, error, size))
+				while True:
+					try:
+						result = encoded.get_nowait()
+					except queue.Empty:
+						break
+					yield result
+			toEncode.put(end)
+			while True:
+				result = encoded.get()
+				if result is end: break
+				yield result
+		finally:
+			# If the caller stops early, let the threads finish what they have and stop
+			if not finished: toLoad.put(end)
+			toEncode.put(end)
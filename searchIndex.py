@@ -0,0 +1,59 @@
+""" An inverted index of the image records, written next to imageMetadata.js as imageSearch.js so that the search box in index.html does not have to scan the headers of every image on every key press. Each header field (and the filename, as the field 'filename') maps its lower-case words to the images that contain them. Fields whose values are all numbers also get a sorted list of (value, image) pairs for range queries such as EXPTIME>30. """
+
+import os
+
+def isNumber(value):
+	return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def words(value):
+	return set(("%s"%(value,)).lower().split())
+
+def recordFields(record):
+	""" Returns the (field, value) pairs of a record that are searched """
+	fields = [ ('filename', record['sourceFilename']) ]
+	headers = record.get('headers')
+	if headers is not None: fields.extend(headers.items())
+	return fields
+
+class searchIndex:
+	def __init__(self, records=[]):
+		self.records = {}
+		self.words = {}
+		self.numbers = {}
+		self.textFields = set()
+		for record in records: self.add(record)
+
+	def add(self, record):
+		name = record['sourceFilename']
+		if name in self.records: self.remove(name)
+		self.records[name] = record
+		for field, value in recordFields(record):
+			fieldWords = self.words.setdefault(field, {})
+			for word in words(value): fieldWords.setdefault(word, set()).add(name)
+			if isNumber(value): self.numbers.setdefault(field, {})[name] = value
+			else: self.textFields.add(field)
+
+	def remove(self, name):
+		record = self.records.pop(name, None)
+		if record is None: return
+		for field, value in recordFields(record):
+			fieldWords = self.words[field]
+			for word in words(value):
+				fieldWords[word].discard(name)
+				if len(fieldWords[word]) == 0: del fieldWords[word]
+			if field in self.numbers: self.numbers[field].pop(name, None)
+
+	def asDict(self):
+		""" The index as written for the web page. Images are referred to by their position in 'names'. """
+		names = sorted(self.records.keys())
+		ids = dict([ (name, i) for i, name in enumerate(names) ])
+		fields = {}
+		for field, fieldWords in self.words.items():
+			if len(fieldWords) == 0: continue
+			fields[field] = { 'words': dict([ (word, sorted([ ids[n] for n in fieldNames ])) for word, fieldNames in fieldWords.items() ]) }
+			if field not in self.textFields and field in self.numbers:
+				fields[field]['values'] = sorted([ [value, ids[n]] for n, value in self.numbers[field].items() ])
+		return { 'names': names, 'fields': fields }
+
+def searchFilename(filename):
+	return os.path.join(os.path.dirname(filename), "imageSearch.js")
@@ -0,0 +1,99 @@
+""" Keeps track of the time spent in each stage of a fitsBrowser run (loading, stretching, PNG encoding, writing the metadata...), and of the bytes written by the stages that write images """
+
+import os, time, json
+
+class stageTimer:
+	def __init__(self):
+		self.totals = {}
+		self.counts = {}
+		self.maximums = {}
+		self.order = []
+		self.bytes = {}
+		self.fileTimes = {}
+
+	def add(self, stage, seconds):
+		if stage not in self.totals:
+			self.order.append(stage)
+			self.totals[stage] = 0.
+			self.counts[stage] = 0
+			self.maximums[stage] = 0.
+		self.totals[stage]+= seconds
+		self.counts[stage]+= 1
+		self.maximums[stage] = max(self.maximums[stage], seconds)
+
+	def addBytes(self, stage, count):
+		self.bytes[stage] = self.bytes.get(stage, 0) + count
+
+	def fileStats(self):
+		""" The stage times of this timer (stage -> seconds), with the bytes written by each stage under 'bytes' if there are any. This is the form merge() takes. """
+		stats = dict(self.totals)
+		if len(self.bytes) > 0: stats['bytes'] = dict(self.bytes)
+		return stats
+
+	def merge(self, times, filename=None):
+		""" Adds the stage times of one file, as given by fileStats(), e.g. from a worker process. They are kept for the stats file if a filename is given. """
+		for stage in sorted(times.keys()):
+			if stage != 'bytes': self.add(stage, times[stage])
+		for stage, count in times.get('bytes', {}).items(): self.addBytes(stage, count)
+		if filename is not None: self.fileTimes[filename] = times
+
+	def stage(self, name):
+		""" Returns a context manager that times the code inside a 'with' block as stage 'name' """
+		return timedStage(self, name)
+
+	def asDict(self):
+		stages = {}
+		for s in self.order:
+			stages[s] = { 'total': self.totals[s], 'count': self.counts[s], 'mean': self.totals[s] / self.counts[s], 'max': self.maximums[s] }
+			if s in self.bytes: stages[s]['bytes'] = self.bytes[s]
+		return stages
+
+	def summary(self):
+		""" Returns a table of the time spent in each stage """
+		grandTotal = sum(self.totals.values())
+		lines = [ "%-14s %8s %10s %10s %10s %6s"%("Stage", "Calls", "Total (s)", "Mean (ms)", "Max (ms)", "%") ]
+		for s in self.order:
+			percent = 0.
+			if grandTotal > 0: percent = 100. * self.totals[s] / grandTotal
+			lines.append("%-14s %8d %10.2f %10.1f %10.1f %6.1f"%(s, self.counts[s], self.totals[s], 1000. * self.totals[s] / self.counts[s], 1000. * self.maximums[s], percent))
+		if len(self.bytes) > 0: lines.append(self.outputSummary())
+		return "\n".join(lines)
+
+	def outputSummary(self):
+		""" Returns a table of the size and encoding speed of the images written by each stage that counts its bytes, e.g. one per kind of image and format """
+		lines = [ "%-14s %8s %10s %10s %10s %8s"%("Output", "Files", "Size (MB)", "Mean (KB)", "Mean (ms)", "MB/s") ]
+		for s in self.order:
+			if s not in self.bytes: continue
+			megabytes = self.bytes[s] / 1048576.
+			rate = 0.
+			if self.totals[s] > 0: rate = megabytes / self.totals[s]
+			lines.append("%-14s %8d %10.2f %10.1f %10.1f %8.1f"%(s, self.counts[s], megabytes, self.bytes[s] / 1024. / self.counts[s], 1000. * self.totals[s] / self.counts[s], rate))
+		return "\n".join(lines)
+
+class timedStage:
+	def __init__(self, timer, name):
+		self.timer = timer
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.timer.add(self.name, time.time() - self.start)
+		return False
+
+def writeStatsFile(filename, timer, wallTime):
+	""" Writes the timings of a run as JSON, with the stage times of each file that was processed """
+	stats = {
+		'finished': time.strftime("%Y-%m-%d %H:%M:%S"),
+		'wallTime': wallTime,
+		'files': len(timer.fileTimes),
+		'stages': timer.asDict(),
+		'fileTimes': timer.fileTimes
+	}
+	tempFilename = filename + ".tmp"
+	statsFile = open(tempFilename, 'wt')
+	json.dump(stats, statsFile, indent = 4)
+	statsFile.close()
+	os.rename(tempFilename, filename)
@@ -0,0 +1,4 @@
+import os, sys
+
+# The modules live in the top folder of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
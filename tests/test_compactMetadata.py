@@ -0,0 +1,57 @@
+import json
+import compactMetadata, metadataWriter, fitsBrowser
+
+def makeRecords(count):
+	records = []
+	for i in range(count):
+		sourceFilename = "night%d/frame%03d.fits"%(i % 2, i)
+		record = { 'pngFilename': fitsBrowser.imageFilename(sourceFilename, extension="webp"), 'thumbnailFilename': fitsBrowser.imageFilename(sourceFilename, "thumb_"), 'sourceFilename': sourceFilename, 'xSize': 2048, 'ySize': 4096 + i, 'imageFormat': 'webp' }
+		record['headers'] = { 'OBJECT': "Field %d"%(i % 3), 'EXPTIME': 30.0 if i % 2 else 30, 'FILTER': None if i % 5 == 0 else 'r', 'SIMPLE': True, 'SEQNUM': i, 'MIXED': [ 1, "one", 1.5, None ][i % 4] }
+		records.append(record)
+	# Absent fields and headers, kept apart from null ones
+	del records[1]['pngFilename']
+	del records[2]['headers']['OBJECT']
+	del records[3]['headers']
+	records[4]['pngFilename'] = "images/elsewhere.webp"
+	records[6]['pngFilename'] = None
+	return records
+
+def roundTrip(records):
+	return metadataWriter.recordsFromJSON(metadataWriter.recordsJSON(records, compact=True))
+
+def test_roundTrip():
+	records = makeRecords(20)
+	assert roundTrip(records) == json.loads(json.dumps(records))
+
+def test_columnEncodings():
+	compact = compactMetadata.encode(makeRecords(20))
+	pngColumn = compact['columns']['pngFilename']
+	assert pngColumn['encoding'] == 'filename' and 'data' not in pngColumn
+	assert sorted(pngColumn['exceptions'].keys()) == [ '4', '6' ]
+	assert compact['columns']['thumbnailFilename']['encoding'] == 'filename'
+	assert compact['headerColumns']['OBJECT']['encoding'] == 'dictionary'
+	assert compact['headerColumns']['SIMPLE']['type'] == 'bool'
+	assert compact['headerColumns']['MIXED']['type'] == 'any'
+	assert compact['noHeaders'] == [ 3 ]
+
+def test_emptyAndSmall():
+	assert roundTrip([]) == []
+	assert roundTrip([ { 'sourceFilename': "a.fits" } ]) == [ { 'sourceFilename': "a.fits" } ]
+
+def test_newerVersionIsRejected():
+	compact = compactMetadata.encode(makeRecords(10))
+	compact['version'] = compactMetadata.formatVersion + 1
+	try:
+		compactMetadata.decode(compact)
+	except ValueError:
+		return
+	assert False, "A newer format was decoded"
+
+def test_compressedSourceNames():
+	""" a.fits, a.fits.gz and a.fits.fz get images of their own, and the names are still worked out from the source names """
+	names = [ "night/a.fits", "night/a.fits.gz", "night/a.fits.fz", "night/b.fits.FZ" ]
+	assert [ fitsBrowser.imageFilename(n, "thumb_") for n in names ] == [ "images/night/thumb_a.png", "images/night/thumb_a.fits.gz.png", "images/night/thumb_a.fits.fz.png", "images/night/thumb_b.fits.FZ.png" ]
+	records = [ { 'sourceFilename': n, 'thumbnailFilename': fitsBrowser.imageFilename(n, "thumb_") } for n in names ]
+	compact = compactMetadata.encode(records)
+	assert compact['columns']['thumbnailFilename']['exceptions'] == {}
+	assert roundTrip(records) == records
@@ -0,0 +1,94 @@
+import gzip, shutil, numpy
+from astropy.io import fits
+import compressedInput, fitsClasses
+
+def gzipCopy(filename):
+	source = open(filename, 'rb')
+	output = gzip.open(filename + ".gz", 'wb')
+	shutil.copyfileobj(source, output)
+	output.close()
+	source.close()
+	return filename + ".gz"
+
+def pixels(height, width, seed=1):
+	return numpy.random.RandomState(seed).randint(0, 60000, (height, width)).astype(numpy.uint16)
+
+def trimmed(data, step):
+	return data[:(data.shape[0] // step) * step:step, :(data.shape[1] // step) * step:step]
+
+def loadImage(filename, outputSize=None):
+	image = fitsClasses.fitsObject()
+	assert image.initFromFITSFile(filename.split("/")[-1], path=filename.rsplit("/", 1)[0], outputSize=outputSize)
+	return image.fullImage['data']
+
+def test_gzipReducedRead(tmpdir):
+	data = pixels(101, 203)
+	filename = str(tmpdir.join("single.fits"))
+	fits.PrimaryHDU(data).writeto(filename)
+	expected = fits.getdata(filename).astype(numpy.float32)
+	for step in [1, 2, 4]:
+		images = compressedInput.gzipImages(gzipCopy(filename))
+		headers, shape, stream = next(images)
+		numpy.testing.assert_array_equal(stream.read(step), trimmed(expected, step))
+
+def test_gzipMosaicWithBlank(tmpdir):
+	""" An odd-width mosaic with BLANK pixels gives the same image gzipped as uncompressed """
+	hdus = [ fits.PrimaryHDU() ]
+	for seed in [1, 2]:
+		data = (pixels(100, 203, seed) // 2).astype(numpy.int16)
+		data[10:20, 30:40] = -32768
+		hdus.append(fits.ImageHDU(data))
+	filename = str(tmpdir.join("mosaic.fits"))
+	fits.HDUList(hdus).writeto(filename)
+	# Scaled integers with BLANK, written without astropy rescaling the raw values
+	hdulist = fits.open(filename, mode='update', do_not_scale_image_data=True)
+	for hdu in hdulist[1:]: hdu.header.update([ ('BSCALE', 2.), ('BZERO', 10.), ('BLANK', -32768) ])
+	hdulist.close()
+	expected = loadImage(filename)
+	assert numpy.isnan(expected).any()
+	numpy.testing.assert_allclose(loadImage(gzipCopy(filename)), expected, rtol=1e-6)
+
+def test_tileReducedRead(tmpdir):
+	data = pixels(101, 203).astype(numpy.int16)
+	filename = str(tmpdir.join("single.fits.fz"))
+	fits.HDUList([ fits.PrimaryHDU(), fits.CompImageHDU(data) ]).writeto(filename)
+	hdulist = fits.open(filename)
+	for step in [2, 4]:
+		numpy.testing.assert_array_equal(compressedInput.readTileRows(hdulist[1], step), trimmed(hdulist[1].data, step).astype(numpy.float32))
+	hdulist.close()
+
+def test_tileReadFallsBack(tmpdir, monkeypatch):
+	""" Without the astropy internals the fast path needs, a .fz file is still read, in full """
+	data = pixels(101, 203).astype(numpy.int16)
+	filename = str(tmpdir.join("single.fits.fz"))
+	fits.HDUList([ fits.PrimaryHDU(), fits.CompImageHDU(data) ]).writeto(filename)
+	for error in [ AttributeError("'module' object has no attribute 'decompress_hdu'"), KeyError('ZNAXIS1'), ValueError("buffer is smaller than requested size") ]:
+		def unexpected(hdu, step): raise error
+		monkeypatch.setattr(compressedInput, 'readSelectedTiles', unexpected)
+		hdulist = fits.open(filename)
+		assert compressedInput.readTileRows(hdulist[1], 2) is None
+		hdulist.close()
+		numpy.testing.assert_array_equal(loadImage(filename, outputSize=50), data)
+
+def test_blankPixelsAreBlack(tmpdir):
+	""" BLANK pixels of a single image, and NaNs in a tile-compressed one, are shown as black rather than cast from NaN """
+	data = (pixels(60, 41) // 2).astype(numpy.int16)
+	data[10:20, 5:15] = -32768
+	filename = str(tmpdir.join("blank.fits"))
+	hdu = fits.PrimaryHDU(data)
+	hdu.header['BLANK'] = -32768
+	hdu.writeto(filename)
+	fzFilename = str(tmpdir.join("blank.fits.fz"))
+	floatData = data.astype(numpy.float32)
+	floatData[10:20, 5:15] = numpy.nan
+	fits.HDUList([ fits.PrimaryHDU(), fits.CompImageHDU(floatData) ]).writeto(fzFilename)
+	for name in [ filename, gzipCopy(filename), fzFilename ]:
+		image = fitsClasses.fitsObject()
+		assert image.initFromFITSFile(name.split("/")[-1], path=str(tmpdir))
+		image.readPixels()
+		assert numpy.isnan(image.fullImage['data']).any(), name
+		# Casting NaN to uint8 is undefined, so the NaNs must be gone before the 8-bit image is made
+		boosted = image.getBoostedImage()
+		assert not numpy.isnan(boosted).any() and (boosted[10:20, 5:15] == 0).all(), name
+		rendered = numpy.asarray(image.makeImages([ 'image' ])['image'])[::-1]
+		assert (rendered[10:20, 5:15] == 0).all(), name
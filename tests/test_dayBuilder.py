@@ -0,0 +1,42 @@
+import dayBuilder, fitsBrowser
+
+class fakeCatalogue:
+	def __init__(self):
+		self.nights = []
+	def commitNight(self, night, webPath):
+		self.nights.append(night)
+	def __len__(self):
+		return len(self.nights)
+
+def fakeBuilder(results):
+	""" A folderBuilder that returns the result given for each night, or raises it if it is an exception """
+	class builder:
+		def __init__(self, options, pool=None):
+			self.night = options['webPath'].rsplit("/", 1)[1]
+		def run(self):
+			result = results[self.night]
+			if isinstance(result, Exception): raise result
+			return result
+		def unlock(self):
+			pass
+		def assist(self):
+			return results[self.night]
+	return builder
+
+def nightResult(locked=False, errors=[]):
+	return { 'locked': locked, 'errors': errors, 'webPath': "web", 'processed': 0, 'images': 1, 'new': 1, 'modified': 0, 'deleted': 0, 'wallTime': 0.0 }
+
+def test_incompleteNightsFail(monkeypatch):
+	results = { '20261016': nightResult(), '20261017': nightResult(errors=[ ("bad.fits", "broken") ]), '20261018': nightResult(locked=True), '20261019': ValueError("no folder") }
+	monkeypatch.setattr(fitsBrowser, 'folderBuilder', fakeBuilder(results))
+	monkeypatch.setattr(fitsBrowser, 'folderOptions', lambda config, dataPath, webPath, title, debug: { 'webPath': webPath })
+	catalogue = fakeCatalogue()
+	failed = dayBuilder.buildArchive(sorted(results), None, "data", "web", catalogue, jobs=2)
+	assert failed == [ '20261017', '20261018', '20261019' ]
+	# A night with errors still goes in the catalogue, a locked one is left to the process holding the lock
+	assert sorted(catalogue.nights) == [ '20261016', '20261017' ]
+
+def test_nightComplete():
+	assert dayBuilder.nightComplete(nightResult())
+	assert not dayBuilder.nightComplete(nightResult(errors=[ ("bad.fits", "broken") ]))
+	assert not dayBuilder.nightComplete(nightResult(locked=True))
@@ -0,0 +1,47 @@
+import os, signal, multiprocessing
+import numpy
+from astropy.io import fits
+import fitsBrowser
+
+def buildFolder(tmpdir):
+	config = fitsBrowser.loadConfig()
+	options = fitsBrowser.folderOptions(config, dataPath=str(tmpdir.join("data")), webPath=str(tmpdir.join("web")), installPath=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), title="Test")
+	builder = fitsBrowser.folderBuilder(options)
+	result = builder.run()
+	builder.unlock()
+	return result, sorted([ r['sourceFilename'] for r in builder.writer.jsonData ])
+
+def test_failedFilesAreRetried(tmpdir, monkeypatch):
+	tmpdir.mkdir("data")
+	for name in [ "a.fits", "b.fits" ]: fits.PrimaryHDU(numpy.random.RandomState(1).normal(100, 10, (40, 40)).astype(numpy.float32)).writeto(str(tmpdir.join("data", name)))
+	makeImages = fitsBrowser.makeImages
+	def failingMakeImages(newImage, filename, *args):
+		if filename == "b.fits": raise IOError("disk full")
+		return makeImages(newImage, filename, *args)
+	monkeypatch.setattr(fitsBrowser, 'makeImages', failingMakeImages)
+	result, names = buildFolder(tmpdir)
+	assert [ path for path, error in result['errors'] ] == [ str(tmpdir.join("data", "b.fits")) ]
+	assert names == [ "a.fits" ]
+	monkeypatch.setattr(fitsBrowser, 'makeImages', makeImages)
+	result, names = buildFolder(tmpdir)
+	assert result['errors'] == [] and result['processed'] == 1 and result['new'] == 1
+	assert names == [ "a.fits", "b.fits" ]
+	result, names = buildFolder(tmpdir)
+	assert result['processed'] == 0 and names == [ "a.fits", "b.fits" ]
+
+def dyingWorker(job):
+	""" Renders like renderFITSFileWorker, except that the worker process is killed outright for c.fits """
+	if job[0] == "c.fits": os.kill(os.getpid(), signal.SIGKILL)
+	return (job[0], {}, None, None)
+
+def test_deadWorkerIsReported(monkeypatch):
+	""" A worker that dies without answering doesn't hang the run. Its file is reported as failed and the others still come back in order. """
+	monkeypatch.setattr(fitsBrowser, 'renderFITSFileWorker', dyingWorker)
+	pool = multiprocessing.Pool(processes=2)
+	try:
+		jobs = [ (name, None, (name, None, [], None), None) for name in [ "a.fits", "b.fits", "c.fits", "d.fits" ] ]
+		results = [ (p, result[0], result[2]) for p, fingerprint, job, result in fitsBrowser.renderInOrder(iter(jobs), pool, timeout=3) ]
+	finally:
+		pool.terminate()
+	assert [ (p, record) for p, record, error in results ] == [ ("a.fits", "a.fits"), ("b.fits", "b.fits"), ("c.fits", None), ("d.fits", "d.fits") ]
+	assert results[2][2].startswith("No result after 3 seconds")
@@ -0,0 +1,23 @@
+import os, re
+import folderWatcher
+
+search_re = re.compile(".*\.fits$")
+
+def touch(filename):
+	open(filename, 'w').write("data")
+
+def test_unknownFilesAreReported(tmpdir):
+	""" A file that is in the folder but not known (e.g. written while the first pass was running) is reported on the first check """
+	folder = os.path.realpath(str(tmpdir))
+	touch(folder + "/a.fits")
+	touch(folder + "/b.fits")
+	watcher = folderWatcher.folderWatcher(folder, search_re, pollInterval=0.01, settleTime=0, usePolling=True, isKnown=lambda p: p.endswith("a.fits"))
+	assert watcher.waitForFiles(1) == [ folder + "/b.fits" ]
+
+def test_newFilesAreReported(tmpdir):
+	folder = os.path.realpath(str(tmpdir))
+	touch(folder + "/a.fits")
+	watcher = folderWatcher.folderWatcher(folder, search_re, pollInterval=0.01, settleTime=0, usePolling=True)
+	assert watcher.waitForFiles(0.05) == []
+	touch(folder + "/c.fits")
+	assert watcher.waitForFiles(1) == [ folder + "/c.fits" ]
@@ -0,0 +1,61 @@
+import numpy
+from astropy.io import fits
+import headerScan, fitsClasses
+
+def astropyHeaders(filename):
+	""" The headers of every HDU merged, as fitsObject reads them with astropy """
+	headers = {}
+	hdulist = fits.open(filename)
+	for hdu in hdulist:
+		for keyword in hdu.header.keys():
+			if keyword in headerScan.skippedKeywords: continue
+			value = hdu.header[keyword]
+			if isinstance(value, fits.card.Undefined): value = None
+			headers[keyword] = value
+	hdulist.close()
+	return headers
+
+def imageHDU(hduClass, seed):
+	hdu = hduClass(numpy.random.RandomState(seed).randint(0, 1000, (60, 41)).astype(numpy.int16), name="CCD%d"%seed)
+	hdu.header['OBJECT'] = "Field %d"%seed
+	hdu.header['EXPTIME'] = 30.0
+	hdu.header['FILTER'] = 'r'
+	hdu.header['LONGSTR'] = "x" * 100
+	return hdu
+
+def writeFiles(tmpdir):
+	primary = fits.PrimaryHDU()
+	primary.header['OBSERVER'] = 'Benchmark'
+	primary.header['UNDEF'] = None
+	files = {}
+	files['single'] = str(tmpdir.join("single.fits"))
+	fits.PrimaryHDU(imageHDU(fits.ImageHDU, 1).data, header=primary.header).writeto(files['single'])
+	files['mef'] = str(tmpdir.join("mef.fits"))
+	fits.HDUList([ primary, imageHDU(fits.ImageHDU, 1), imageHDU(fits.ImageHDU, 2) ]).writeto(files['mef'])
+	files['fz'] = str(tmpdir.join("mef.fits.fz"))
+	fits.HDUList([ primary, imageHDU(fits.CompImageHDU, 1), imageHDU(fits.CompImageHDU, 2) ]).writeto(files['fz'])
+	return files
+
+def test_scanMatchesAstropy(tmpdir):
+	for kind, filename in writeFiles(tmpdir).items():
+		scan = headerScan.scanFile(filename)
+		assert scan['headers'] == astropyHeaders(filename), kind
+		hdulist = fits.open(filename)
+		assert scan['shapes'] == [ hdu.data.shape for hdu in hdulist if hdu.data is not None ], kind
+		hdulist.close()
+
+def test_headerOnlyLoadMatchesFullLoad(tmpdir):
+	""" A header-only rescan records the same values as a full load, including BITPIX and NAXISn of .fz images """
+	for kind, filename in writeFiles(tmpdir).items():
+		folder, name = filename.rsplit("/", 1)
+		scanned, loaded = fitsClasses.fitsObject(), fitsClasses.fitsObject()
+		assert scanned.initFromFITSFile(name, path=folder, loadPixels=False)
+		assert loaded.initFromFITSFile(name, path=folder)
+		assert scanned.allHeaders == loaded.allHeaders, kind
+		assert tuple(scanned.size) == tuple(loaded.size), kind
+	assert scanned.allHeaders['BITPIX'] == 16
+
+def test_selectedKeywords(tmpdir):
+	filename = writeFiles(tmpdir)['mef']
+	scan = headerScan.scanFile(filename, headerScan.wantedKeywords(['OBJECT', 'MISSING']))
+	assert scan['headers'] == { 'OBJECT': "Field 2" }
@@ -0,0 +1,7 @@
+import os, subprocess, sys
+
+def test_importLoadsNoImageLibraries():
+	""" Importing fitsBrowser, as every run does, must not load astropy or PIL; they are only imported when there is a file to render """
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	command = "import sys; sys.path.insert(0, %r); import fitsBrowser; print(sorted(m for m in ('astropy', 'PIL') if m in sys.modules))"%root
+	assert subprocess.check_output([ sys.executable, "-c", command ]).strip() == "[]"
@@ -0,0 +1,46 @@
+import os
+import metadataIndex
+
+def writeFile(filename, text, mtime=None):
+	f = open(filename, 'wb')
+	f.write(text)
+	f.close()
+	if mtime is not None: os.utime(filename, (mtime, mtime))
+
+def test_changeDetection(tmpdir):
+	frame = str(tmpdir.join("frame.fits"))
+	writeFile(frame, b"A" * 100000, 1000000)
+	index = metadataIndex.metadataIndex(str(tmpdir.join("index.json")))
+	assert index.status(frame) == 'new'
+	index.update(frame, { 'sourceFilename': "frame.fits" })
+	assert index.status(frame) == 'unchanged'
+	# Touched without changing the contents
+	os.utime(frame, (2000000, 2000000))
+	assert index.status(frame) == 'unchanged'
+	assert index.entries[frame]['mtime'] == 2000000
+	# Re-written with the same size
+	writeFile(frame, b"A" * 99999 + b"B", 3000000)
+	assert index.status(frame) == 'modified'
+	# Re-written with a different size, keeping the old mtime
+	index.update(frame, None)
+	writeFile(frame, b"A" * 50, 3000000)
+	assert index.status(frame) == 'modified'
+
+def test_savedIndex(tmpdir):
+	frames = [ str(tmpdir.join("frame%d.fits"%i)) for i in range(3) ]
+	for frame in frames: writeFile(frame, frame.encode('ascii'))
+	filename = str(tmpdir.join("index.json"))
+	index = metadataIndex.metadataIndex(filename)
+	for frame in frames: index.update(frame, { 'sourceFilename': os.path.basename(frame) })
+	index.save()
+	reloaded = metadataIndex.metadataIndex(filename)
+	assert reloaded.existed
+	assert [ reloaded.status(frame) for frame in frames ] == [ 'unchanged' ] * 3
+	assert reloaded.getRecord(frames[1]) == { 'sourceFilename': "frame1.fits" }
+	assert reloaded.deletedFiles(set(frames[1:])) == [ frames[0] ]
+
+def test_unreadableIndex(tmpdir):
+	filename = str(tmpdir.join("index.json"))
+	writeFile(filename, b"{ not json")
+	index = metadataIndex.metadataIndex(filename)
+	assert len(index) == 0 and not index.existed
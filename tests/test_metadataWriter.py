@@ -0,0 +1,19 @@
+import os, gzip
+import metadataWriter
+
+def makeRecords(count):
+	return [ { 'sourceFilename': "frame%03d.fits"%i, 'xSize': 100, 'ySize': 200, 'headers': { 'OBJECT': "Field %d"%(i % 3), 'SEQNUM': i } } for i in range(count) ]
+
+def test_chunkedFileReadsBack(tmpdir):
+	filename = str(tmpdir.join("imageMetadata.js"))
+	for compact in [ False, True ]:
+		records = makeRecords(25)
+		metadataWriter.writeJSONFile(filename, "Test", records, chunkSize=10, compact=compact, gzipped=compact)
+		assert sorted(os.listdir(str(tmpdir))) == sorted([ "imageMetadata.js", "imageMetadata_1.js", "imageMetadata_2.js" ] + ([ "imageMetadata.js.gz", "imageMetadata_1.js.gz", "imageMetadata_2.js.gz" ] if compact else []))
+		assert metadataWriter.readJSONFile(filename) == records
+		if compact: assert gzip.open(filename + ".gz").read() == open(filename).read()
+		# Fewer records leave fewer chunks behind
+		metadataWriter.writeJSONFile(filename, "Test", records[:12], chunkSize=10, compact=compact)
+		assert metadataWriter.readJSONFile(filename) == records[:12]
+		assert not os.path.exists(str(tmpdir.join("imageMetadata_2.js")))
+		assert not os.path.exists(str(tmpdir.join("imageMetadata_1.js.gz")))
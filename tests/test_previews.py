@@ -0,0 +1,44 @@
+import os
+import numpy
+from astropy.io import fits
+import fitsBrowser, renderCache
+
+def buildFolder(tmpdir, previewSize):
+	config = fitsBrowser.loadConfig()
+	options = fitsBrowser.folderOptions(config, dataPath=str(tmpdir.join("data")), webPath=str(tmpdir.join("web")), installPath=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), title="Test", previewSize=previewSize)
+	builder = fitsBrowser.folderBuilder(options)
+	result = builder.run()
+	builder.unlock()
+	records = dict([ (r['sourceFilename'], r) for r in builder.writer.jsonData ])
+	return result, records, sorted(os.listdir(str(tmpdir.join("web", "images"))))
+
+def test_smallImagesAreTheirOwnPreview(tmpdir):
+	tmpdir.mkdir("data")
+	for name, size in [ ("small.fits", 50), ("large.fits", 150) ]:
+		fits.PrimaryHDU(numpy.random.RandomState(size).normal(100, 10, (size, size)).astype(numpy.float32)).writeto(str(tmpdir.join("data", name)))
+	result, records, images = buildFolder(tmpdir, 100)
+	assert images == [ "large.png", "preview_large.png", "small.png", "thumb_large.png", "thumb_small.png" ]
+	assert records['small.fits']['previewFilename'] == records['small.fits']['pngFilename'] == "images/small.png"
+	assert records['large.fits']['previewFilename'] == "images/preview_large.png"
+	# Nothing is out of date on the next run
+	result, records, images = buildFolder(tmpdir, 100)
+	assert result['stale'] == 0
+	# A smaller preview size needs a preview of the small image as well, and a larger one lets the preview of the large image go
+	result, records, images = buildFolder(tmpdir, 20)
+	assert images == [ "large.png", "preview_large.png", "preview_small.png", "small.png", "thumb_large.png", "thumb_small.png" ]
+	assert records['small.fits']['previewFilename'] == "images/preview_small.png"
+	result, records, images = buildFolder(tmpdir, 200)
+	assert images == [ "large.png", "small.png", "thumb_large.png", "thumb_small.png" ]
+	assert records['large.fits']['previewFilename'] == "images/large.png"
+
+def test_evictionKeepsTheFullImage(tmpdir):
+	""" When the preview of a file was its full image, re-rendering the file must not delete the full image as an obsolete preview """
+	web = tmpdir.mkdir("web")
+	for name in [ "a.png", "preview_a.png" ]: web.join(name).write("")
+	cache = renderCache.renderCache(str(web.join("renderCache.json")), str(web))
+	parameters = { 'image': "i", 'preview': "p", 'thumbnail': "t" }
+	cache.update("a.fits", "old", { 'image': "a.png", 'preview': "a.png" }, [ 'image', 'preview' ], parameters)
+	assert cache.staleOutputs("a.fits", { 'image': "a.png", 'preview': "preview_a.png" }, "old", parameters) == []
+	cache.update("a.fits", "new", { 'image': "a.png", 'preview': "preview_a.png" }, [ 'image', 'preview' ], parameters)
+	assert os.path.exists(str(web.join("a.png"))) and os.path.exists(str(web.join("preview_a.png")))
+	assert cache.staleOutputs("a.fits", { 'image': "a.png", 'preview': "preview_a.png" }, "new", parameters) == []
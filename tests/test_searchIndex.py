@@ -0,0 +1,50 @@
+import searchIndex
+
+def makeRecords(count):
+	filters = [ 'g', 'r', 'i' ]
+	records = []
+	for i in range(count):
+		headers = { 'OBJECT': "M%d field"%(i % 4), 'FILTER': filters[i % 3], 'EXPTIME': 10 * (i % 5), 'AIRMASS': 1.0 + i / 10.0 }
+		if i % 7 == 0: headers['COMMENTS'] = None
+		record = { 'sourceFilename': "night/frame%03d.fits"%i, 'headers': headers }
+		if i == 5: del record['headers']
+		records.append(record)
+	return records
+
+def linearWordSearch(records, field, word):
+	""" The names of the records whose 'field' holds 'word', found by looking at every record """
+	return set([ r['sourceFilename'] for r in records if word in [ w for f, v in searchIndex.recordFields(r) if f == field for w in searchIndex.words(v) ] ])
+
+def indexedWordSearch(index, field, word):
+	names = index['names']
+	return set([ names[i] for i in index['fields'].get(field, {}).get('words', {}).get(word, []) ])
+
+def checkAgainstLinearScan(records, index):
+	assert index['names'] == sorted([ r['sourceFilename'] for r in records ])
+	names = index['names']
+	for field in [ 'filename', 'OBJECT', 'FILTER', 'EXPTIME', 'COMMENTS' ]:
+		scanWords = set([ w for r in records for f, v in searchIndex.recordFields(r) if f == field for w in searchIndex.words(v) ])
+		assert set(index['fields'].get(field, {}).get('words', {}).keys()) == scanWords
+		for word in scanWords:
+			assert indexedWordSearch(index, field, word) == linearWordSearch(records, field, word)
+	for field in [ 'EXPTIME', 'AIRMASS' ]:
+		values = sorted([ [ r['headers'][field], names.index(r['sourceFilename']) ] for r in records if 'headers' in r ])
+		assert index['fields'][field]['values'] == values
+		# A range query on the sorted values finds what a scan of the records does
+		assert set([ names[i] for v, i in values if v > 20 ]) == set([ r['sourceFilename'] for r in records if 'headers' in r and r['headers'][field] > 20 ])
+	assert 'values' not in index['fields']['OBJECT']
+
+def test_indexMatchesLinearScan():
+	records = makeRecords(30)
+	checkAgainstLinearScan(records, searchIndex.searchIndex(records).asDict())
+
+def test_updatedIndexMatchesLinearScan():
+	""" Replacing and removing records leaves the index as if it had been built from the final records """
+	records = makeRecords(30)
+	index = searchIndex.searchIndex(records)
+	changed = dict(records[3], headers={ 'OBJECT': "Comet", 'FILTER': 'z', 'EXPTIME': 99, 'AIRMASS': 2.5 })
+	index.add(changed)
+	index.remove(records[4]['sourceFilename'])
+	final = [ changed if r is records[3] else r for r in records if r is not records[4] ]
+	checkAgainstLinearScan(final, index.asDict())
+	assert index.asDict() == searchIndex.searchIndex(final).asDict()